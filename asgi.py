@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for Nori, serving the same routes as web.py.
+
+Model calls go through async_assistant, so a single process can hold hundreds
+of concurrent conversations instead of pinning one sync worker per request:
+
+    uvicorn asgi:app --port 5001
+"""
+
+import asyncio
+import json
+import logging
+from typing import Optional
+from urllib.parse import parse_qsl
+import metrics
+from config import BASE_DIR
+from assistant import VARIANTS, DEFAULT_VARIANT
+from async_assistant import achat, achat_stream, use_loop_for_extraction
+from resilience import ModelUnavailableError
+from memory import clear_history
+from session_state import touch_session, update_session
+from web import (
+    UNAVAILABLE_MESSAGE, get_variant, handle_command, limit_headers, limited_reply, reply_cache, request_user_id,
+    sse_event, valid_idempotency_key,
+)
+
+INDEX_HTML = BASE_DIR / "templates" / "index.html"
+
+logger = logging.getLogger(__name__)
+
+
+async def read_json(receive) -> dict:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        return {}
+
+
+async def send_response(send, status: int, body: bytes, content_type: str, headers: Optional[dict] = None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+        + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, payload: dict, status: int = 200, headers: Optional[dict] = None):
+    await send_response(send, status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+
+def scope_user_id(scope, data: dict) -> Optional[str]:
+    """web.request_user_id for an ASGI scope."""
+    header = dict(scope["headers"]).get(b"x-user-id", b"").decode("latin-1")
+    return request_user_id(header, data)
+
+
+def scope_idempotency_key(scope) -> Optional[str]:
+    key = dict(scope["headers"]).get(b"idempotency-key")
+    return key.decode("latin-1") if key is not None else None
+
+
+async def index(scope, receive, send):
+    html = await asyncio.to_thread(INDEX_HTML.read_bytes)
+    await send_response(send, 200, html, "text/html; charset=utf-8")
+
+
+async def get_variant_endpoint(scope, receive, send):
+    user_id = scope_user_id(scope, dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"))))
+    if user_id is None:
+        await send_json(send, {"error": "Invalid user id"}, 400)
+        return
+    variant = await asyncio.to_thread(get_variant, user_id)
+    await send_json(send, {
+        "current": variant,
+        "variants": {k: v["label"] for k, v in VARIANTS.items()}
+    })
+
+
+async def set_variant_endpoint(scope, receive, send):
+    data = await read_json(receive)
+    user_id = scope_user_id(scope, data)
+    if user_id is None:
+        await send_json(send, {"error": "Invalid user id"}, 400)
+        return
+    variant = data.get("variant", DEFAULT_VARIANT)
+    if variant not in VARIANTS:
+        await send_json(send, {"error": f"Unknown variant: {variant}"}, 400)
+        return
+    await asyncio.to_thread(clear_history, user_id, "variant")
+    await asyncio.to_thread(update_session, user_id, variant=variant, greeting_seeded=False,
+                            plan_turns=0)
+    greeting = VARIANTS[variant]["greeting"]
+    await send_json(send, {"status": "ok", "variant": variant, "greeting": greeting})
+
+
+async def chat_reply(user_id: str, message: str) -> tuple[dict, int]:
+    """Async version of web.chat_reply."""
+    command_reply = await asyncio.to_thread(handle_command, message, user_id)
+    if command_reply is not None:
+        return {"messages": command_reply}, 200
+
+    limited = await asyncio.to_thread(limited_reply, user_id)
+    if limited is not None:
+        return limited
+
+    try:
+        with metrics.trace_request("/chat"):
+            variant = await asyncio.to_thread(get_variant, user_id)
+            response = await achat(user_id, message, variant=variant)
+            await asyncio.to_thread(touch_session, user_id)
+    except ModelUnavailableError:
+        logger.warning("Model unavailable", exc_info=True)
+        return {"error": UNAVAILABLE_MESSAGE}, 503
+
+    if response is None:
+        # Answered together with the same user's concurrent message
+        return {"messages": [], "coalesced": True}, 200
+
+    paragraphs = [p.strip() for p in response.split("\n\n") if p.strip()]
+    return {"messages": paragraphs}, 200
+
+
+async def chat_endpoint(scope, receive, send):
+    data = await read_json(receive)
+    user_id = scope_user_id(scope, data)
+    if user_id is None:
+        await send_json(send, {"error": "Invalid user id"}, 400)
+        return
+    message = data.get("message", "").strip()
+
+    if not message:
+        await send_json(send, {"error": "No message provided"}, 400)
+        return
+
+    key = scope_idempotency_key(scope)
+    if not valid_idempotency_key(key):
+        await send_json(send, {"error": "Invalid Idempotency-Key"}, 400)
+        return
+
+    replay = await reply_cache.abegin(user_id, key) if key is not None else None
+    if replay is not None:
+        await send_json(send, replay)
+        return
+    payload, status = None, 500
+    try:
+        payload, status = await chat_reply(user_id, message)
+    finally:
+        if key is not None:
+            await asyncio.to_thread(reply_cache.finish, user_id, key, payload if status == 200 else None)
+    await send_json(send, payload, status, limit_headers(payload, status))
+
+
+async def aiter_paragraphs(chunks):
+    """Async version of web.iter_paragraphs."""
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        while "\n\n" in buffer:
+            paragraph, buffer = buffer.split("\n\n", 1)
+            if paragraph.strip():
+                yield paragraph.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def chat_stream_endpoint(scope, receive, send):
+    data = await read_json(receive)
+    user_id = scope_user_id(scope, data)
+    if user_id is None:
+        await send_json(send, {"error": "Invalid user id"}, 400)
+        return
+    message = data.get("message", "").strip()
+
+    if not message:
+        await send_json(send, {"error": "No message provided"}, 400)
+        return
+
+    key = scope_idempotency_key(scope)
+    if not valid_idempotency_key(key):
+        await send_json(send, {"error": "Invalid Idempotency-Key"}, 400)
+        return
+    replay = await reply_cache.abegin(user_id, key) if key is not None else None
+
+    # Until the stream takes over the claimed key, any early exit releases it
+    streaming = False
+    try:
+        if replay is not None:
+            command_reply = replay["messages"]
+        else:
+            command_reply = await asyncio.to_thread(handle_command, message, user_id)
+        if command_reply is None:
+            limited = await asyncio.to_thread(limited_reply, user_id)
+            if limited is not None:
+                await send_json(send, limited[0], 429, limit_headers(*limited))
+                return
+        variant = await asyncio.to_thread(get_variant, user_id)
+        streaming = True
+    finally:
+        if key is not None and replay is None and not streaming:
+            await asyncio.to_thread(reply_cache.finish, user_id, key, None)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def emit(event: str, payload: dict, more: bool = True):
+        await send({"type": "http.response.body", "body": sse_event(event, payload).encode("utf-8"),
+                    "more_body": more})
+
+    # Bubbles sent so far, kept for replay once the stream completes
+    paragraphs = []
+    completed = False
+    try:
+        if command_reply is not None:
+            for paragraph in command_reply:
+                paragraphs.append(paragraph)
+                await emit("message", {"text": paragraph})
+        else:
+            with metrics.trace_request("/chat/stream"):
+                async for paragraph in aiter_paragraphs(achat_stream(user_id, message, variant=variant)):
+                    paragraphs.append(paragraph)
+                    await emit("message", {"text": paragraph})
+                await asyncio.to_thread(touch_session, user_id)
+        completed = True
+    except ModelUnavailableError:
+        logger.warning("Model unavailable", exc_info=True)
+        await emit("error", {"error": UNAVAILABLE_MESSAGE}, more=False)
+        return
+    except Exception:
+        logger.exception("Streaming chat failed")
+        await emit("error", {"error": "Something went wrong. Please try again."}, more=False)
+        return
+    finally:
+        if key is not None and replay is None:
+            await asyncio.to_thread(reply_cache.finish, user_id, key, {"messages": paragraphs} if completed else None)
+    await emit("done", {}, more=False)
+
+
+async def metrics_endpoint(scope, receive, send):
+    await send_response(send, 200, metrics.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+
+
+ROUTES = {
+    ("GET", "/"): index,
+    ("GET", "/get-variant"): get_variant_endpoint,
+    ("POST", "/set-variant"): set_variant_endpoint,
+    ("POST", "/chat"): chat_endpoint,
+    ("POST", "/chat/stream"): chat_stream_endpoint,
+    ("GET", "/metrics"): metrics_endpoint,
+}
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                use_loop_for_extraction(asyncio.get_running_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                use_loop_for_extraction(None)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await send_json(send, {"error": "Not found"}, 404)
+        return
+    await handler(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import os
+    import uvicorn
+    port = int(os.environ.get("PORT", 5001))
+    uvicorn.run("asgi:app", host="0.0.0.0", port=port)
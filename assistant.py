@@ -1,21 +1,59 @@
 from typing import Optional
 import json
+import logging
+import threading
+import time
 from datetime import datetime
 import anthropic
-from config import ANTHROPIC_API_KEY, MODEL, PROMPTS_DIR
+from config import (
+    ANTHROPIC_API_KEY,
+    EXTRACTION_QUEUE_DIR, EXTRACTION_WORKERS, EXTRACTION_COALESCE_SECONDS, EXTRACTION_LOCAL_FIRST,
+    MODEL_DEADLINES, MODEL_MAX_RETRIES, MODEL_RETRY_BASE_DELAY, MODEL_HEDGE_TASKS, MODEL_HEDGE_PERCENTILE,
+    MODEL_HEDGE_MIN_DELAY, MODEL_HEDGE_MIN_SAMPLES,
+    BREAKER_WINDOW, BREAKER_DEGRADE_RATE, BREAKER_OPEN_RATE, BREAKER_COOLDOWN,
+    TURN_COALESCE_SECONDS, TURN_ASYNC_POLL_MAX,
+    RECALL_TOP_K, RECALL_SNIPPET_CHARS, PROFILE_PROMPT_NOTES,
+)
+import metrics
+from extraction_queue import ExtractionQueue
+from history import archive_summarized_turns, get_history_window, load_summary, refresh_summary
+from local_extraction import extract_locally
 from memory import get_recent_history, save_conversation_turn
-from user_profile import format_profile_for_prompt, load_profile, save_profile
-
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-
+from playbooks import playbook_stage, read_prompt_file, static_prompt
+from recall import format_snippets, recall_index
+from resilience import CircuitBreaker, ModelCaller, ModelUnavailableError
+from routing import chat_route, record_call, route_params
+from session_state import get_session, update_session
+from turns import TurnGate, user_locks
+from user_profile import format_profile_for_prompt, load_profile, profile_update, save_profile
+
+logger = logging.getLogger(__name__)
+
+# Retries, deadlines and hedging are handled by model_calls, not the SDK
+client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+model_calls = ModelCaller(
+    MODEL_DEADLINES,
+    max_retries=MODEL_MAX_RETRIES,
+    retry_base_delay=MODEL_RETRY_BASE_DELAY,
+    hedge_tasks=MODEL_HEDGE_TASKS,
+    hedge_percentile=MODEL_HEDGE_PERCENTILE,
+    hedge_min_delay=MODEL_HEDGE_MIN_DELAY,
+    hedge_min_samples=MODEL_HEDGE_MIN_SAMPLES,
+    breaker=CircuitBreaker(BREAKER_WINDOW, BREAKER_DEGRADE_RATE, BREAKER_OPEN_RATE, BREAKER_COOLDOWN),
+)
+metrics.register_collector(metrics.counters("nori_model", model_calls.stats, "Model call outcomes."))
+metrics.register_collector(lambda: [(
+    "nori_model_breaker_state", "gauge", "Circuit breaker: 0 closed, 1 degraded (background paused), 2 open.",
+    (CircuitBreaker.CLOSED, CircuitBreaker.DEGRADED, CircuitBreaker.OPEN).index(model_calls.breaker.state()),
+)])
+
+# Each variant's task list and stages are in playbooks.PLAYBOOKS
 VARIANTS = {
     "coach": {
-        "task_file": "tasks_coach.txt",
         "greeting": "Hi — I'm your weight loss coach. I'll ask a few questions to build a plan tailored to you.\n\nHow much weight are you looking to lose?",
         "label": "Coach (step-by-step)",
     },
     "planner": {
-        "task_file": "tasks_planner.txt",
         "greeting": "Hi — I'm your weight loss coach. Tell me a bit about your goals and I'll put together a draft plan for you to review.\n\nHow much weight are you looking to lose?",
         "label": "Planner (quick draft + refine)",
     },
@@ -24,47 +62,100 @@ VARIANTS = {
 DEFAULT_VARIANT = "coach"
 
 
-def load_system_prompt(variant: str = DEFAULT_VARIANT) -> str:
-    """Load and assemble the system prompt for the given variant."""
-    header = (PROMPTS_DIR / "base_header.txt").read_text()
-    task_file = VARIANTS[variant]["task_file"]
-    tasks = (PROMPTS_DIR / task_file).read_text()
-    footer = (PROMPTS_DIR / "base_footer.txt").read_text()
-    return header + "\n\n" + tasks + "\n\n" + footer
+# Provider-side prompt cache counters, taken from the API usage fields
+prompt_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "cache_read_tokens": 0,
+    "cache_write_tokens": 0,
+    "uncached_input_tokens": 0,
+}
+_prompt_cache_stats_lock = threading.Lock()
+metrics.register_collector(metrics.counters("nori_prompt_cache", prompt_cache_stats, "Provider prompt cache usage."))
+
+# Profile extraction counters: exchanges parsed locally and model calls made or avoided
+extraction_stats = {
+    "exchanges": 0,
+    "resolved_locally": 0,
+    "model_calls": 0,
+    "calls_avoided": 0,
+}
+_extraction_stats_lock = threading.Lock()
+metrics.register_collector(metrics.counters("nori_extraction", extraction_stats, "Profile extraction work."))
 
 
-def load_resources() -> str:
-    """Load URL patterns for services."""
-    resources_file = PROMPTS_DIR / "resources.txt"
-    if resources_file.exists():
-        return resources_file.read_text()
-    return ""
+def session_variant(user_id: str) -> str:
+    """The user's active variant, or the default."""
+    variant = get_session(user_id)["variant"]
+    return variant if variant in VARIANTS else DEFAULT_VARIANT
 
 
-def build_system_prompt(user_id: str, variant: str = DEFAULT_VARIANT) -> str:
-    """Build the complete system prompt with user profile and resources."""
-    template = load_system_prompt(variant)
-    profile_text = format_profile_for_prompt(user_id)
-    resources = load_resources()
+def build_system_prompt(user_id: str, variant: str = DEFAULT_VARIANT, query: str = "",
+                        skip_recent: int = 0) -> list[dict]:
+    """Build the system prompt as ordered blocks: a cacheable static prefix, then per-user context.
 
-    current_date = datetime.now().strftime("%B %d, %Y")
-    prompt = template.format(user_profile=profile_text, current_date=current_date)
-    if resources:
-        prompt += f"\n\n{resources}"
-    return prompt
+    The playbook steps and resources for the user's stage are shared by everyone
+    at that stage, so they go first and are marked for provider-side prompt
+    caching (see playbooks.py). The date,
+    profile and snippets recalled for `query` change from turn to turn and go last,
+    after the cache breakpoint. The newest `skip_recent` turns are not recalled.
+    """
+    static = static_prompt(variant, load_profile(user_id), get_session(user_id)["plan_turns"])
 
+    profile_text = format_profile_for_prompt(user_id)
+    current_date = datetime.now().strftime("%B %d, %Y")
+    context = read_prompt_file("context.txt").format(user_profile=profile_text, current_date=current_date)
+    summary = load_summary(user_id)["text"]
+    if summary:
+        context += f"\n\n## Earlier in this conversation\n{summary}"
+    if query:
+        notes = load_profile(user_id)["notes"]
+        notes = notes[:max(len(notes) - PROFILE_PROMPT_NOTES, 0)]  # the newest are in the profile block
+        recalled = recall_index.search(user_id, query, RECALL_TOP_K, skip_recent=skip_recent, notes=notes)
+        if recalled:
+            context += f"\n\n## Possibly relevant from past conversations\n{format_snippets(recalled, RECALL_SNIPPET_CHARS)}"
+
+    return [
+        {"type": "text", "text": static, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": context},
+    ]
+
+
+def record_prompt_cache_usage(usage) -> None:
+    """Update prompt cache hit/miss counters from a response's usage."""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    with _prompt_cache_stats_lock:
+        prompt_cache_stats["hits" if cache_read else "misses"] += 1
+        prompt_cache_stats["cache_read_tokens"] += cache_read
+        prompt_cache_stats["cache_write_tokens"] += cache_write
+        prompt_cache_stats["uncached_input_tokens"] += getattr(usage, "input_tokens", 0) or 0
+
+
+def extract_profile_updates(user_id: str, user_message: str, assistant_response: str,
+                            previous_response: Optional[str] = None) -> Optional[dict]:
+    """Extract any new profile information from the conversation."""
+    return extract_profile_updates_batch(user_id, [{
+        "user_message": user_message,
+        "assistant_response": assistant_response,
+        "previous_response": previous_response,
+    }])
+
+
+def build_extraction_prompt(user_id: str, exchanges: list[dict]) -> str:
+    """Build the profile extraction prompt for one or more consecutive exchanges."""
+    transcript = "\n\n".join(
+        f"User said: {e['user_message']}\nAssistant responded: {e['assistant_response']}"
+        for e in exchanges
+    )
+    noun = "exchange" if len(exchanges) == 1 else "exchanges"
 
-def extract_profile_updates(user_id: str, user_message: str, assistant_response: str) -> Optional[dict]:
-    """Use Claude to extract any new profile information from the conversation."""
-    profile = load_profile(user_id)
-
-    extraction_prompt = f"""Analyze this conversation exchange and extract any NEW information about the user that should be remembered for their weight loss plan.
+    extraction_prompt = f"""Analyze this conversation {noun} and extract any NEW information about the user that should be remembered for their weight loss plan.
 
 Current known profile:
 {format_profile_for_prompt(user_id)}
 
-User said: {user_message}
-Assistant responded: {assistant_response}
+{transcript}
 
 If there's new information to add, respond with a JSON object containing only the fields to update:
 - name: string
@@ -87,35 +178,37 @@ Only include fields where you found NEW information not already in the profile.
 If nothing new was learned, respond with exactly: null
 
 Respond with ONLY the JSON object or null, no other text."""
-
-    response = client.messages.create(
-        model=MODEL,
-        max_tokens=500,
-        messages=[{"role": "user", "content": extraction_prompt}]
-    )
-
-    response_text = response.content[0].text.strip()
-
+    return extraction_prompt
+
+
+def merge_profile_updates(user_id: str, updates: dict):
+    """Merge extracted fields into the saved profile; list fields are appended to."""
+    with profile_update(user_id):
+        profile = load_profile(user_id)
+        for key, value in updates.items():
+            if key in profile:
+                if isinstance(profile[key], list) and isinstance(value, list):
+                    for item in value:
+                        if item not in profile[key]:
+                            profile[key].append(item)
+                elif isinstance(profile[key], list):
+                    if value not in profile[key]:
+                        profile[key].append(value)
+                else:
+                    profile[key] = value
+        save_profile(user_id, profile)
+
+
+def apply_profile_updates(user_id: str, response_text: str) -> Optional[dict]:
+    """Merge an extraction response into the saved profile. Returns the updates applied."""
+    response_text = response_text.strip()
     if response_text == "null" or not response_text:
         return None
 
     try:
         updates = json.loads(response_text)
         if updates:
-            # Merge updates into profile
-            for key, value in updates.items():
-                if key in profile:
-                    if isinstance(profile[key], list) and isinstance(value, list):
-                        for item in value:
-                            if item not in profile[key]:
-                                profile[key].append(item)
-                    elif isinstance(profile[key], list):
-                        if value not in profile[key]:
-                            profile[key].append(value)
-                    else:
-                        profile[key] = value
-
-            save_profile(user_id, profile)
+            merge_profile_updates(user_id, updates)
             return updates
     except json.JSONDecodeError:
         pass
@@ -123,74 +216,233 @@ Respond with ONLY the JSON object or null, no other text."""
     return None
 
 
-def chat(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT) -> str:
-    """Send a message and get a response, managing memory automatically."""
-    # Save user message
-    save_conversation_turn(user_id, "user", user_message)
+def resolve_locally(exchanges: list[dict]) -> tuple[dict, list[dict]]:
+    """Split exchanges into updates parsed locally and the exchanges that still need the model."""
+    local_updates: dict = {}
+    unresolved = []
+    for exchange in exchanges:
+        updates = extract_locally(exchange) if EXTRACTION_LOCAL_FIRST else None
+        if updates is None:
+            unresolved.append(exchange)
+            continue
+        for key, value in updates.items():
+            if isinstance(value, list):
+                local_updates.setdefault(key, [])
+                local_updates[key] += [v for v in value if v not in local_updates[key]]
+            else:
+                local_updates[key] = value
+
+    with _extraction_stats_lock:
+        extraction_stats["exchanges"] += len(exchanges)
+        extraction_stats["resolved_locally"] += len(exchanges) - len(unresolved)
+        extraction_stats["model_calls" if unresolved else "calls_avoided"] += 1
+    return local_updates, unresolved
+
+
+def extract_profile_updates_batch(user_id: str, exchanges: list[dict]) -> Optional[dict]:
+    """Extract new profile information from one or more consecutive exchanges."""
+    with metrics.span("extraction"):
+        local_updates, unresolved = resolve_locally(exchanges)
+        updates = None
+        if unresolved:
+            params = route_params("extraction")
+            started = time.perf_counter()
+            response = model_calls.create(
+                client, "extraction",
+                **params,
+                messages=[{"role": "user", "content": build_extraction_prompt(user_id, unresolved)}]
+            )
+            record_call("extraction", params["model"], time.perf_counter() - started, response.usage,
+                        user_id=user_id, variant=session_variant(user_id))
+            updates = apply_profile_updates(user_id, response.content[0].text)
+        # Direct answers parsed locally win over the model's reading of the surrounding turns
+        if local_updates:
+            merge_profile_updates(user_id, local_updates)
+            updates = {**(updates or {}), **local_updates}
+        return updates
+
+
+def summarize_conversation(previous_summary: str, turns: list[dict], user_id: Optional[str] = None) -> str:
+    """Fold older turns into the rolling conversation summary."""
+    transcript = "\n".join(f"{t['role'].capitalize()}: {t['content']}" for t in turns)
+    summary_prompt = f"""You maintain a running summary of a weight loss coaching conversation. The most recent messages are shown to the coach verbatim; this summary covers everything before them.
+
+Current summary:
+{previous_summary or "(none yet)"}
+
+Older messages to fold in:
+{transcript}
+
+Rewrite the summary to include what matters from these messages: where the user is in the coaching steps, decisions made, numbers agreed, plan details and open questions. Stay under 200 words. Plain text, no preamble."""
+
+    params = route_params("summary")
+    started = time.perf_counter()
+    with metrics.span("summary"):
+        response = model_calls.create(
+            client, "summary",
+            **params,
+            messages=[{"role": "user", "content": summary_prompt}]
+        )
+    record_call("summary", params["model"], time.perf_counter() - started, response.usage,
+                user_id=user_id, variant=user_id and session_variant(user_id))
+    return response.content[0].text.strip()
+
+
+def _run_extraction_job(user_id: str, exchanges: list[dict]):
+    extract_profile_updates_batch(user_id, exchanges)
+    fold_history(user_id)
+
+
+def fold_history(user_id: str):
+    """Post-turn maintenance run after extraction: fold evicted turns into the summary, archive them."""
+    try:
+        refresh_summary(user_id, lambda summary, turns: summarize_conversation(summary, turns, user_id))
+    except ModelUnavailableError as e:
+        # Don't fail (and re-run) the extraction; the fold is retried after the next turn
+        logger.warning("Summary fold for %s skipped: %s", user_id, e)
+    archive_summarized_turns(user_id)
+
+
+# Profile extraction runs off the response path; back-to-back turns are coalesced
+extraction_queue = ExtractionQueue(
+    _run_extraction_job,
+    EXTRACTION_QUEUE_DIR,
+    workers=EXTRACTION_WORKERS,
+    coalesce_seconds=EXTRACTION_COALESCE_SECONDS,
+)
+metrics.register_collector(lambda: [(
+    "nori_extraction_queue_users", "gauge", "Users with queued or running profile extraction.",
+    extraction_queue.depth(),
+)])
+
+
+def flush_profile_updates(user_id: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+    """Wait for pending profile extraction so the profile reflects every turn."""
+    return extraction_queue.flush(user_id, timeout)
+
+
+# One turn at a time per user; messages that arrive mid-turn are answered together next
+turn_gate = TurnGate(user_locks, TURN_COALESCE_SECONDS, TURN_ASYNC_POLL_MAX)
+metrics.register_collector(metrics.counters("nori_turn", turn_gate.stats, "Chat turns run and messages coalesced."))
 
-    # Build context
-    system_prompt = build_system_prompt(user_id, variant)
-    history = get_recent_history(user_id)
+
+def prepare_turn(user_id: str, user_messages: list[str], variant: str = DEFAULT_VARIANT) -> tuple[list[dict], list[dict], str]:
+    """Save the user's messages and build the system prompt, history and model route for the reply."""
+    # Save user messages; consecutive user turns are merged by the API
+    for user_message in user_messages:
+        save_conversation_turn(user_id, "user", user_message)
+
+    # Build context; turns already in the history window aren't recalled again
+    history = get_history_window(user_id)
+    with metrics.span("prompt_build"):
+        system_prompt = build_system_prompt(user_id, variant, "\n".join(user_messages), skip_recent=len(history))
 
     # Seed the conversation with the greeting so the model sees itself on-track
     greeting = VARIANTS[variant]["greeting"]
-    if len(history) == 1:
+    if not get_session(user_id)["greeting_seeded"] and len(history) == len(user_messages):
         # First user message — inject the greeting as prior assistant turn
         history = [
             {"role": "user", "content": "hi"},
             {"role": "assistant", "content": greeting},
         ] + history
 
-    # Get response from Claude
-    response = client.messages.create(
-        model=MODEL,
-        max_tokens=1024,
-        system=system_prompt,
-        messages=history
-    )
+    return system_prompt, history, chat_route(load_profile(user_id))
 
-    assistant_message = response.content[0].text
 
+def finish_turn(user_id: str, user_messages: list[str], assistant_message: str):
+    """Save the reply and queue profile extraction for the exchange."""
     # Save assistant response
     save_conversation_turn(user_id, "assistant", assistant_message)
 
-    # Extract and save any new profile information
-    extract_profile_updates(user_id, user_message, assistant_message)
-
-    return assistant_message
-
+    # The greeting is seeded once per conversation; count turns spent on the plan,
+    # so the playbook moves on even if extraction misses it
+    session = get_session(user_id)
+    changes = {} if session["greeting_seeded"] else {"greeting_seeded": True}
+    if playbook_stage(load_profile(user_id), session["plan_turns"]) == "plan":
+        changes["plan_turns"] = session["plan_turns"] + 1
+    if changes:
+        update_session(user_id, **changes)
+
+    # The reply the user was answering lets short answers ("yes", "180 lbs") be parsed locally
+    recent = get_recent_history(user_id, len(user_messages) + 2)
+    previous_response = (
+        recent[0]["content"] if len(recent) == len(user_messages) + 2 and recent[0]["role"] == "assistant" else None
+    )
 
-def chat_stream(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT):
-    """Stream a response, yielding chunks as they arrive."""
-    # Save user message
-    save_conversation_turn(user_id, "user", user_message)
+    # Extract and save any new profile information in the background
+    extraction_queue.submit(user_id, "\n\n".join(user_messages), assistant_message, previous_response)
 
-    # Build context
-    system_prompt = build_system_prompt(user_id, variant)
-    history = get_recent_history(user_id)
 
-    # Seed the conversation with the greeting so the model sees itself on-track
-    greeting = VARIANTS[variant]["greeting"]
-    if len(history) == 1:
-        history = [
-            {"role": "user", "content": "hi"},
-            {"role": "assistant", "content": greeting},
-        ] + history
+def chat(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT) -> Optional[str]:
+    """Send a message and get a response, managing memory automatically.
 
-    # Stream response from Claude
-    full_response = ""
-    with client.messages.stream(
-        model=MODEL,
-        max_tokens=1024,
-        system=system_prompt,
-        messages=history
-    ) as stream:
-        for text in stream.text_stream:
-            full_response += text
-            yield text
+    Returns None if a concurrent request from the same user already answered the message.
+    """
+    with metrics.span("turn_wait"):
+        handle, user_messages = turn_gate.enter(user_id, user_message)
+    if user_messages is None:
+        return None
+    try:
+        system_prompt, history, route = prepare_turn(user_id, user_messages, variant)
+        params = route_params(route, variant)
+
+        # Get response from Claude
+        started = time.perf_counter()
+        with metrics.span("model"):
+            response = model_calls.create(
+                client, "chat",
+                **params,
+                system=system_prompt,
+                messages=history
+            )
+
+        assistant_message = response.content[0].text
+        record_prompt_cache_usage(response.usage)
+        record_call(route, params["model"], time.perf_counter() - started, response.usage,
+                    user_id=user_id, variant=variant)
+
+        finish_turn(user_id, user_messages, assistant_message)
+    finally:
+        turn_gate.leave(handle)
+    return assistant_message
 
-    # Save assistant response
-    save_conversation_turn(user_id, "assistant", full_response)
 
-    # Extract profile updates after streaming completes
-    extract_profile_updates(user_id, user_message, full_response)
+def chat_stream(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT):
+    """Stream a response, yielding chunks as they arrive.
+
+    Yields nothing if a concurrent request from the same user already answered the message.
+    """
+    with metrics.span("turn_wait"):
+        handle, user_messages = turn_gate.enter(user_id, user_message)
+    if user_messages is None:
+        return
+    try:
+        system_prompt, history, route = prepare_turn(user_id, user_messages, variant)
+        params = route_params(route, variant)
+
+        # Stream response from Claude
+        full_response = ""
+        started = time.perf_counter()
+        first_token = None
+        with model_calls.stream(
+            client, "chat",
+            **params,
+            system=system_prompt,
+            messages=history
+        ) as stream:
+            for text in stream.text_stream:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    metrics.record_stage("model_ttft", first_token - started)
+                full_response += text
+                yield text
+            usage = stream.get_final_message().usage
+            record_prompt_cache_usage(usage)
+        finished = time.perf_counter()
+        metrics.record_stage("model_generation", finished - (first_token or started))
+        record_call(route, params["model"], finished - started, usage, ttft=first_token and first_token - started,
+                    user_id=user_id, variant=variant)
+
+        finish_turn(user_id, user_messages, full_response)
+    finally:
+        turn_gate.leave(handle)
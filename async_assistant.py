@@ -0,0 +1,160 @@
+"""
+Async counterparts of the assistant entry points, built on AsyncAnthropic.
+
+Model calls are awaited on the event loop, so one process can hold many
+conversations in flight. Storage and prompt assembly are still the sync code
+in assistant.py; they are short and run in the default thread pool so they
+never block the loop. Waiting for a user's turn (TurnGate.aenter) polls the
+turn lock on the loop, so a queue of waiting turns holds no threads.
+
+Under the ASGI app, use_loop_for_extraction() has the background extraction
+queue make its model calls here too, with the async client.
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+import anthropic
+import metrics
+from assistant import (
+    DEFAULT_VARIANT,
+    apply_profile_updates,
+    build_extraction_prompt,
+    extraction_queue,
+    finish_turn,
+    fold_history,
+    merge_profile_updates,
+    model_calls,
+    prepare_turn,
+    record_prompt_cache_usage,
+    resolve_locally,
+    session_variant,
+    turn_gate,
+)
+from config import ANTHROPIC_API_KEY
+from routing import record_call, route_params
+
+async_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+_worker_extraction_job = extraction_queue.handler
+
+
+async def achat(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT) -> Optional[str]:
+    """Async version of assistant.chat."""
+    with metrics.span("turn_wait"):
+        handle, user_messages = await turn_gate.aenter(user_id, user_message)
+    if user_messages is None:
+        return None
+    try:
+        system_prompt, history, route = await asyncio.to_thread(prepare_turn, user_id, user_messages, variant)
+        params = route_params(route, variant)
+
+        started = time.perf_counter()
+        with metrics.span("model"):
+            response = await model_calls.acreate(
+                async_client, "chat",
+                **params,
+                system=system_prompt,
+                messages=history
+            )
+
+        assistant_message = response.content[0].text
+        record_prompt_cache_usage(response.usage)
+        # Usage is stored per user, so record off the loop
+        await asyncio.to_thread(record_call, route, params["model"], time.perf_counter() - started, response.usage,
+                                user_id=user_id, variant=variant)
+
+        await asyncio.to_thread(finish_turn, user_id, user_messages, assistant_message)
+    finally:
+        turn_gate.leave(handle)  # never blocks
+    return assistant_message
+
+
+async def achat_stream(user_id: str, user_message: str, variant: str = DEFAULT_VARIANT) -> AsyncIterator[str]:
+    """Async version of assistant.chat_stream."""
+    with metrics.span("turn_wait"):
+        handle, user_messages = await turn_gate.aenter(user_id, user_message)
+    if user_messages is None:
+        return
+    try:
+        system_prompt, history, route = await asyncio.to_thread(prepare_turn, user_id, user_messages, variant)
+        params = route_params(route, variant)
+
+        full_response = ""
+        started = time.perf_counter()
+        first_token = None
+        async with model_calls.astream(
+            async_client, "chat",
+            **params,
+            system=system_prompt,
+            messages=history
+        ) as stream:
+            async for text in stream.text_stream:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    metrics.record_stage("model_ttft", first_token - started)
+                full_response += text
+                yield text
+            usage = (await stream.get_final_message()).usage
+            record_prompt_cache_usage(usage)
+        finished = time.perf_counter()
+        metrics.record_stage("model_generation", finished - (first_token or started))
+        await asyncio.to_thread(record_call, route, params["model"], finished - started, usage,
+                                ttft=first_token and first_token - started, user_id=user_id, variant=variant)
+
+        await asyncio.to_thread(finish_turn, user_id, user_messages, full_response)
+    finally:
+        # Never blocks, and can't await here if the generator is closed during cleanup
+        turn_gate.leave(handle)
+
+
+
+async def aextract_profile_updates(user_id: str, user_message: str, assistant_response: str,
+                                   previous_response: Optional[str] = None) -> Optional[dict]:
+    """Async version of assistant.extract_profile_updates."""
+    return await aextract_profile_updates_batch(user_id, [{
+        "user_message": user_message,
+        "assistant_response": assistant_response,
+        "previous_response": previous_response,
+    }])
+
+
+async def aextract_profile_updates_batch(user_id: str, exchanges: list[dict]) -> Optional[dict]:
+    """Async version of assistant.extract_profile_updates_batch."""
+    with metrics.span("extraction"):
+        local_updates, unresolved = resolve_locally(exchanges)
+        updates = None
+        if unresolved:
+            extraction_prompt = await asyncio.to_thread(build_extraction_prompt, user_id, unresolved)
+            params = route_params("extraction")
+            started = time.perf_counter()
+            response = await model_calls.acreate(
+                async_client, "extraction",
+                **params,
+                messages=[{"role": "user", "content": extraction_prompt}]
+            )
+            variant = await asyncio.to_thread(session_variant, user_id)
+            await asyncio.to_thread(record_call, "extraction", params["model"], time.perf_counter() - started,
+                                    response.usage, user_id=user_id, variant=variant)
+            updates = await asyncio.to_thread(apply_profile_updates, user_id, response.content[0].text)
+        # Direct answers parsed locally win over the model's reading of the surrounding turns
+        if local_updates:
+            await asyncio.to_thread(merge_profile_updates, user_id, local_updates)
+            updates = {**(updates or {}), **local_updates}
+        return updates
+
+
+def use_loop_for_extraction(loop: Optional[asyncio.AbstractEventLoop]):
+    """Run queued extractions' model calls on `loop`, or on the workers again with None.
+
+    The queue's own worker threads still wait for each job and run the summary
+    fold, so a failed job is retried as before.
+    """
+    if loop is None:
+        extraction_queue.handler = _worker_extraction_job
+        return
+
+    def run_extraction_job(user_id: str, exchanges: list[dict]):
+        asyncio.run_coroutine_threadsafe(aextract_profile_updates_batch(user_id, exchanges), loop).result()
+        fold_history(user_id)
+
+    extraction_queue.handler = run_extraction_job
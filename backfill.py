@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Re-run profile extraction over stored conversations.
+
+Use after adding a field to DEFAULT_PROFILE or changing the extraction prompt.
+Every user's history since their last /reset, archived segments included, is
+replayed through extraction in chunks of exchanges, several users at a time.
+Progress is appended to a log after each chunk and folded into the checkpoint
+now and then, so an interrupted run picks up where it stopped:
+
+    python backfill.py                          # every user, 4 at a time
+    python backfill.py --users alice bob --reset
+    python backfill.py --batch                  # submit through the Message Batches API
+
+Rate limits and overload errors pause every worker, honouring retry-after.
+To try it without an API key, point it at the fake server:
+
+    python fake_anthropic.py --port 8089 --batch-delay 5 &
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8089 ANTHROPIC_API_KEY=test python backfill.py --batch
+"""
+
+import argparse
+import copy
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+import assistant
+from config import DATA_ROOT
+from resilience import RETRYABLE, ModelUnavailableError
+from routing import route_params
+from storage import _atomic_write, get_storage
+from user_profile import DEFAULT_PROFILE, flush_profiles, load_profile, save_profile
+
+DEFAULT_CHECKPOINT = DATA_ROOT / "backfill.json"
+DEFAULT_CONCURRENCY = 4
+DEFAULT_CHUNK_EXCHANGES = 20
+COMPACT_EVERY = 1000  # progress records logged before they're folded into the checkpoint
+MAX_BATCH_REQUESTS = 10_000
+
+
+def user_turns(user_id: str) -> list[dict]:
+    """Every turn since the user's last /reset: archived segments in order, then the active one."""
+    storage = get_storage()
+    turns = []
+    for entry in storage.list_archives(user_id):
+        if entry["reason"] == "reset":
+            turns = []  # a reset forgets everything before it
+            continue
+        turns += storage.load_archive(user_id, entry["id"])
+    return turns + storage.load_turns(user_id)
+
+
+def exchanges_from_turns(turns: list[dict]) -> list[dict]:
+    """Pair each user turn with the reply to it, as the extraction queue does."""
+    exchanges = []
+    previous_response = None
+    for i, turn in enumerate(turns):
+        if turn["role"] == "assistant":
+            previous_response = turn["content"]
+            continue
+        reply = turns[i + 1] if i + 1 < len(turns) and turns[i + 1]["role"] == "assistant" else None
+        exchanges.append({
+            "user_message": turn["content"],
+            "assistant_response": reply["content"] if reply else "",
+            "previous_response": previous_response,
+        })
+    return exchanges
+
+
+def chunked(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class Checkpoint:
+    """Per-user progress and outstanding batches.
+
+    Each change is appended to a log next to the checkpoint (<path>.log); every
+    COMPACT_EVERY records, and on close, the state is written to the checkpoint
+    atomically and the log emptied. Replaying a record twice is harmless, so a
+    crash between the two steps loses nothing.
+    """
+
+    def __init__(self, path: Path, restart: bool = False, compact_every: int = COMPACT_EVERY):
+        self.path = path
+        self.log_path = path.with_name(path.name + ".log")
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self.data = {"users": {}, "batches": {}}
+        self._logged = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if not restart:
+            if path.exists():
+                self.data = json.loads(path.read_text())
+            if self.log_path.exists():
+                for line in self.log_path.read_bytes().splitlines():
+                    try:
+                        self._apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # the record being written when the run stopped
+        self._compact()
+        self._log = open(self.log_path, "ab")
+
+    def _apply(self, record: dict):
+        if record["op"] == "user":
+            self.data["users"].setdefault(record["id"], {"chunks_done": 0, "done": False}).update(record["fields"])
+        elif record["op"] == "add_batch":
+            self.data["batches"][record["id"]] = record["chunks"]
+        elif record["op"] == "finish_batch":
+            self.data["batches"].pop(record["id"], None)
+            for user_id, fields in record["users"].items():
+                self.data["users"].setdefault(user_id, {"chunks_done": 0, "done": False}).update(fields)
+
+    def _record(self, record: dict):
+        # Caller holds the lock
+        self._apply(record)
+        self._log.write((json.dumps(record) + "\n").encode("utf-8"))
+        self._log.flush()
+        self._logged += 1
+        if self._logged >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        # Caller holds the lock (or is __init__)
+        _atomic_write(self.path, json.dumps(self.data, indent=2).encode("utf-8"))
+        self.log_path.write_bytes(b"")
+        self._logged = 0
+
+    def close(self):
+        """Fold the log into the checkpoint."""
+        with self._lock:
+            self._compact()
+            self._log.close()
+
+    def user(self, user_id: str) -> dict:
+        with self._lock:
+            return dict(self.data["users"].get(user_id, {"chunks_done": 0, "done": False}))
+
+    def update_user(self, user_id: str, **fields):
+        with self._lock:
+            self._record({"op": "user", "id": user_id, "fields": fields})
+
+    def add_batch(self, batch_id: str, chunks: list):
+        with self._lock:
+            self._record({"op": "add_batch", "id": batch_id, "chunks": chunks})
+
+    def finish_batch(self, batch_id: str, users: dict):
+        with self._lock:
+            self._record({"op": "finish_batch", "id": batch_id, "users": users})
+
+
+class RateGate:
+    """Shared backoff: when one worker is rate limited, all of them wait."""
+
+    def __init__(self, max_retries: int = 8, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def call(self, fn: Callable):
+        """Call fn, backing off on rate limits, overload and connection errors."""
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            try:
+                return fn()
+            except RETRYABLE + (ModelUnavailableError,) as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = None
+                response = getattr(e, "response", None)
+                if response is not None:
+                    try:
+                        retry_after = float(response.headers.get("retry-after", ""))
+                    except ValueError:
+                        pass
+                # Full jitter, so paused workers don't all retry at the same instant
+                delay = retry_after or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"  {type(e).__name__}; backing off {delay:.1f}s", flush=True)
+                self.pause(delay)
+
+
+def reset_profile(user_id: str):
+    """Start the user over from an empty profile, keeping the generated plan and commitment."""
+    profile = load_profile(user_id)
+    fresh = copy.deepcopy(DEFAULT_PROFILE)
+    fresh.update({k: profile[k] for k in ("plan", "committed") if profile.get(k) is not None})
+    save_profile(user_id, fresh)
+
+
+# -- Online mode: one extraction call per chunk, chunks of a user in order --
+
+def backfill_user(user_id: str, checkpoint: Checkpoint, gate: RateGate, chunk_size: int, reset: bool):
+    state = checkpoint.user(user_id)
+    if state["done"]:
+        return
+    chunks = chunked(exchanges_from_turns(user_turns(user_id)), chunk_size)
+    start = state["chunks_done"]
+    if start == 0 and reset:
+        reset_profile(user_id)
+    for i in range(start, len(chunks)):
+        gate.call(lambda: assistant.extract_profile_updates_batch(user_id, chunks[i]))
+        flush_profiles(user_id)
+        checkpoint.update_user(user_id, chunks_done=i + 1, chunks=len(chunks))
+    checkpoint.update_user(user_id, done=True, chunks=len(chunks))
+    print(f"{user_id}: {len(chunks) - start} chunks", flush=True)
+
+
+def run_online(users: list[str], checkpoint: Checkpoint, gate: RateGate, concurrency: int,
+               chunk_size: int, reset: bool) -> int:
+    """Backfill users with bounded concurrency. Returns the number of users that failed."""
+    failed = []
+
+    def work(user_id: str):
+        try:
+            backfill_user(user_id, checkpoint, gate, chunk_size, reset)
+        except Exception as e:
+            failed.append(user_id)
+            checkpoint.update_user(user_id, error=str(e))
+            print(f"{user_id}: failed ({e})", flush=True)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(work, users))
+    return len(failed)
+
+
+# -- Batch mode: every chunk submitted at once against the profile as it stands --
+
+def submit_batches(users: list[str], checkpoint: Checkpoint, gate: RateGate, chunk_size: int, reset: bool):
+    pending_users = {chunk[0] for chunks in checkpoint.data["batches"].values() for chunk in chunks}
+    requests, chunks_meta = [], []
+
+    def submit():
+        if not chunks_meta:
+            return
+        batch = gate.call(lambda: assistant.client.messages.batches.create(requests=requests))
+        checkpoint.add_batch(batch.id, list(chunks_meta))
+        print(f"Submitted {batch.id} ({len(requests)} requests)", flush=True)
+        requests.clear()
+        chunks_meta.clear()
+
+    for user_id in users:
+        if user_id in pending_users or checkpoint.user(user_id)["done"]:
+            continue
+        if reset:
+            reset_profile(user_id)
+            flush_profiles(user_id)
+        chunks = chunked(exchanges_from_turns(user_turns(user_id)), chunk_size)
+        if not chunks:
+            checkpoint.update_user(user_id, done=True, chunks=0)
+        for i, chunk in enumerate(chunks):
+            local_updates, unresolved = assistant.resolve_locally(chunk)
+            custom_id = None
+            if unresolved:
+                custom_id = f"r{len(requests)}"
+                requests.append({"custom_id": custom_id, "params": {
+                    **route_params("extraction"),
+                    "messages": [{"role": "user", "content": assistant.build_extraction_prompt(user_id, unresolved)}],
+                }})
+            chunks_meta.append([user_id, i, custom_id, local_updates])
+        if len(requests) >= MAX_BATCH_REQUESTS:
+            submit()
+    submit()
+
+
+def collect_batches(checkpoint: Checkpoint, gate: RateGate, poll_interval: float) -> int:
+    """Wait for outstanding batches and apply their results. Returns the number of failed requests."""
+    failures = 0
+    for batch_id, chunks in list(checkpoint.data["batches"].items()):
+        while True:
+            batch = gate.call(lambda: assistant.client.messages.batches.retrieve(batch_id))
+            if batch.processing_status == "ended":
+                break
+            print(f"{batch_id}: {batch.request_counts.processing} requests processing", flush=True)
+            time.sleep(poll_interval)
+
+        results = {}
+        for entry in gate.call(lambda: list(assistant.client.messages.batches.results(batch_id))):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = entry.result.message.content[0].text
+
+        users = {}
+        for user_id, index, custom_id, local_updates in sorted(chunks, key=lambda c: (c[0], c[1])):
+            state = users.setdefault(user_id, {"done": True, "chunks": 0})
+            state["chunks"] += 1
+            if custom_id is not None:
+                if custom_id not in results:
+                    failures += 1
+                    state["done"] = False  # picked up again by the next run
+                    continue
+                assistant.apply_profile_updates(user_id, results[custom_id])
+            if local_updates:
+                assistant.merge_profile_updates(user_id, local_updates)
+        for state in users.values():
+            state["chunks_done"] = state["chunks"] if state["done"] else 0
+        flush_profiles()
+        checkpoint.finish_batch(batch_id, users)
+        print(f"{batch_id}: applied results for {len(users)} users", flush=True)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-run profile extraction over stored conversations")
+    parser.add_argument("--users", nargs="+", help="only these users (default: everyone)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="users processed at once")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_EXCHANGES, help="exchanges per extraction call")
+    parser.add_argument("--checkpoint", type=Path, default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start over")
+    parser.add_argument("--reset", action="store_true", help="rebuild profiles from empty instead of merging")
+    parser.add_argument("--batch", action="store_true", help="submit through the Message Batches API")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="seconds between batch status checks")
+    parser.add_argument("--max-retries", type=int, default=8)
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint, restart=args.restart)
+    gate = RateGate(max_retries=args.max_retries)
+    users = args.users or get_storage().list_users()
+
+    if args.batch:
+        submit_batches(users, checkpoint, gate, args.chunk_size, args.reset)
+        failures = collect_batches(checkpoint, gate, args.poll_interval)
+    else:
+        failures = run_online(users, checkpoint, gate, args.concurrency, args.chunk_size, args.reset)
+
+    checkpoint.close()
+    done = sum(1 for u in users if checkpoint.user(u)["done"])
+    print(f"Backfilled {done}/{len(users)} users; checkpoint in {args.checkpoint}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for Nori's per-turn local overhead.
+
+Times the storage, profile and prompt-building steps of a turn, and a full
+chat() turn against an in-process fake Anthropic client, across history sizes
+and profile sizes. Results are written as JSON so runs can be compared between
+commits:
+
+    python bench.py --output bench/before.json
+    python bench.py --output bench/after.json --compare bench/before.json
+
+Runs against a throwaway data directory; your data/ is never touched.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+DEFAULT_HISTORY_SIZES = [10, 100, 1_000, 10_000, 100_000]
+DEFAULT_NOTE_COUNTS = [0, 10, 100, 1_000, 5_000]
+
+
+def measure(fn, repeat: int, setup=None) -> dict:
+    """Run fn `repeat` times and summarize wall time in microseconds."""
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    samples.sort()
+    return {
+        "n": len(samples),
+        "mean_us": round(statistics.fmean(samples), 2),
+        "p50_us": round(samples[len(samples) // 2], 2),
+        "p95_us": round(samples[min(int(len(samples) * 0.95), len(samples) - 1)], 2),
+        "min_us": round(samples[0], 2),
+    }
+
+
+def seed_history(storage, user_id: str, turns: int):
+    """Write `turns` alternating turns for a user as quickly as the backend allows."""
+    records = [{
+        "role": "user" if i % 2 == 0 else "assistant",
+        "content": f"Turn {i}: I had oatmeal for breakfast and walked for twenty minutes.",
+        "timestamp": datetime.now().isoformat(),
+    } for i in range(turns)]
+    if hasattr(storage, "import_user"):
+        storage.import_user(user_id, records, None, {})
+    else:
+        for record in records:
+            storage.append_turn(user_id, record)
+
+
+def seed_profile(user_id: str, notes: int):
+    from user_profile import DEFAULT_PROFILE, save_profile, flush_profiles
+    import copy
+    profile = copy.deepcopy(DEFAULT_PROFILE)
+    profile.update({
+        "name": "Sam",
+        "height": "5'10\"",
+        "current_weight": "210 lbs",
+        "target_weight": "180 lbs",
+        "conditions": ["type 2 diabetes"],
+        "notes": [f"note {i}: prefers walking after dinner" for i in range(notes)],
+    })
+    save_profile(user_id, profile)
+    flush_profiles(user_id)
+
+
+def run(history_sizes: list[int], note_counts: list[int], repeat: int) -> list[dict]:
+    import assistant
+    import history
+    import memory
+    import user_profile
+    from fake_anthropic import FakeAnthropic
+    from storage import get_storage
+
+    storage = get_storage()
+    assistant.client = FakeAnthropic()
+    results = []
+
+    def record(name: str, size_name: str, size: int, stats: dict):
+        results.append({"name": name, size_name: size, **stats})
+        print(f"  {name:<32} {size_name}={size:<7} p50={stats['p50_us']:>10.1f}us  p95={stats['p95_us']:>10.1f}us",
+              flush=True)
+
+    print("History size:")
+    for size in history_sizes:
+        user_id = f"bench_history_{size}"
+        seed_history(storage, user_id, size)
+        record("save_conversation_turn", "history_turns", size,
+               measure(lambda: memory.save_conversation_turn(user_id, "user", "ok"), repeat))
+        record("get_recent_history", "history_turns", size,
+               measure(lambda: memory.get_recent_history(user_id), repeat))
+        record("get_history_window", "history_turns", size,
+               measure(lambda: history.get_history_window(user_id), repeat))
+
+        def turn():
+            assistant.chat(user_id, "I walked 30 minutes today")
+        record("chat", "history_turns", size,
+               measure(turn, max(repeat // 10, 5), setup=lambda: assistant.flush_profile_updates(user_id)))
+        assistant.flush_profile_updates(user_id)
+
+    print("Profile notes:")
+    for notes in note_counts:
+        user_id = f"bench_profile_{notes}"
+        seed_profile(user_id, notes)
+        cold = lambda: user_profile.profile_cache.invalidate(user_id)
+        record("load_profile", "profile_notes", notes, measure(lambda: user_profile.load_profile(user_id), repeat))
+        record("load_profile_cold", "profile_notes", notes,
+               measure(lambda: user_profile.load_profile(user_id), repeat, setup=cold))
+        record("format_profile_for_prompt", "profile_notes", notes,
+               measure(lambda: user_profile.format_profile_for_prompt(user_id), repeat))
+        record("format_profile_for_prompt_cold", "profile_notes", notes,
+               measure(lambda: user_profile.format_profile_for_prompt(user_id), repeat, setup=cold))
+        record("build_system_prompt", "profile_notes", notes,
+               measure(lambda: assistant.build_system_prompt(user_id), repeat))
+
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(current: list[dict], baseline_path: str, threshold: float):
+    """Print p50 ratios against a previous run and flag regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def key(r):
+        return (r["name"], r.get("history_turns"), r.get("profile_notes"))
+
+    before = {key(r): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('commit') or 'unknown commit'}):")
+    regressions = 0
+    for r in current:
+        old = before.get(key(r))
+        if not old or not old["p50_us"]:
+            continue
+        ratio = r["p50_us"] / old["p50_us"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        size = r.get("history_turns", r.get("profile_notes"))
+        print(f"  {r['name']:<32} {size:<7} {old['p50_us']:>10.1f} -> {r['p50_us']:>10.1f}us  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Nori's per-turn local overhead")
+    parser.add_argument("--history-sizes", type=int, nargs="+", default=DEFAULT_HISTORY_SIZES)
+    parser.add_argument("--note-counts", type=int, nargs="+", default=DEFAULT_NOTE_COUNTS)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="p50 ratio reported as a regression")
+    args = parser.parse_args()
+
+    # Point every module at a scratch data directory before they import config
+    data_root = tempfile.mkdtemp(prefix="nori-bench-")
+    os.environ["NORI_DATA_ROOT"] = data_root
+    os.environ["NORI_STORAGE_BACKEND"] = args.backend
+    os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+
+    results = run(args.history_sizes, args.note_counts, args.repeat)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,95 @@ load_dotenv(Path(__file__).parent / ".env", override=True)
 
 # Paths
 BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data" / "users"
+DATA_ROOT = Path(os.getenv("NORI_DATA_ROOT", BASE_DIR / "data"))
+DATA_DIR = DATA_ROOT / "users"  # sharded: users/ab/cd/<user_id> (see storage.UserDirs)
+USER_DIR_CACHE_SIZE = 100_000   # user directories remembered as existing, per process
 PROMPTS_DIR = BASE_DIR / "prompts"
 
 # API
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 MODEL = "claude-sonnet-4-20250514"
+MODEL_FAST = "claude-3-5-haiku-20241022"
+
+# Model and max_tokens per call site (see routing.py). Chat turns are routed by the
+# user's step: intake questions, the planning steps up to commitment, then coaching.
+# A "variant:route" key (e.g. "planner:chat_plan") overrides a route for one variant.
+MODEL_ROUTES = {
+    "chat_intake": {"model": MODEL_FAST, "max_tokens": 512},
+    "chat_plan": {"model": MODEL, "max_tokens": 2048},
+    "chat": {"model": MODEL, "max_tokens": 1024},
+    "extraction": {"model": MODEL_FAST, "max_tokens": 500},
+    "summary": {"model": MODEL_FAST, "max_tokens": 400},
+}
+
+# Shortest system prefix each model will cache, in tokens; a shorter cache_control block is ignored
+PROMPT_CACHE_MIN_TOKENS = {MODEL: 1024, MODEL_FAST: 2048}
+
+# Model calls (see resilience.py)
+MODEL_DEADLINES = {"chat": 60.0, "extraction": 30.0, "summary": 45.0}  # seconds per call, retries included
+MODEL_MAX_RETRIES = 2
+MODEL_RETRY_BASE_DELAY = 0.5    # seconds; doubled per attempt, full jitter
+MODEL_HEDGE_TASKS = ("chat",)   # tasks that may send a second request when the first is slow
+MODEL_HEDGE_PERCENTILE = 95     # hedge when the first token is later than this percentile of recent calls
+MODEL_HEDGE_MIN_DELAY = 1.0     # never hedge sooner than this many seconds
+MODEL_HEDGE_MIN_SAMPLES = 20    # calls observed before hedging starts
+BREAKER_WINDOW = 20             # recent attempts the circuit breaker looks at
+BREAKER_DEGRADE_RATE = 0.25     # failure rate at which extraction and summaries are paused
+BREAKER_OPEN_RATE = 0.5         # failure rate at which chat fails fast too
+BREAKER_COOLDOWN = 30.0         # seconds before a trial call is let through
+
+# Storage: "json" (one directory per user) or "sqlite" (shared WAL database)
+STORAGE_BACKEND = os.getenv("NORI_STORAGE_BACKEND", "json")
+SQLITE_PATH = DATA_ROOT / "nori.db"
+SQLITE_POOL_SIZE = 4  # connections kept open per process
+
+# Profile cache
+PROFILE_CACHE_SIZE = 1024      # profiles kept per process
+PROFILE_CACHE_POLICY = "lru"   # "lru" or "fifo"
+PROFILE_WRITE_DELAY = 0.25     # seconds to coalesce saves before writing; 0 writes through
+
+# Session state (variant, greeting flag, last activity) shared across workers
+SESSION_CACHE_SIZE = 4096  # sessions cached per process
+
+# Turns: each user's turns run one at a time; messages sent during a turn are answered together
+TURN_COALESCE_SECONDS = 0.0  # extra wait before a turn starts, so a double-tap lands in it too
+TURN_ASYNC_POLL_MAX = 0.05   # async turns poll a busy turn lock, backing off up to this many seconds
+
+# Idempotency-Key replay for retried /chat requests
+IDEMPOTENCY_TTL = 3600.0              # seconds a response is replayed for
+IDEMPOTENCY_CACHE_SIZE = 10_000       # responses kept per process
+IDEMPOTENCY_USER_KEYS = 20            # responses kept per user, shared across workers
+IDEMPOTENCY_RUNNING_TIMEOUT = 120.0   # retries wait this long for the first request before running again
+
+# Per-user limits, checked before a chat turn calls the model; 0 disables a limit
+CHAT_RATE_PER_MINUTE = float(os.getenv("NORI_CHAT_RATE_PER_MINUTE", "20"))  # sustained turns per user, per worker
+CHAT_BURST = 5                 # turns allowed back to back before the rate applies
+DAILY_TOKEN_QUOTA = int(os.getenv("NORI_DAILY_TOKEN_QUOTA", "500000"))  # tokens (all kinds) per user per UTC day
+RATE_LIMIT_USERS = 100_000     # users whose rate buckets are kept per process
+
+# Instrumentation: log a JSON trace of per-stage timings for every request
+TRACE_REQUESTS = os.getenv("NORI_TRACE_REQUESTS", "").lower() in ("1", "true", "yes")
+
+# Playbooks: send only the task steps and resources for the user's stage (see playbooks.py)
+PLAYBOOK_STAGES = os.getenv("NORI_PLAYBOOK_STAGES", "1").lower() in ("1", "true", "yes")
+PLAYBOOK_PLAN_TURNS = 6  # turns in the plan stage before the commitment steps are sent, even if no plan was extracted
 
 # Memory settings
 MAX_CONVERSATION_HISTORY = 20  # turns to keep in context
+HISTORY_TOKEN_BUDGET = 4000    # estimated tokens of verbatim history sent per turn
+HISTORY_MAX_TURNS = 100        # never send more turns than this, however short
+SUMMARY_FOLD_MIN_TURNS = 10    # fold evicted turns into the summary in batches of at least this many
+SUMMARY_FOLD_MAX_TURNS = 200   # cap on turns summarized in one fold
+ACTIVE_SEGMENT_MAX_TURNS = 1000  # archive already-summarized turns once the active conversation is longer
+
+# Recall: snippets from past turns and profile notes picked per message (see recall.py)
+RECALL_TOP_K = 5               # snippets added to the prompt
+RECALL_SNIPPET_CHARS = 300     # each snippet is cut to this length
+RECALL_CACHE_SIZE = 256        # per-user indexes kept per process
+PROFILE_PROMPT_NOTES = 10      # newest notes always in the profile block; older ones only via recall
+
+# Background profile extraction
+EXTRACTION_QUEUE_DIR = DATA_ROOT / "queue"
+EXTRACTION_WORKERS = 2
+EXTRACTION_COALESCE_SECONDS = 2.0  # wait this long for follow-up turns before extracting
+EXTRACTION_LOCAL_FIRST = True      # parse simple answers locally; only send the rest to the model
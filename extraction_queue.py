@@ -0,0 +1,273 @@
+"""
+Background profile extraction.
+
+Exchanges waiting for extraction are appended to a per-user JSONL file under
+the queue directory, so pending work survives a restart. A small pool of
+worker threads drains the queue. Turns that arrive for a user before their
+job starts are coalesced into the same file and handled by one extraction call.
+
+Several gunicorn workers share the queue directory, so appending to, claiming
+and requeueing a user's file all happen under an flock on `<user>.lock` there.
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+PENDING_SUFFIX = ".jsonl"
+PROCESSING_SUFFIX = ".processing"
+LOCK_SUFFIX = ".lock"
+
+logger = logging.getLogger(__name__)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ExtractionQueue:
+    """Durable, coalescing job queue drained by a pool of worker threads."""
+
+    def __init__(self, handler: Callable[[str, list[dict]], None], queue_dir: Path,
+                 workers: int = 2, coalesce_seconds: float = 0.0, retry_seconds: float = 30.0):
+        self.handler = handler
+        self.queue_dir = Path(queue_dir)
+        self.workers = workers
+        self.coalesce_seconds = coalesce_seconds
+        self.retry_seconds = retry_seconds
+
+        self._cond = threading.Condition()
+        self._due: dict[str, float] = {}   # user_id -> monotonic time the job may start
+        self._active: set[str] = set()
+        self._threads: list[threading.Thread] = []
+        self._stopping = False
+
+    # -- Producer side --
+
+    def submit(self, user_id: str, user_message: str, assistant_response: str,
+               previous_response: Optional[str] = None):
+        """Queue an exchange for extraction."""
+        self._ensure_started()
+        line = json.dumps({
+            "user_message": user_message,
+            "assistant_response": assistant_response,
+            "previous_response": previous_response,
+        }, ensure_ascii=False) + "\n"
+        # Never wait for the file lock while holding self._cond
+        with self._file_lock(user_id):
+            with open(self._pending_file(user_id), "a", encoding="utf-8") as f:
+                f.write(line)
+        with self._cond:
+            self._schedule(user_id, time.monotonic() + self.coalesce_seconds)
+
+    def depth(self) -> int:
+        """Number of users with queued or running jobs."""
+        with self._cond:
+            return len(self._due) + len(self._active)
+
+    def pending(self, user_id: Optional[str] = None) -> bool:
+        """Return True if there is queued or in-flight work."""
+        with self._cond:
+            return self._has_work(user_id)
+
+    def flush(self, user_id: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        """Run pending jobs now and wait for them. Returns False on timeout.
+
+        With a user_id, also waits for that user's jobs queued or running in
+        other processes, so whichever worker serves the next request sees them.
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        if not self._threads:
+            # Nothing was submitted in this process; drain leftovers inline
+            with self._cond:
+                self._recover()
+                users = [u for u in self._due if user_id is None or u == user_id]
+                for uid in users:
+                    del self._due[uid]
+            for uid in users:
+                self._attempt(uid)
+            return True if user_id is None else self._flush_on_disk(user_id, deadline)
+
+        with self._cond:
+            for uid in self._due:
+                if user_id is None or uid == user_id:
+                    self._due[uid] = 0.0
+            self._cond.notify_all()
+            # Jobs that fail during the flush are rescheduled for later; don't wait on them
+            while self._has_work(user_id, before=started):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True if user_id is None else self._flush_on_disk(user_id, deadline)
+
+    def _flush_on_disk(self, user_id: str, deadline: Optional[float], poll: float = 0.02) -> bool:
+        """Run the user's pending file here and wait out jobs other processes have claimed."""
+        while True:
+            if self._pending_file(user_id).exists() and not self._attempt(user_id):
+                return False
+            claimed = self._claimed_files(user_id)
+            for path in claimed:
+                pid = path.stem.rpartition(".")[2]
+                if not _pid_alive(int(pid)):
+                    with self._file_lock(user_id):
+                        if path.exists():
+                            self._requeue(user_id, path)
+            if not claimed and not self._pending_file(user_id).exists():
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """Stop the workers. Unfinished jobs stay on disk for the next start."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._stopping = False
+
+    # -- Worker side --
+
+    def _pending_file(self, user_id: str) -> Path:
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        return self.queue_dir / f"{user_id}{PENDING_SUFFIX}"
+
+    def _claimed_files(self, user_id: str) -> list[Path]:
+        """The user's jobs claimed by any process (`<user>.<pid>.processing`)."""
+        return [
+            path for path in self.queue_dir.glob(f"*{PROCESSING_SUFFIX}")
+            if path.stem.rpartition(".")[0] == user_id and path.stem.rpartition(".")[2].isdigit()
+        ]
+
+    @contextmanager
+    def _file_lock(self, user_id: str):
+        """Exclusive across threads and processes: each open() gets its own flock."""
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.queue_dir / f"{user_id}{LOCK_SUFFIX}", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _schedule(self, user_id: str, due: float):
+        # Caller holds self._cond
+        if user_id in self._active:
+            return  # picked up again when the active job finishes
+        self._due[user_id] = min(due, self._due.get(user_id, due))
+        self._cond.notify()
+
+    def _has_work(self, user_id: Optional[str], before: Optional[float] = None) -> bool:
+        due = {u for u, t in self._due.items() if before is None or t <= before}
+        if user_id is None:
+            return bool(due or self._active)
+        return user_id in due or user_id in self._active
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            self._recover()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"extraction-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.stop)
+
+    def _recover(self):
+        """Reschedule jobs left on disk by a previous or crashed process."""
+        if not self.queue_dir.exists():
+            return
+        for path in self.queue_dir.iterdir():
+            if path.suffix == PROCESSING_SUFFIX:
+                user_id, _, pid = path.stem.rpartition(".")
+                if pid.isdigit() and not _pid_alive(int(pid)):
+                    with self._file_lock(user_id):
+                        if path.exists():
+                            self._requeue(user_id, path)
+                    self._due.setdefault(user_id, 0.0)
+            elif path.suffix == PENDING_SUFFIX:
+                self._due.setdefault(path.stem, 0.0)
+
+    def _requeue(self, user_id: str, processing: Path):
+        """Put a claimed job back in front of the user's pending file. Caller holds the file lock."""
+        pending = self._pending_file(user_id)
+        data = processing.read_bytes()
+        if pending.exists():
+            data += pending.read_bytes()
+        tmp = pending.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(pending)
+        processing.unlink()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                user_id = None
+                while user_id is None:
+                    if self._stopping:
+                        return
+                    now = time.monotonic()
+                    ready = [u for u, due in self._due.items() if due <= now]
+                    if ready:
+                        user_id = min(ready, key=self._due.get)
+                        del self._due[user_id]
+                        self._active.add(user_id)
+                    else:
+                        wait = min(self._due.values(), default=now + 60) - now
+                        self._cond.wait(max(wait, 0.01))
+            delay = self.coalesce_seconds if self._attempt(user_id) else self.retry_seconds
+            with self._cond:
+                self._active.discard(user_id)
+                if self._pending_file(user_id).exists():
+                    self._schedule(user_id, time.monotonic() + delay)
+                self._cond.notify_all()
+
+    def _attempt(self, user_id: str) -> bool:
+        """Run one job, logging failures. Returns False if it must be retried."""
+        try:
+            self._run(user_id)
+            return True
+        except Exception:
+            logger.exception("Profile extraction failed for %s; will retry", user_id)
+            return False
+
+    def _run(self, user_id: str):
+        """Claim a user's pending exchanges and hand them to the handler."""
+        pending = self._pending_file(user_id)
+        processing = self.queue_dir / f"{user_id}.{os.getpid()}{PROCESSING_SUFFIX}"
+        with self._file_lock(user_id):
+            try:
+                pending.rename(processing)
+            except FileNotFoundError:
+                return  # claimed by another process
+
+        exchanges = []
+        for line in processing.read_text(encoding="utf-8").splitlines():
+            if line.strip():
+                exchanges.append(json.loads(line))
+
+        try:
+            if exchanges:
+                self.handler(user_id, exchanges)
+        except Exception:
+            with self._file_lock(user_id):
+                self._requeue(user_id, processing)
+            raise
+        processing.unlink()
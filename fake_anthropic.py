@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Local fake of the Anthropic Messages API for development and load testing.
+
+Serves POST /v1/messages (plain and streaming) with deterministic replies and
+configurable latency, so Nori can run end-to-end without calling the real API:
+
+    python fake_anthropic.py --port 8089 --ttft 0.4 --token-latency 0.02
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8089 ANTHROPIC_API_KEY=test python web.py
+
+Requests without a system prompt (profile extraction, summaries) get "null".
+Message Batches (create, retrieve, results) are supported too; a batch reports
+"ended" once --batch-delay seconds have passed. Faults can be injected to
+exercise timeouts, hedging and the circuit breaker:
+
+    python fake_anthropic.py --slow-rate 0.05 --slow-delay 8 --error-rate 0.1 --error-status 529
+
+FakeAnthropic is an in-process stand-in for anthropic.Anthropic with the same
+replies, for benchmarks and replays that should not touch the network.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from anthropic.types import Message
+from anthropic.types.messages import MessageBatch, MessageBatchIndividualResponse
+
+ERROR_TYPES = {429: "rate_limit_error", 500: "api_error", 503: "api_error", 529: "overloaded_error"}
+
+DEFAULT_REPLY = (
+    "Thanks, that helps.\n\n"
+    "Do you have a target date in mind?"
+)
+
+
+def _words(text: str) -> list[str]:
+    """Split text into word-sized pieces that rejoin to the original."""
+    pieces, current = [], ""
+    for ch in text:
+        current += ch
+        if ch in " \n":
+            pieces.append(current)
+            current = ""
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _prompt_tokens(body: dict) -> int:
+    """Rough input token count for the usage block."""
+    size = len(json.dumps(body.get("system", ""))) + len(json.dumps(body.get("messages", [])))
+    return size // 4
+
+
+def default_reply(body: dict, reply: str = DEFAULT_REPLY) -> str:
+    """Reply text for a request: `reply` for chat turns, "null" for system-less calls."""
+    if not body.get("system"):
+        return "null"
+    return reply
+
+
+def build_message(body: dict, reply: str) -> dict:
+    """Build a Messages API response body."""
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "fake"),
+        "content": [{"type": "text", "text": reply}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": _prompt_tokens(body),
+            "output_tokens": max(len(reply) // 4, 1),
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        },
+    }
+
+
+class FakeBatches:
+    """Message batches held in memory; results are computed when the batch is created."""
+
+    def __init__(self, reply_for, delay: float = 0.0):
+        self.reply_for = reply_for
+        self.delay = delay
+        self._batches: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def create(self, requests: list[dict]) -> dict:
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        results = [{
+            "custom_id": r["custom_id"],
+            "result": {"type": "succeeded", "message": build_message(r["params"], self.reply_for(r["params"]))},
+        } for r in requests]
+        with self._lock:
+            self._batches[batch_id] = {"created": datetime.now(timezone.utc), "results": results}
+        return self.describe(batch_id)
+
+    def describe(self, batch_id: str, results_url: str = "") -> Optional[dict]:
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        created = batch["created"]
+        ended = datetime.now(timezone.utc) >= created + timedelta(seconds=self.delay)
+        count = len(batch["results"])
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": created.isoformat(),
+            "expires_at": (created + timedelta(days=1)).isoformat(),
+            "ended_at": (created + timedelta(seconds=self.delay)).isoformat() if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{results_url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def results(self, batch_id: str) -> list[dict]:
+        with self._lock:
+            return list(self._batches[batch_id]["results"])
+
+
+class FakeMessagesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeMessagesServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int):
+        error_type = ERROR_TYPES.get(status, "api_error")
+        data = json.dumps({"type": "error", "error": {"type": error_type, "message": "Injected fault"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("retry-after", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) not in (4, 5):
+            self._not_found()
+            return
+        batch = self.server.batches.describe(parts[3], self.server.base_url)
+        if batch is None or (len(parts) == 5 and (parts[4] != "results" or batch["processing_status"] != "ended")):
+            self._not_found()
+            return
+        if len(parts) == 4:
+            self._send_json(200, batch)
+            return
+        data = "".join(json.dumps(r) + "\n" for r in self.server.batches.results(parts[3])).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        path = self.path.split("?")[0]
+        if path == "/v1/messages/batches":
+            self.server.record_request()
+            self._send_json(200, self.server.batches.create(body.get("requests", [])))
+            return
+        if path != "/v1/messages":
+            self._not_found()
+            return
+
+        self.server.record_request()
+        fault = self.server.pick_fault()
+        if fault == "error":
+            self._send_error(self.server.error_status)
+            return
+        reply = self.server.reply_for(body)
+        message = build_message(body, reply)
+        usage = message["usage"]
+
+        time.sleep(self.server.ttft + (self.server.slow_delay if fault == "slow" else 0.0))
+        if not body.get("stream"):
+            time.sleep(self.server.token_latency * len(_words(reply)))
+            self._send_json(200, message)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(name: str, data: dict):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        start = dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=0))
+        event("message_start", {"type": "message_start", "message": start})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        for i, piece in enumerate(_words(reply)):
+            if i:
+                time.sleep(self.server.token_latency)
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": piece}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": usage["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+
+
+class FakeMessagesServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the fake's settings and counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address, ttft: float = 0.0, token_latency: float = 0.0,
+                 reply: str = DEFAULT_REPLY, batch_delay: float = 0.0, slow_rate: float = 0.0,
+                 slow_delay: float = 0.0, error_rate: float = 0.0, error_status: int = 529,
+                 seed: Optional[int] = None, verbose: bool = False):
+        super().__init__(address, FakeMessagesHandler)
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.faults = {"slow": 0, "error": 0}
+        self._random = random.Random(seed)
+        self.reply = reply
+        self.verbose = verbose
+        self.requests = 0
+        self.batches = FakeBatches(self.reply_for, batch_delay)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def reply_for(self, body: dict) -> str:
+        return default_reply(body, self.reply)
+
+    def pick_fault(self) -> Optional[str]:
+        """Decide whether this request fails ("error"), stalls ("slow") or is served normally."""
+        with self._lock:
+            roll = self._random.random()
+            fault = "error" if roll < self.error_rate else "slow" if roll < self.error_rate + self.slow_rate else None
+            if fault:
+                self.faults[fault] += 1
+            return fault
+
+
+class _FakeStream:
+    def __init__(self, message: Message, token_latency: float):
+        self._message = message
+        self._token_latency = token_latency
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        for i, piece in enumerate(_words(self._message.content[0].text)):
+            if i and self._token_latency:
+                time.sleep(self._token_latency)
+            yield piece
+
+    def get_final_message(self) -> Message:
+        return self._message
+
+
+class _FakeMessageBatches:
+    def __init__(self, owner: "FakeAnthropic"):
+        self._owner = owner
+        self._batches = FakeBatches(self._reply, owner.batch_delay)
+
+    def _reply(self, params: dict) -> str:
+        self._owner.calls.append(params)
+        return self._owner.responder(params)
+
+    def create(self, requests: list[dict], **kwargs) -> MessageBatch:
+        return MessageBatch.model_validate(self._batches.create(list(requests)))
+
+    def retrieve(self, message_batch_id: str, **kwargs) -> MessageBatch:
+        return MessageBatch.model_validate(self._batches.describe(message_batch_id, "fake://"))
+
+    def results(self, message_batch_id: str, **kwargs):
+        for result in self._batches.results(message_batch_id):
+            yield MessageBatchIndividualResponse.model_validate(result)
+
+
+class _FakeMessages:
+    def __init__(self, owner: "FakeAnthropic"):
+        self._owner = owner
+        self.batches = _FakeMessageBatches(owner)
+
+    def _message(self, kwargs: dict) -> Message:
+        kwargs.pop("timeout", None)
+        self._owner.calls.append(kwargs)
+        if self._owner.ttft:
+            time.sleep(self._owner.ttft)
+        reply = self._owner.responder(kwargs)
+        return Message.model_validate(build_message(kwargs, reply))
+
+    def create(self, **kwargs) -> Message:
+        message = self._message(kwargs)
+        if self._owner.token_latency:
+            time.sleep(self._owner.token_latency * len(_words(message.content[0].text)))
+        return message
+
+    def stream(self, **kwargs) -> _FakeStream:
+        return _FakeStream(self._message(kwargs), self._owner.token_latency)
+
+
+class FakeAnthropic:
+    """In-process stand-in for anthropic.Anthropic (messages.create, .stream and .batches).
+
+    `responder(request_kwargs) -> str` chooses the reply text; the default
+    mirrors the fake server. Every request is appended to `calls`.
+    """
+
+    def __init__(self, responder=None, ttft: float = 0.0, token_latency: float = 0.0,
+                 batch_delay: float = 0.0):
+        self.responder = responder or default_reply
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.batch_delay = batch_delay
+        self.calls: list[dict] = []
+        self.messages = _FakeMessages(self)
+
+
+def start_server(port: int = 0, **settings) -> FakeMessagesServer:
+    """Start a fake server on a background thread and return it."""
+    server = FakeMessagesServer(("127.0.0.1", port), **settings)
+    threading.Thread(target=server.serve_forever, name="fake-anthropic", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Anthropic Messages API")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--ttft", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="seconds before a message batch ends")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests delayed by --slow-delay")
+    parser.add_argument("--slow-delay", type=float, default=0.0, help="extra seconds before the first token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=529, help="HTTP status of injected failures")
+    parser.add_argument("--seed", type=int, help="seed for fault injection")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = FakeMessagesServer(("127.0.0.1", args.port), ttft=args.ttft, token_latency=args.token_latency,
+                                batch_delay=args.batch_delay, slow_rate=args.slow_rate, slow_delay=args.slow_delay,
+                                error_rate=args.error_rate, error_status=args.error_status, seed=args.seed,
+                                verbose=args.verbose)
+    print(f"Fake Messages API on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Token-budgeted conversation history with a rolling summary.
+
+The newest turns are sent verbatim until the token budget is spent. Turns that
+fall out of that window are folded, in batches, into a running summary stored
+by the storage backend, so the per-turn input size stays bounded no
+matter how long the conversation gets. Once the log itself grows long, the
+turns already summarized are moved to a compressed archive segment.
+"""
+
+from typing import Callable, Optional
+from config import (
+    ACTIVE_SEGMENT_MAX_TURNS, HISTORY_TOKEN_BUDGET, HISTORY_MAX_TURNS,
+    SUMMARY_FOLD_MIN_TURNS, SUMMARY_FOLD_MAX_TURNS,
+)
+from metrics import span
+from storage import get_storage
+from tokens import estimate_message_tokens
+
+
+def select_window(turns: list[dict], token_budget: int) -> list[dict]:
+    """Pick the newest turns that fit in the budget (always at least the last one)."""
+    window = []
+    used = 0
+    for turn in reversed(turns):
+        cost = estimate_message_tokens(turn)
+        if window and used + cost > token_budget:
+            break
+        window.append(turn)
+        used += cost
+    window.reverse()
+
+    # The API expects the conversation to open with a user turn
+    while len(window) > 1 and window[0]["role"] != "user":
+        window.pop(0)
+    return window
+
+
+def get_history_window(user_id: str, token_budget: int = None) -> list[dict]:
+    """Get the budgeted recent history formatted for Claude API."""
+    token_budget = token_budget or HISTORY_TOKEN_BUDGET
+    with span("history_load"):
+        recent = get_storage().recent_turns(user_id, HISTORY_MAX_TURNS)
+    return [{"role": c["role"], "content": c["content"]} for c in select_window(recent, token_budget)]
+
+
+def load_summary(user_id: str) -> dict:
+    """Load the rolling summary: {"text": str, "covered": turns folded so far}."""
+    return get_storage().load_summary(user_id) or {"text": "", "covered": 0}
+
+
+def save_summary(user_id: str, summary: dict):
+    get_storage().save_summary(user_id, summary)
+
+
+def refresh_summary(user_id: str, summarize: Callable[[str, list[dict]], str],
+                    token_budget: int = None) -> Optional[dict]:
+    """Fold turns that have left the history window into the rolling summary.
+
+    `summarize(previous_summary, turns)` returns the updated summary text. It is
+    only called once at least SUMMARY_FOLD_MIN_TURNS turns are waiting, so the
+    summary is updated incrementally in batches rather than regenerated per turn.
+    """
+    token_budget = token_budget or HISTORY_TOKEN_BUDGET
+    storage = get_storage()
+    total = storage.count_turns(user_id)
+    window = select_window(storage.recent_turns(user_id, HISTORY_MAX_TURNS), token_budget)
+    window_start = total - len(window)
+
+    summary = load_summary(user_id)
+    if summary["covered"] > total:
+        # History was cleared since the last fold
+        summary = {"text": "", "covered": 0}
+
+    if window_start - summary["covered"] < SUMMARY_FOLD_MIN_TURNS:
+        return None
+
+    # Very long backlogs (e.g. migrated users) only fold their most recent part
+    start = max(summary["covered"], window_start - SUMMARY_FOLD_MAX_TURNS)
+    turns = storage.turns_range(user_id, start, window_start)
+    summary = {"text": summarize(summary["text"], turns), "covered": window_start}
+    save_summary(user_id, summary)
+    return summary
+
+
+def archive_summarized_turns(user_id: str) -> Optional[dict]:
+    """Move turns already folded into the summary out of the active conversation.
+
+    Only runs once the active conversation is longer than ACTIVE_SEGMENT_MAX_TURNS,
+    so the hot path keeps reading a bounded log. Returns the archived segment.
+    """
+    storage = get_storage()
+    summary = load_summary(user_id)
+    if not summary["covered"] or storage.count_turns(user_id) <= ACTIVE_SEGMENT_MAX_TURNS:
+        return None
+    entry = storage.archive_turns(user_id, summary["covered"], reason="summarized")
+    if entry:
+        save_summary(user_id, {"text": summary["text"], "covered": summary["covered"] - entry["turns"]})
+    return entry
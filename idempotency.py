@@ -0,0 +1,146 @@
+"""
+Replay of chat responses for retried requests.
+
+A client that sends an Idempotency-Key header gets the same response back for
+every retry with that key, without a second model call or duplicate turns.
+Responses are kept in a bounded per-process LRU with a TTL, and in a small
+per-user file (replies.json) so a retry that lands on another gunicorn worker
+is answered too. While the first request is still running, the file marks the
+key as running and retries wait for its result instead of starting their own;
+abegin() does that waiting on the event loop for the ASGI app.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from memory import get_user_dir
+from turns import user_locks
+
+REPLIES_FILE = "replies.json"
+
+
+class ReplyCache:
+    """Responses by (user, idempotency key), bounded and expired after ttl seconds."""
+
+    def __init__(self, ttl: float, max_size: int, user_keys: int, running_timeout: float, poll: float = 0.05):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.user_keys = user_keys              # keys kept in each user's replies file
+        self.running_timeout = running_timeout  # a running mark older than this is abandoned
+        self.poll = poll
+        self._entries: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()  # key -> (stored at, response)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "waits": 0, "expired": 0, "evictions": 0}
+
+    def begin(self, user_id: str, key: str) -> Optional[dict]:
+        """Return the stored response for the key, or None after claiming it for this request.
+
+        A claimed key must be passed to finish(), with the response or None on failure.
+        """
+        waited = False
+        while True:
+            settled, response = self._try_begin(user_id, key)
+            if settled:
+                return response
+            if not waited:
+                waited = True
+                self._count_wait()
+            time.sleep(self.poll)
+
+    async def abegin(self, user_id: str, key: str) -> Optional[dict]:
+        """begin() for coroutines: waits for a running request without holding a thread."""
+        waited = False
+        while True:
+            settled, response = await asyncio.to_thread(self._try_begin, user_id, key)
+            if settled:
+                return response
+            if not waited:
+                waited = True
+                self._count_wait()
+            await asyncio.sleep(self.poll)
+
+    def _try_begin(self, user_id: str, key: str) -> tuple[bool, Optional[dict]]:
+        """One attempt at begin(): (True, response or None once claimed), or (False, None) while it runs elsewhere."""
+        response = self._get(user_id, key)
+        if response is not None:
+            return True, response
+
+        with user_locks.hold(user_id, "replies"):
+            replies = self._load(user_id)
+            entry = replies.get(key)
+            if entry and "response" in entry:
+                with self._lock:
+                    self.stats["shared_hits"] += 1
+                self._put(user_id, key, entry["response"], entry["at"])
+                return True, entry["response"]
+            if not entry:  # unseen, or its running mark was abandoned
+                replies[key] = {"at": time.time()}
+                self._save(user_id, replies)
+                with self._lock:
+                    self.stats["misses"] += 1
+                return True, None
+        return False, None
+
+    def _count_wait(self):
+        with self._lock:
+            self.stats["waits"] += 1
+
+    def finish(self, user_id: str, key: str, response: Optional[dict]):
+        """Store the response for a claimed key, or release the claim so a retry runs again."""
+        with user_locks.hold(user_id, "replies"):
+            replies = self._load(user_id)
+            if response is None:
+                replies.pop(key, None)
+            else:
+                replies[key] = {"at": time.time(), "response": response}
+            self._save(user_id, replies)
+        if response is not None:
+            self._put(user_id, key, response, time.time())
+
+    def _get(self, user_id: str, key: str) -> Optional[dict]:
+        with self._lock:
+            item = self._entries.get((user_id, key))
+            if item is None:
+                return None
+            if time.time() - item[0] > self.ttl:
+                del self._entries[(user_id, key)]
+                self.stats["expired"] += 1
+                return None
+            self._entries.move_to_end((user_id, key))
+            self.stats["hits"] += 1
+            return item[1]
+
+    def _put(self, user_id: str, key: str, response: dict, stored_at: float):
+        with self._lock:
+            self._entries[(user_id, key)] = (stored_at, response)
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _load(self, user_id: str) -> dict:
+        # Caller holds the user's replies lock
+        try:
+            replies = json.loads((get_user_dir(user_id) / REPLIES_FILE).read_text())
+        except FileNotFoundError:
+            return {}
+        now = time.time()
+        return {
+            k: v for k, v in replies.items()
+            if now - v["at"] <= (self.ttl if "response" in v else self.running_timeout)
+        }
+
+    def _save(self, user_id: str, replies: dict):
+        # Caller holds the user's replies lock; keep the newest keys
+        newest = sorted(replies.items(), key=lambda item: item[1]["at"])[-self.user_keys:]
+        path = get_user_dir(user_id) / REPLIES_FILE
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(dict(newest), ensure_ascii=False))
+        tmp.replace(path)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+End-to-end load generator for the web app.
+
+Simulated users each pick a variant, chat with a think time between messages,
+and now and then send /profile or /new. Every user has their own id (sent as
+X-User-Id), so conversations run in parallel the way real traffic would:
+
+    python loadgen.py --spawn --users 50 --duration 60 --ttft 0.4 --token-latency 0.02
+    python loadgen.py --url http://127.0.0.1:5001 --users 200 --think-time 2
+
+--spawn starts the fake Messages API and the app (`python web.py` unless
+--server-cmd says otherwise) against a scratch data directory. Afterwards the
+stored conversations are checked against what each user sent, so lost,
+duplicated or reordered turns show up as integrity errors. Without --spawn the
+check reads the data directory from config, so run it on the same box or pass
+--no-verify.
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+BASE_DIR = Path(__file__).parent
+MESSAGES = [
+    "I walked for 20 minutes after dinner today.",
+    "What should I eat for breakfast this week?",
+    "I had a rough day and ate a lot of snacks.",
+    "How many steps should I aim for?",
+    "I weigh 210 lbs",
+    "ok",
+]
+COMMANDS = ["/profile", "/new"]
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """q-th percentile of already sorted samples."""
+    if not samples:
+        return 0.0
+    return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+
+class Stats:
+    """Latencies and outcomes per route, shared by all simulated users."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.first_message: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, route: str, outcome: str, seconds: float, first: Optional[float] = None):
+        with self._lock:
+            self.outcomes[route][outcome] += 1
+            if outcome == "ok":
+                self.latencies[route].append(seconds)
+                if first is not None:
+                    self.first_message[route].append(first)
+
+    def summary(self, elapsed: float) -> dict:
+        routes = {}
+        for route in sorted(self.outcomes):
+            samples = sorted(self.latencies[route])
+            total = sum(self.outcomes[route].values())
+            routes[route] = {
+                "requests": total,
+                "rps": round(total / elapsed, 2),
+                "error_rate": round(1 - self.outcomes[route]["ok"] / total, 4),
+                "outcomes": dict(self.outcomes[route]),
+                **{f"p{q}_ms": round(percentile(samples, q) * 1000, 1) for q in (50, 90, 99)},
+            }
+            if self.first_message[route]:
+                first = sorted(self.first_message[route])
+                routes[route].update({f"first_message_p{q}_ms": round(percentile(first, q) * 1000, 1)
+                                      for q in (50, 90, 99)})
+        return routes
+
+
+class SimulatedUser:
+    """One user's session: pick a variant, then chat until the deadline."""
+
+    def __init__(self, user_id: str, args, stats: Stats, deadline: float):
+        self.user_id = user_id
+        self.args = args
+        self.stats = stats
+        self.deadline = deadline
+        self.rng = random.Random(f"{args.seed}:{user_id}")
+        self.sent = 0
+        # User messages the server should have stored since the last /new; None once unknown
+        self.expected: Optional[list[str]] = []
+        # Messages whose request failed; the app keeps the user turn without a reply
+        self.failed: set[str] = set()
+
+    def request(self, route: str, path: str, payload: Optional[dict] = None, stream: bool = False):
+        """Send one request. Returns the parsed reply, or None on failure."""
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        req = urllib.request.Request(self.args.url + path, data=data, headers={
+            "Content-Type": "application/json",
+            "X-User-Id": self.user_id,
+        })
+        started = time.perf_counter()
+        first = None
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as response:
+                if not stream:
+                    reply = json.loads(response.read())
+                else:
+                    reply, event = {"messages": []}, None
+                    for raw in response:
+                        line = raw.decode("utf-8").rstrip("\n")
+                        if line.startswith("event: "):
+                            event = line[7:]
+                        elif line.startswith("data: ") and event == "message":
+                            first = first or time.perf_counter() - started
+                            reply["messages"].append(json.loads(line[6:])["text"])
+                        elif line.startswith("data: ") and event == "error":
+                            self.stats.record(route, "stream_error", time.perf_counter() - started)
+                            return None
+        except urllib.error.HTTPError as e:
+            self.stats.record(route, f"http_{e.code}", time.perf_counter() - started)
+            return None
+        except (OSError, ValueError) as e:
+            self.stats.record(route, type(e).__name__, time.perf_counter() - started)
+            return None
+        self.stats.record(route, "ok", time.perf_counter() - started, first)
+        return reply
+
+    def think(self):
+        if self.args.think_time > 0:
+            time.sleep(min(self.rng.expovariate(1 / self.args.think_time),
+                           max(self.deadline - time.monotonic(), 0)))
+
+    def set_variant(self, variants: list[str]) -> bool:
+        if self.request("/set-variant", "/set-variant", {"variant": self.rng.choice(variants)}) is None:
+            self.expected = None
+            return False
+        self.expected, self.failed = [], set()
+        return True
+
+    def chat(self):
+        self.sent += 1
+        message = f"[{self.user_id} #{self.sent}] {self.rng.choice(MESSAGES)}"
+        stream = self.rng.random() < self.args.stream_ratio
+        route = "/chat/stream" if stream else "/chat"
+        started = time.monotonic()
+        reply = self.request(route, route, {"message": message}, stream=stream)
+        if reply is not None:
+            if self.expected is not None:
+                self.expected.append(message)
+        elif time.monotonic() - started >= self.args.timeout:
+            # A timed-out turn may still have been answered and stored
+            self.expected = None
+        else:
+            self.failed.add(message)
+
+    def command(self):
+        command = self.rng.choice(COMMANDS)
+        reply = self.request(f"/chat {command}", "/chat", {"message": command})
+        if command == "/new":
+            self.expected, self.failed = ([] if reply is not None else None), set()
+
+    def run(self, variants: list[str]):
+        self.set_variant(variants)
+        while time.monotonic() < self.deadline:
+            roll = self.rng.random()
+            if roll < self.args.command_ratio:
+                self.command()
+            elif roll < self.args.command_ratio + self.args.variant_ratio:
+                self.set_variant(variants)
+            else:
+                self.chat()
+            self.think()
+
+
+def verify(users: list[SimulatedUser]) -> dict:
+    """Compare each user's stored conversation with the messages the server accepted."""
+    # Imported here so NORI_DATA_ROOT from --spawn is in place before config loads
+    from storage import get_storage
+
+    storage = get_storage()
+    report = Counter()
+    for user in users:
+        if user.expected is None:
+            report["users_skipped"] += 1
+            continue
+        turns = []
+        # Turns archived after being summarized still belong to the current conversation
+        for entry in reversed(storage.list_archives(user.user_id)):
+            if entry["reason"] != "summarized":
+                break
+            turns = storage.load_archive(user.user_id, entry["id"]) + turns
+        turns += storage.load_turns(user.user_id)
+
+        stored = [t["content"] for t in turns if t["role"] == "user"]
+        # Messages coalesced into one turn share the reply that follows them
+        answered, waiting = set(), []
+        for turn in turns:
+            if turn["role"] == "user":
+                waiting.append(turn["content"])
+            else:
+                answered.update(waiting)
+                waiting = []
+        unanswered = set(stored) - answered
+        report["users_checked"] += 1
+        report["turns_expected"] += len(user.expected)
+        report["turns_lost"] += len(set(user.expected) - set(stored))
+        report["turns_unexpected"] += len(set(stored) - set(user.expected) - user.failed)
+        report["turns_duplicated"] += len(stored) - len(set(stored))
+        report["turns_unanswered"] += len(unanswered & user.failed)  # failed requests; expected, not an error
+        report["replies_missing"] += len(unanswered - user.failed)
+        if [m for m in stored if m in user.expected] != [m for m in user.expected if m in stored]:
+            report["users_out_of_order"] += 1
+    return dict(report)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except urllib.error.HTTPError:
+            return  # up, just not a route that answers 200
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+            time.sleep(0.2)
+
+
+def spawn(args) -> list[subprocess.Popen]:
+    """Start the fake Messages API and the app against a scratch data directory."""
+    data_root = tempfile.mkdtemp(prefix="nori-loadgen-")
+    os.environ["NORI_DATA_ROOT"] = data_root
+    fake_port, app_port = free_port(), free_port()
+    fake = subprocess.Popen(
+        [sys.executable, "fake_anthropic.py", "--port", str(fake_port), "--ttft", str(args.ttft),
+         "--token-latency", str(args.token_latency), "--error-rate", str(args.error_rate)],
+        cwd=BASE_DIR, stdout=subprocess.DEVNULL,
+    )
+    env = dict(os.environ, ANTHROPIC_BASE_URL=f"http://127.0.0.1:{fake_port}",
+               ANTHROPIC_API_KEY=os.environ.get("ANTHROPIC_API_KEY") or "loadgen", PORT=str(app_port))
+    if not args.limits:
+        # Simulated users chat far faster than the per-user limits allow
+        env.update(NORI_CHAT_RATE_PER_MINUTE="0", NORI_DAILY_TOKEN_QUOTA="0")
+    server = subprocess.Popen(shlex.split(args.server_cmd.format(port=app_port)), cwd=BASE_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    args.url = f"http://127.0.0.1:{app_port}"
+    wait_until_ready(f"http://127.0.0.1:{fake_port}/v1/messages/batches/none")
+    wait_until_ready(args.url + "/get-variant")
+    print(f"Spawned fake API on :{fake_port} and app on :{app_port}; data in {data_root}", flush=True)
+    return [server, fake]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive concurrent simulated users against the web app")
+    parser.add_argument("--url", default="http://127.0.0.1:5001")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load after ramp-up starts")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which users join")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between a user's requests")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="fraction of chats sent to /chat/stream")
+    parser.add_argument("--command-ratio", type=float, default=0.05, help="fraction of requests that are /profile or /new")
+    parser.add_argument("--variant-ratio", type=float, default=0.02, help="fraction of requests that switch variant")
+    parser.add_argument("--timeout", type=float, default=60.0, help="client timeout per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix", default=f"load{os.getpid()}", help="user id prefix")
+    parser.add_argument("--spawn", action="store_true", help="start the fake API and the app for this run")
+    parser.add_argument("--server-cmd", default=f"{sys.executable} web.py",
+                        help="app command for --spawn; {port} is replaced with the port to bind")
+    parser.add_argument("--ttft", type=float, default=0.3, help="fake API seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="fake API seconds between tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake API fraction of failed calls")
+    parser.add_argument("--limits", action="store_true", help="keep the per-user rate limit and quota when spawning")
+    parser.add_argument("--no-verify", action="store_true", help="skip the stored-conversation check")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--verbose", action="store_true", help="show the spawned app's log")
+    args = parser.parse_args()
+
+    processes = spawn(args) if args.spawn else []
+    try:
+        with urllib.request.urlopen(args.url + "/get-variant", timeout=10) as response:
+            variants = list(json.loads(response.read())["variants"])
+
+        stats = Stats()
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [SimulatedUser(f"{args.prefix}-{i}", args, stats, deadline) for i in range(args.users)]
+        threads = []
+        for i, user in enumerate(users):
+            time.sleep(args.ramp / args.users if i else 0)
+            thread = threading.Thread(target=user.run, args=(variants,), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    routes = stats.summary(elapsed)
+    print(f"\n{args.users} users, {elapsed:.1f}s, think time {args.think_time}s")
+    for route, r in routes.items():
+        line = (f"  {route:<16} {r['requests']:>6} req  {r['rps']:>7.2f}/s  p50={r['p50_ms']:>8.1f}ms  "
+                f"p90={r['p90_ms']:>8.1f}ms  p99={r['p99_ms']:>8.1f}ms  errors={r['error_rate']:.1%}")
+        if "first_message_p50_ms" in r:
+            line += f"  first bubble p50={r['first_message_p50_ms']:.1f}ms"
+        print(line)
+        failures = {k: v for k, v in r["outcomes"].items() if k != "ok"}
+        if failures:
+            print(f"  {'':<16} {failures}")
+
+    integrity = None if args.no_verify else verify(users)
+    if integrity is not None:
+        print(f"Integrity: {integrity}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {"timestamp": datetime.now().isoformat(), **{k: v for k, v in vars(args).items()}},
+                "elapsed": round(elapsed, 2),
+                "routes": routes,
+                "integrity": integrity,
+            }, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    problems = integrity and sum(integrity.get(k, 0) for k in (
+        "turns_lost", "turns_unexpected", "turns_duplicated", "replies_missing", "users_out_of_order"))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
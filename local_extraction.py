@@ -0,0 +1,202 @@
+"""
+Deterministic profile extraction that runs before the model.
+
+Many turns are short answers: "ok", "210 lbs", "5'10", "by June", "yes" to
+"Are you ready to start this tomorrow?". Those are parsed here and applied
+directly. An exchange counts as resolved only if every word of the user's
+message is accounted for by a parser or is filler; anything else (negations,
+relatives, free text, bare numbers) goes to the model as before. So does an
+acknowledgement of a reply with a plan, numbers or strategies in it, since
+"sounds good" there can confirm something worth saving.
+"""
+
+import re
+from typing import Optional
+
+MONTHS = ("january|february|march|april|may|june|july|august|september|october|"
+          "november|december|jan|feb|mar|apr|jun|jul|aug|sep|sept|oct|nov|dec")
+NUMBER_WORDS = "one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|a"
+
+WEIGHT = re.compile(r"\b(\d{2,3}(?:\.\d)?)\s*(lbs?|pounds?|kgs?|kilos?|kilograms?)\b")
+HEIGHT_IMPERIAL = re.compile(r"\b([4-7])\s*(?:'|ft\b|feet\b|foot\b)\s*(?:(\d{1,2})\s*(?:\"|''|in\b|inches\b)?)?")
+HEIGHT_METRIC = re.compile(r"\b(1[3-9]\d|2[0-2]\d)\s*(?:cm|centimeters?|centimetres?)\b")
+TARGET_DATE = re.compile(
+    r"\b(by|before|within|in)\s+(?:the\s+)?((?:end\s+of\s+(?:the\s+)?)?"
+    rf"(?:(?:{MONTHS})(?:\s+\d{{4}})?|(?:\d{{1,2}}|{NUMBER_WORDS})\s+(?:weeks?|months?|years?)"
+    r"|summer|spring|fall|autumn|winter|christmas|next\s+year|(?:the\s+)?year))\b"
+)
+
+CONDITIONS = [
+    (re.compile(r"\btype\s*(?:2|ii|two)\s+diabet(?:es|ic)\b|\bt2d\b"), "type 2 diabetes"),
+    (re.compile(r"\btype\s*(?:1|i|one)\s+diabet(?:es|ic)\b|\bt1d\b"), "type 1 diabetes"),
+    (re.compile(r"\bpre-?diabet(?:es|ic)\b"), "prediabetes"),
+    (re.compile(r"\bdiabet(?:es|ic)\b"), "diabetes"),
+    (re.compile(r"\bhigh blood pressure\b|\bhypertension\b"), "high blood pressure"),
+    (re.compile(r"\bhigh cholesterol\b"), "high cholesterol"),
+    (re.compile(r"\bsleep apn(?:o)?ea\b"), "sleep apnea"),
+    (re.compile(r"\bpcos\b|\bpolycystic ovary syndrome\b"), "PCOS"),
+    (re.compile(r"\bhypothyroid(?:ism)?\b|\bunderactive thyroid\b"), "hypothyroidism"),
+    (re.compile(r"\b(?:osteo)?arthritis\b"), "arthritis"),
+    (re.compile(r"\bbad knees?\b"), "bad knees"),
+    (re.compile(r"\bbad back\b|\bback pain\b"), "back pain"),
+    (re.compile(r"\basthma\b"), "asthma"),
+    (re.compile(r"\bgerd\b|\bacid reflux\b"), "acid reflux"),
+    (re.compile(r"\bfatty liver(?: disease)?\b"), "fatty liver disease"),
+    (re.compile(r"\bheart disease\b"), "heart disease"),
+]
+
+# Cues in the words just before a weight
+TARGET_CUE = re.compile(r"\b(goal|target|get(?: down)? to|down to|reach|hit|be at|want|like to|aim(?:ing)?|hoping)\b")
+CHANGE_CUE = re.compile(r"\b(lose|lost|losing|drop|dropped|shed|gain|gained|put on)\b")
+CURRENT_CUE = re.compile(r"\b(weigh|i'm|im|i am|currently|now|at the moment|right now|today)\b")
+NEGATION = re.compile(r"\b(no|not|never|without|don't|dont|doesn't|didn't|used to|n't)\b")
+
+# What the assistant asked just before the message
+COMMIT_QUESTION = re.compile(r"ready to (?:start|begin|commit)|commit to|can you commit|are you in\b")
+TARGET_QUESTION = re.compile(r"goal weight|target weight|like to weigh|want to weigh|like to get to|want to get to|weight goal")
+CURRENT_QUESTION = re.compile(r"current weight|weigh (?:right )?now|how much do you weigh|what do you weigh|weigh currently")
+DATE_QUESTION = re.compile(r"\bby when\b|\bwhen would you\b|\bwhen do you\b|timeline|target date|how soon|how long")
+
+AFFIRM = re.compile(r"^(?:yes|yep|yeah|yup|sure|ok|okay|absolutely|definitely|of course|let'?s do (?:it|this)|i'?m in|"
+                    r"i'?m ready|ready|i commit|i'?m committed|deal|count me in|will do|i will|i can do that|100%)\b")
+DECLINE = re.compile(r"^(?:no|nope|nah|not yet|not really|not ready|i'?m not ready|maybe later|i don'?t think so)\b")
+ACKNOWLEDGE = re.compile(r"^(?:ok|okay|k|thanks|thank you|thx|ty|got it|sounds good|great|cool|nice|perfect|"
+                         r"awesome|hi|hello|hey|good morning|good evening|makes sense|understood|will do)$")
+
+# Replies whose acknowledgement may confirm something for the profile
+PROFILE_CONTENT = re.compile(r"\d|\bplan\b|calori|kcal|\bstrateg|\bdiet\b|exercis|workout|\bwalk|\bcommit|barrier")
+
+FILLER = set("""
+i i'm im am my me weight weigh is are currently right now about around roughly approximately like
+and so um uh well to want get down goal target would i'd id be at tall height the a an of it its it's
+just over under by before within in ideally hoping hope love say reach hit aim aiming hmm oh
+have has got i've ive with diagnosed also too plus suffer from
+yes yep yeah yup sure ok okay absolutely definitely of course let's lets do this i'll ill will ready
+in committed commit deal count thanks thank you great cool sounds good perfect awesome tomorrow
+""".split())
+
+# Filler after a decline, less the words that contradict it: "no, I'm ready" is not a no
+DECLINE_FILLER = FILLER - set("""
+yes yep yeah yup sure ok okay absolutely definitely course let's lets do i'll ill will ready in
+committed commit deal count great sounds good perfect awesome
+""".split())
+
+
+def _normalize(text: str) -> str:
+    return (text.lower().replace("’", "'").replace("‘", "'")
+            .replace("“", '"').replace("”", '"').strip())
+
+
+def _clause_before(text: str, start: int) -> str:
+    """The words leading up to a match, within its clause."""
+    before = text[max(0, start - 40):start]
+    return re.split(r"[.,;!?]|\bbut\b|\band\b", before)[-1]
+
+
+def _leftover_is_filler(text: str, spans: list[tuple[int, int]], filler: set = FILLER) -> bool:
+    for start, end in sorted(spans, reverse=True):
+        text = text[:start] + " " + text[end:]
+    words = re.findall(r"[a-z0-9%']+", text)
+    return all(w.strip("'") in filler or w in filler for w in words)
+
+
+def _weight(match: re.Match) -> Optional[str]:
+    value, unit = float(match.group(1)), match.group(2)
+    metric = unit.startswith("k")
+    low, high = (35, 320) if metric else (80, 700)
+    if not low <= value <= high:
+        return None
+    return f"{match.group(1)} {'kg' if metric else 'lbs'}"
+
+
+def _height(match: re.Match) -> Optional[str]:
+    if match.re is HEIGHT_METRIC:
+        return f"{match.group(1)} cm"
+    feet, inches = match.group(1), match.group(2)
+    if inches is None:
+        return f"{feet}'"
+    if int(inches) > 11:
+        return None
+    return f"{feet}'{inches}\""
+
+
+def extract_locally(exchange: dict) -> Optional[dict]:
+    """Parse one exchange without the model.
+
+    Returns the profile updates found (possibly empty) if the user's message is
+    fully accounted for, or None if it needs the model.
+    """
+    text = _normalize(exchange.get("user_message", ""))
+    previous = _normalize(exchange.get("previous_response") or "")
+    if not text:
+        return {}
+    bare = re.sub(r"[^\w\s'%]", "", text).strip()
+
+    # Answers to "Are you ready to start this tomorrow?"
+    if COMMIT_QUESTION.search(previous):
+        if DECLINE.match(bare):
+            declined = _leftover_is_filler(bare, [DECLINE.match(bare).span()], DECLINE_FILLER)
+            return {"committed": False} if declined else None
+        if AFFIRM.match(bare):
+            return {"committed": True} if _leftover_is_filler(bare, [AFFIRM.match(bare).span()]) else None
+
+    if ACKNOWLEDGE.match(bare):
+        reply = _normalize(exchange.get("assistant_response") or "")
+        return None if PROFILE_CONTENT.search(previous) or PROFILE_CONTENT.search(reply) else {}
+
+    negated = bool(NEGATION.search(text))
+    updates: dict = {}
+    spans: list[tuple[int, int]] = []
+
+    for match in WEIGHT.finditer(text):
+        value = _weight(match)
+        clause = _clause_before(text, match.start())
+        if value is None or negated or CHANGE_CUE.search(clause):
+            return None  # "lose 30 lbs" is a change, not a weight
+        if TARGET_CUE.search(clause):
+            field = "target_weight"
+        elif CURRENT_CUE.search(text[:match.start()]):
+            field = "current_weight"
+        elif TARGET_QUESTION.search(previous):
+            field = "target_weight"
+        elif CURRENT_QUESTION.search(previous):
+            field = "current_weight"
+        else:
+            return None
+        if field in updates:
+            return None
+        updates[field] = value
+        spans.append(match.span())
+
+    for pattern in (HEIGHT_IMPERIAL, HEIGHT_METRIC):
+        for match in pattern.finditer(text):
+            value = _height(match)
+            if value is None or negated or "height" in updates:
+                return None
+            updates["height"] = value
+            spans.append(match.span())
+
+    for match in TARGET_DATE.finditer(text):
+        if match.group(1) == "in" and not DATE_QUESTION.search(previous):
+            return None  # "in June" could be anything; "by June" is a deadline
+        if negated or "target_date" in updates:
+            return None
+        updates["target_date"] = re.sub(rf"\b(?:{MONTHS}|christmas)\b", lambda m: m.group().capitalize(), match.group(2))
+        spans.append(match.span())
+
+    conditions = []
+    for pattern, name in CONDITIONS:
+        for match in pattern.finditer(text):
+            if any(s <= match.start() < e for s, e in spans):
+                continue  # "type 2 diabetes" already matched; don't add "diabetes" too
+            if negated:
+                return None
+            if name not in conditions:
+                conditions.append(name)
+            spans.append(match.span())
+    if conditions:
+        updates["conditions"] = conditions
+
+    if not spans or not _leftover_is_filler(text, spans):
+        return None
+    return updates
@@ -7,9 +7,10 @@ a profile of your health over time.
 """
 
 import sys
-from assistant import chat_stream
+from assistant import chat_stream, flush_profile_updates
 from user_profile import display_profile, load_profile, save_profile
 from memory import clear_history
+from session_state import clear_session, update_session
 
 # Default user ID (in a real app, this would come from auth)
 USER_ID = "default"
@@ -39,14 +40,18 @@ def handle_command(command: str) -> bool:
         print_help()
 
     elif cmd == "/profile":
+        flush_profile_updates(USER_ID)
         print(display_profile(USER_ID))
 
     elif cmd == "/clear" or cmd == "/new":
         clear_history(USER_ID)
+        update_session(USER_ID, greeting_seeded=False, plan_turns=0)
         print("New conversation started. (Profile retained)")
 
     elif cmd == "/reset":
-        clear_history(USER_ID)
+        flush_profile_updates(USER_ID)
+        clear_history(USER_ID, reason="reset")
+        clear_session(USER_ID)
         save_profile(USER_ID, {
             "name": None,
             "height": None,
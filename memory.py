@@ -1,49 +1,64 @@
-import json
 from pathlib import Path
 from datetime import datetime
-from config import DATA_DIR, MAX_CONVERSATION_HISTORY
+from config import MAX_CONVERSATION_HISTORY
+from metrics import span
+from recall import recall_index
+from storage import get_storage, get_user_dirs
 
-
-def get_user_dir(user_id: str) -> Path:
-    """Get or create user data directory."""
-    user_dir = DATA_DIR / user_id
-    user_dir.mkdir(parents=True, exist_ok=True)
-    return user_dir
+def get_user_dir(user_id: str, create: bool = True) -> Path:
+    """Get the user data directory, creating it unless this is a read."""
+    dirs = get_user_dirs()
+    return dirs.ensure(user_id) if create else dirs.path(user_id)
 
 
 def load_conversations(user_id: str) -> list[dict]:
     """Load conversation history for a user."""
-    conv_file = get_user_dir(user_id) / "conversations.json"
-    if conv_file.exists():
-        return json.loads(conv_file.read_text())
-    return []
+    return get_storage().load_turns(user_id)
 
 
 def save_conversation_turn(user_id: str, role: str, content: str):
-    """Save a single conversation turn."""
-    conversations = load_conversations(user_id)
-    conversations.append({
+    """Save a single conversation turn and add it to the recall index."""
+    turn = {
         "role": role,
         "content": content,
         "timestamp": datetime.now().isoformat()
-    })
-
-    conv_file = get_user_dir(user_id) / "conversations.json"
-    conv_file.write_text(json.dumps(conversations, indent=2))
+    }
+    with span("conversation_write"):
+        get_storage().append_turn(user_id, turn)
+        recall_index.add_turn(user_id, turn)
 
 
 def get_recent_history(user_id: str, limit: int = None) -> list[dict]:
     """Get recent conversation history formatted for Claude API."""
     limit = limit or MAX_CONVERSATION_HISTORY
-    conversations = load_conversations(user_id)
-    recent = conversations[-limit:]
+    with span("history_load"):
+        recent = get_storage().recent_turns(user_id, limit)
 
     # Format for Claude API (just role and content)
     return [{"role": c["role"], "content": c["content"]} for c in recent]
 
 
-def clear_history(user_id: str):
-    """Clear conversation history for a user."""
-    conv_file = get_user_dir(user_id) / "conversations.json"
-    if conv_file.exists():
-        conv_file.write_text("[]")
+def count_turns(user_id: str) -> int:
+    """Count the turns in a user's conversation history."""
+    return get_storage().count_turns(user_id)
+
+
+def list_archived_sessions(user_id: str) -> list[dict]:
+    """List archived conversation segments, oldest first."""
+    return get_storage().list_archives(user_id)
+
+
+def load_archived_session(user_id: str, segment_id: str) -> list[dict]:
+    """Load the turns of an archived conversation segment."""
+    return get_storage().load_archive(user_id, segment_id)
+
+
+def clear_history(user_id: str, reason: str = "new"):
+    """Start a new conversation. The old one is archived, not deleted.
+
+    After /new, earlier conversations can still be recalled; a reset forgets them.
+    """
+    get_storage().archive_turns(user_id, reason=reason)
+    get_storage().clear_summary(user_id)
+    if reason == "reset":
+        recall_index.reset(user_id)
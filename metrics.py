@@ -0,0 +1,185 @@
+"""
+Lightweight latency instrumentation.
+
+Wrap a stage of a turn in `span("stage")` to record its duration in a
+histogram. Wrap a request in `trace_request(route)` to also collect the spans
+that ran during it and, when TRACE_REQUESTS is on, log them as one line of
+structured JSON. `render_prometheus()` serves everything in the Prometheus
+text format for the /metrics route.
+
+Metrics are per process; with several gunicorn workers, scrape each worker or
+aggregate in Prometheus.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+from config import TRACE_REQUESTS
+
+logger = logging.getLogger("nori.trace")
+if TRACE_REQUESTS and not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Seconds; spans range from sub-millisecond file reads to minute-long generations
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as exposed by Prometheus."""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms: dict[tuple, Histogram] = {}     # (name, labels) -> Histogram
+_counters: dict[tuple, float] = {}           # (name, labels) -> running total
+_help: dict[str, str] = {
+    "nori_stage_seconds": "Time spent in each stage of a turn.",
+    "nori_request_seconds": "End-to-end request time by route.",
+    "nori_model_route_seconds": "Model call time by route and model.",
+    "nori_model_route_ttft_seconds": "Time to first streamed token by route and model.",
+    "nori_model_route_calls_total": "Model calls by route and model.",
+    "nori_model_route_tokens_total": "Tokens by route, model and kind (input, output, cache_read, cache_write).",
+    "nori_variant_tokens_total": "Tokens by prompt variant and kind.",
+    "nori_playbook_turns_total": "System prompts built by variant and playbook stage.",
+    "nori_playbook_tokens_saved_total": "Estimated system prompt tokens saved against the full playbook.",
+}
+_collectors: list[Callable[[], list[tuple]]] = []
+_trace: ContextVar[Optional[dict]] = ContextVar("nori_trace", default=None)
+
+
+def observe(name: str, value: float, **labels):
+    """Record a value in the named histogram."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def increment(name: str, amount: float = 1, **labels):
+    """Add to the named labelled counter."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def record_stage(stage: str, seconds: float):
+    """Record a stage duration measured elsewhere (e.g. time to first token)."""
+    observe("nori_stage_seconds", seconds, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace["stages"][stage] = trace["stages"].get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    """Time the enclosed block as one stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace_request(route: str, **fields):
+    """Time a request and collect the stages that ran inside it."""
+    trace = {"route": route, "stages": {}, **fields}
+    token = _trace.set(trace)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _trace.reset(token)
+        observe("nori_request_seconds", elapsed, route=route, status=status)
+        if TRACE_REQUESTS:
+            logger.info(json.dumps({
+                **trace,
+                "status": status,
+                "total_ms": round(elapsed * 1000, 2),
+                "stages": {k: round(v * 1000, 2) for k, v in trace["stages"].items()},
+            }))
+
+
+def register_collector(collector: Callable[[], list[tuple]]):
+    """Register a callable returning (name, type, help, value) samples for /metrics."""
+    _collectors.append(collector)
+    return collector
+
+
+def counters(prefix: str, stats: dict, help_text: str) -> Callable[[], list[tuple]]:
+    """Build a collector that exposes a dict of running counts as Prometheus counters."""
+    def collect():
+        return [(f"{prefix}_{key}_total", "counter", help_text, value) for key, value in list(stats.items())]
+    return collect
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        by_name: dict[str, list] = {}
+        for (name, labels), histogram in sorted(_histograms.items()):
+            by_name.setdefault(name, []).append((labels, histogram.counts[:], histogram.sum, histogram.count))
+        counters_by_name: dict[str, list] = {}
+        for (name, labels), value in sorted(_counters.items()):
+            counters_by_name.setdefault(name, []).append((labels, value))
+
+    for name, series in by_name.items():
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for name, series in counters_by_name.items():
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in series:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for collector in _collectors:
+        for name, kind, help_text, value in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
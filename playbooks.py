@@ -0,0 +1,220 @@
+"""
+Playbook registry: the slice of each variant's task list a turn needs.
+
+The task files and resources.txt are split at their headings. Each variant's
+playbook maps a stage of the conversation, read from the profile, to the steps
+the model can be on during it (with a step of overlap either side, since
+extraction runs a turn behind) and to the resource sections worth linking then.
+Extraction can miss the plan altogether, so after PLAYBOOK_PLAN_TURNS turns in
+the plan stage (counted in session state) the user moves on to commitment.
+
+A stage prompt shorter than the turn's model will cache (PROMPT_CACHE_MIN_TOKENS)
+would be billed in full every turn, while a cached full prompt is read at a
+tenth of the price. So when the stage prompt is too short to cache and the full
+prompt isn't, the full prompt is sent instead.
+The static prefix for each (variant, stage) is compiled once per version of the
+prompt files, so a turn pays for a dict lookup and carries a fraction of the
+full prompt. NORI_PLAYBOOK_STAGES=0 sends the full prompt again, for
+comparison. Tokens saved against the full prompt are on /metrics, and
+
+    python playbooks.py
+
+prints them per variant and stage.
+"""
+
+import logging
+import re
+from config import PLAYBOOK_PLAN_TURNS, PLAYBOOK_STAGES, PROMPT_CACHE_MIN_TOKENS, PROMPTS_DIR
+import metrics
+from routing import INTAKE_FIELDS, chat_route, route_params
+from tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("intake", "plan", "commitment", "ongoing")
+
+PLAYBOOKS = {
+    "coach": {
+        "task_file": "tasks_coach.txt",
+        "steps": {
+            "intake": [f"Step {n}" for n in range(0, 6)],
+            "plan": [f"Step {n}" for n in range(4, 12)],
+            "commitment": [f"Step {n}" for n in range(11, 16)],
+            "ongoing": ["Step 15", "After completing all steps"],
+        },
+    },
+    "planner": {
+        "task_file": "tasks_planner.txt",
+        "steps": {
+            "intake": ["Phase 1", "Phase 2"],
+            "plan": ["Phase 2", "Phase 3"],
+            "commitment": ["Phase 3", "Phase 4"],
+            "ongoing": ["Phase 4", "After completing all phases"],
+        },
+    },
+}
+
+# Sections of resources.txt by stage; crisis resources are always included
+RESOURCES = {
+    "intake": ["Crisis resources"],
+    "plan": ["Calorie & Macro Tracking", "Fitness & Exercise", "Meal Planning & Recipes",
+             "GLP-1 Information", "Crisis resources"],
+    "commitment": ["Calorie & Macro Tracking", "Fitness & Exercise", "Meal Planning & Recipes",
+                   "Scales & Tracking", "Crisis resources"],
+    "ongoing": None,  # all of them
+}
+
+STAGE_NOTE = ("Only the part of the task list for where this person is now is shown. Earlier parts "
+              "are done unless the conversation shows otherwise.")
+
+_HEADING = re.compile(r"(?m)^(?=#{2,3} )")
+
+# Prompt files are cached in-process and re-read only when their mtime changes
+_prompt_file_cache: dict[str, tuple[int, str]] = {}
+
+# (variant, stage or None for the full prompt) -> (source texts, compiled text, estimated tokens)
+_compiled: dict[tuple, tuple[tuple, str, int]] = {}
+
+
+def read_prompt_file(name: str) -> str:
+    """Read a file from the prompts directory, cached until it changes on disk."""
+    path = PROMPTS_DIR / name
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        _prompt_file_cache.pop(name, None)
+        return ""
+    cached = _prompt_file_cache.get(name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    text = path.read_text()
+    _prompt_file_cache[name] = (mtime, text)
+    return text
+
+
+def playbook_stage(profile: dict, plan_turns: int = 0) -> str:
+    """Where the user is in their playbook, from their profile and turns spent on the plan."""
+    if any(profile.get(field) is None for field in INTAKE_FIELDS):
+        return "intake"
+    if profile.get("plan") is None and plan_turns < PLAYBOOK_PLAN_TURNS:
+        return "plan"
+    if profile.get("committed") is None:
+        return "commitment"
+    return "ongoing"
+
+
+def split_sections(text: str) -> tuple[str, dict[str, str]]:
+    """Split a prompt file at its ## and ### headings: (lead, {key: section}).
+
+    The lead is everything up to the first ### heading; a section's key is its
+    heading up to any colon or parenthesis, e.g. "Step 3" or "GLP-1 Information".
+    """
+    parts = _HEADING.split(text)
+    lead = []
+    sections = {}
+    for part in parts:
+        if not part.strip():
+            continue
+        if not sections and not part.startswith("### "):
+            lead.append(part)
+            continue
+        heading = part.split("\n", 1)[0].lstrip("#").strip()
+        sections[re.split(r"[:(]", heading)[0].strip()] = part.strip()
+    return "".join(lead).strip(), sections
+
+
+def _pick(name: str, sections: dict[str, str], keys) -> list[str]:
+    if keys is None:
+        return list(sections.values())
+    missing = [key for key in keys if key not in sections]
+    if missing:
+        logger.warning("%s has no section %s; left out of the prompt", name, ", ".join(missing))
+    return [sections[key] for key in sections if key in keys]
+
+
+def _compile(variant: str, stage, header: str, tasks: str, footer: str, resources: str) -> str:
+    if stage is None:
+        parts = [header, tasks, footer]
+        if resources:
+            parts.append(resources)
+        return "\n\n".join(parts)
+
+    task_file = PLAYBOOKS[variant]["task_file"]
+    lead, steps = split_sections(tasks)
+    task_text = "\n\n".join([lead, STAGE_NOTE] + _pick(task_file, steps, PLAYBOOKS[variant]["steps"][stage]))
+    parts = [header, task_text, footer]
+    resource_lead, sections = split_sections(resources)
+    picked = _pick("resources.txt", sections, RESOURCES[stage])
+    if picked:
+        parts.append("\n\n".join([resource_lead] + picked))
+    return "\n\n".join(parts)
+
+
+def _get(variant: str, stage) -> tuple[str, int]:
+    sources = (
+        read_prompt_file("base_header.txt"),
+        read_prompt_file(PLAYBOOKS[variant]["task_file"]),
+        read_prompt_file("base_footer.txt"),
+        read_prompt_file("resources.txt"),
+    )
+    cached = _compiled.get((variant, stage))
+    if cached and cached[0] == sources:  # unchanged files are the same objects, so this is cheap
+        return cached[1], cached[2]
+    text = _compile(variant, stage, *sources)
+    _compiled[(variant, stage)] = (sources, text, estimate_tokens(text))
+    return text, _compiled[(variant, stage)][2]
+
+
+def full_prompt(variant: str) -> str:
+    """Every step and resource for the variant, as sent before playbooks."""
+    return _get(variant, None)[0]
+
+
+def stage_prompt(variant: str, stage: str) -> str:
+    """The compiled static prompt for one stage of the variant's playbook."""
+    return _get(variant, stage)[0]
+
+
+def _choose(variant: str, stage: str, model: str) -> tuple[str, int]:
+    """The stage prompt, or the full one when only the full one is long enough for `model` to cache."""
+    text, tokens = _get(variant, stage if PLAYBOOK_STAGES else None)
+    full_text, full_tokens = _get(variant, None)
+    minimum = PROMPT_CACHE_MIN_TOKENS.get(model, 0)
+    if tokens < minimum <= full_tokens:
+        return full_text, full_tokens
+    return text, tokens
+
+
+def static_prompt(variant: str, profile: dict, plan_turns: int = 0) -> str:
+    """The static prompt for the user's current stage, counting the tokens it saves."""
+    stage = playbook_stage(profile, plan_turns)
+    text, tokens = _choose(variant, stage, route_params(chat_route(profile), variant)["model"])
+    full_tokens = _get(variant, None)[1]
+    metrics.increment("nori_playbook_turns_total", variant=variant, stage=stage)
+    metrics.increment("nori_playbook_tokens_saved_total", full_tokens - tokens, variant=variant, stage=stage)
+    return text
+
+
+# A profile at each stage, for picking the stage's chat route in main()
+STAGE_PROFILES = {
+    "intake": {},
+    "plan": dict.fromkeys(INTAKE_FIELDS, ""),
+    "commitment": {**dict.fromkeys(INTAKE_FIELDS, ""), "plan": ""},
+    "ongoing": {**dict.fromkeys(INTAKE_FIELDS, ""), "plan": "", "committed": True},
+}
+
+
+def main():
+    print(f"{'variant':<10} {'stage':<12} {'tokens':>7} {'full':>7} {'model':<28} {'sent':>7} {'saved':>7}")
+    for variant in PLAYBOOKS:
+        full_tokens = _get(variant, None)[1]
+        for stage in STAGES:
+            tokens = _get(variant, stage)[1]
+            model = route_params(chat_route(STAGE_PROFILES[stage]), variant)["model"]
+            sent = _choose(variant, stage, model)[1]
+            print(f"{variant:<10} {stage:<12} {tokens:>7} {full_tokens:>7} {model:<28} {sent:>7} "
+                  f"{1 - sent / full_tokens:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Per-process profile cache.
+
+Profiles are cached per user with a version stamp from the storage backend, so
+a cached entry is revalidated with one cheap check instead of a read and parse.
+Rendered text (prompt block, /profile display) is memoized per entry version.
+Saves update the cache immediately and are written behind: several saves in
+quick succession collapse into a single atomic write.
+"""
+
+import atexit
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("lock", "loaded", "evicted", "profile", "stamp", "version", "dirty_since", "rendered")
+
+    def __init__(self):
+        self.lock = threading.Lock()  # held across this user's storage reads and writes
+        self.loaded = False
+        self.evicted = False        # dropped from the cache; holders must look it up again
+        self.profile = None
+        self.stamp = None           # storage version when last read or written
+        self.version = 0            # bumped on every in-process save or reload
+        self.dirty_since = None     # monotonic time of the first unwritten save
+        self.rendered = {}          # kind -> (version, text)
+
+
+class ProfileCache:
+    """Bounded cache of saved profiles with write-behind.
+
+    Each entry has its own lock, held across that user's storage I/O. The shared
+    lock only guards the entry table and stats, so a slow read or write for one
+    user doesn't stall the others. Entries with an unwritten save, or in use, are
+    not evicted; the table can run over max_size until they're written.
+    """
+
+    POLICIES = ("lru", "fifo")
+
+    def __init__(self, storage_getter: Callable, max_size: int = 1024,
+                 policy: str = "lru", write_delay: float = 0.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown profile cache policy: {policy}")
+        self.storage_getter = storage_getter
+        self.max_size = max_size
+        self.policy = policy
+        self.write_delay = write_delay
+
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flusher: Optional[threading.Thread] = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "saves": 0,
+            "writes": 0,
+            "render_hits": 0,
+            "render_misses": 0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _acquire(self, user_id: str) -> _Entry:
+        """Return the user's entry with its lock held, adding it if needed."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    entry = self._entries[user_id] = _Entry()
+                    self._evict(keep=user_id)
+                elif self.policy == "lru":
+                    self._entries.move_to_end(user_id)
+            entry.lock.acquire()
+            if not entry.evicted:
+                return entry
+            entry.lock.release()
+
+    def _drop(self, user_id: str, entry: _Entry):
+        # Caller holds entry.lock
+        entry.evicted = True
+        with self._lock:
+            if self._entries.get(user_id) is entry:
+                del self._entries[user_id]
+
+    # -- Reads --
+
+    def _load(self, user_id: str, entry: _Entry):
+        """Make the entry current, reloading it if storage changed. Caller holds entry.lock."""
+        storage = self.storage_getter()
+        if entry.loaded and (entry.dirty_since is not None or (
+            entry.stamp is not None and entry.stamp == storage.profile_version(user_id)
+        )):
+            self._count("hits")
+            return
+
+        # Not loaded yet, or changed on disk by another process
+        self._count("misses")
+        with span("profile_load"):
+            entry.stamp = storage.profile_version(user_id)
+            entry.profile = storage.load_profile(user_id)
+        entry.loaded = True
+        entry.version += 1
+        entry.rendered.clear()
+        if entry.stamp is None:
+            self._drop(user_id, entry)  # backend can't validate entries, so don't keep them
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """Return a private copy of the saved profile, or None if there isn't one."""
+        entry = self._acquire(user_id)
+        try:
+            self._load(user_id, entry)
+            return copy.deepcopy(entry.profile)
+        finally:
+            entry.lock.release()
+
+    def render(self, user_id: str, kind: str, renderer: Callable[[Optional[dict]], str]) -> str:
+        """Return renderer(profile), memoized until the profile changes."""
+        entry = self._acquire(user_id)
+        try:
+            self._load(user_id, entry)
+            cached = entry.rendered.get(kind)
+            if cached and cached[0] == entry.version:
+                self._count("render_hits")
+                return cached[1]
+            self._count("render_misses")
+            text = renderer(entry.profile)
+            entry.rendered[kind] = (entry.version, text)
+            return text
+        finally:
+            entry.lock.release()
+
+    # -- Writes --
+
+    def put(self, user_id: str, profile: dict):
+        """Save a profile. Written immediately, or after write_delay seconds."""
+        entry = self._acquire(user_id)
+        try:
+            entry.profile = copy.deepcopy(profile)
+            entry.loaded = True
+            entry.version += 1
+            entry.rendered.clear()
+            if entry.dirty_since is None:
+                entry.dirty_since = time.monotonic()
+            if self.write_delay <= 0:
+                self._write(user_id, entry)
+        finally:
+            entry.lock.release()
+
+        with self._lock:
+            self.stats["saves"] += 1
+            if self.write_delay > 0:
+                self._ensure_flusher()
+                self._wakeup.notify()
+
+    def flush(self, user_id: Optional[str] = None):
+        """Write pending saves now."""
+        for uid, entry in self._pending(user_id):
+            with entry.lock:
+                if entry.dirty_since is not None:
+                    self._write(uid, entry)
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drop cached entries (pending saves are written first)."""
+        with self._lock:
+            entries = [(uid, e) for uid, e in self._entries.items() if user_id is None or uid == user_id]
+        for uid, entry in entries:
+            with entry.lock:
+                if entry.dirty_since is not None:
+                    self._write(uid, entry)
+                self._drop(uid, entry)
+
+    def _pending(self, user_id: Optional[str] = None) -> list[tuple[str, _Entry]]:
+        with self._lock:
+            return [(uid, e) for uid, e in self._entries.items()
+                    if e.dirty_since is not None and (user_id is None or uid == user_id)]
+
+    def _write(self, user_id: str, entry: _Entry):
+        # Caller holds entry.lock
+        storage = self.storage_getter()
+        with span("profile_write"):
+            storage.save_profile(user_id, entry.profile)
+            entry.stamp = storage.profile_version(user_id)
+        entry.dirty_since = None
+        self._count("writes")
+
+    def _evict(self, keep: str):
+        # Caller holds the shared lock; skips entries that are dirty or in use
+        excess = len(self._entries) - self.max_size
+        for user_id, entry in list(self._entries.items()):
+            if excess <= 0:
+                break
+            if user_id == keep or entry.dirty_since is not None or not entry.lock.acquire(blocking=False):
+                continue
+            entry.evicted = True
+            del self._entries[user_id]
+            entry.lock.release()
+            self.stats["evictions"] += 1
+            excess -= 1
+
+    def _ensure_flusher(self):
+        # Caller holds the shared lock
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="profile-writer", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                due, next_due = [], None
+                for user_id, entry in self._entries.items():
+                    dirty_since = entry.dirty_since
+                    if dirty_since is None:
+                        continue
+                    if dirty_since + self.write_delay <= now:
+                        due.append((user_id, entry))
+                    elif next_due is None or dirty_since + self.write_delay < next_due:
+                        next_due = dirty_since + self.write_delay
+                if not due:
+                    self._wakeup.wait(None if next_due is None else next_due - now)
+                    continue
+
+            for user_id, entry in due:
+                with entry.lock:
+                    if entry.dirty_since is None:
+                        continue
+                    try:
+                        self._write(user_id, entry)
+                    except Exception:
+                        logger.exception("Failed to write profile for %s; will retry", user_id)
+                        entry.dirty_since = time.monotonic()
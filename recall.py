@@ -0,0 +1,226 @@
+"""
+Per-user retrieval over past conversations and profile notes.
+
+Every saved turn is appended to the user's recall.jsonl, and each process keeps
+a BM25 index of it that is brought up to date by reading only the lines added
+since the last look. Profile notes are indexed the first time they are seen.
+The prompt then carries the few snippets most relevant to the current message
+instead of every note and every old turn, so its size stays flat however long
+the user has been around.
+"""
+
+import fcntl
+import json
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional
+import metrics
+from config import RECALL_CACHE_SIZE
+from storage import get_storage, get_user_dirs
+
+RECALL_FILE = "recall.jsonl"
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_TERM = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+    a about above after again all am an and any are as at be because been before being below between both but by
+    can could did do does doing down during each few for from further had has have having he her here hers him his
+    how i if in into is it its just me more most my no nor not now of off on once only or other our out over own
+    same she should so some such than that the their them then there these they this those through to too under
+    until up very was we were what when where which while who whom why will with would you your yours yes ok okay
+""".split())
+
+
+def terms(text: str) -> list[str]:
+    """Lowercased words, without stopwords and single letters."""
+    return [t for t in _TERM.findall(text.lower()) if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+class _Index:
+    """BM25 postings for one user's recall file, as of `offset` bytes."""
+
+    __slots__ = ("inode", "offset", "docs", "lengths", "postings", "total_length", "turns", "notes", "lock")
+
+    def __init__(self, inode: int):
+        self.inode = inode
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.docs: list[dict] = []
+        self.lengths: list[int] = []
+        self.postings: dict[str, list[tuple[int, int]]] = {}  # term -> [(doc, term count)]
+        self.total_length = 0
+        self.turns: list[int] = []    # positions of turn documents, oldest first
+        self.notes: set[str] = set()
+
+    def add(self, doc: dict):
+        counts = Counter(terms(doc["text"]))
+        index = len(self.docs)
+        self.docs.append(doc)
+        self.lengths.append(sum(counts.values()))
+        self.total_length += self.lengths[-1]
+        for term, count in counts.items():
+            self.postings.setdefault(term, []).append((index, count))
+        if doc["kind"] == "note":
+            self.notes.add(doc["text"])
+        else:
+            self.turns.append(index)
+
+
+class RecallIndex:
+    """Append-only per-user documents with a cached, incrementally updated BM25 index."""
+
+    def __init__(self, cache_size: int = 256):
+        self.cache_size = cache_size
+        self._indexes: OrderedDict[str, _Index] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"searches": 0, "snippets": 0, "docs_loaded": 0, "backfills": 0}
+
+    def _path(self, user_id: str, create: bool = False):
+        dirs = get_user_dirs()
+        return (dirs.ensure(user_id) if create else dirs.path(user_id)) / RECALL_FILE
+
+    def _append(self, user_id: str, docs: list[dict], backfill: bool = False):
+        path = self._path(user_id, create=True)
+        with open(path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if backfill and f.tell():
+                return  # another request built it first
+            f.write(b"".join((json.dumps(doc, ensure_ascii=False) + "\n").encode("utf-8") for doc in docs))
+
+    def _backfill(self, user_id: str):
+        """Index everything stored before the recall file existed."""
+        storage = get_storage()
+        turns = []
+        for entry in storage.list_archives(user_id):
+            if entry["reason"] == "reset":
+                turns = []  # a reset forgets everything before it
+                continue
+            turns += storage.load_archive(user_id, entry["id"])
+        turns += storage.load_turns(user_id)
+        self._append(user_id, [_turn_doc(turn) for turn in turns], backfill=True)
+        with self._lock:
+            self.stats["backfills"] += 1
+
+    def add_turn(self, user_id: str, turn: dict):
+        """Index a turn just saved to storage."""
+        if not self._path(user_id).exists():
+            self._backfill(user_id)  # includes the new turn
+            return
+        self._append(user_id, [_turn_doc(turn)])
+
+    def reset(self, user_id: str):
+        """Forget everything indexed for the user (an empty file, so nothing is backfilled)."""
+        path = self._path(user_id, create=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(b"")
+        tmp.replace(path)
+
+    def _load(self, user_id: str) -> Optional[_Index]:
+        """The user's index, reading only what was appended since it was cached."""
+        path = self._path(user_id)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None or index.inode != stat.st_ino or stat.st_size < index.offset:
+                index = _Index(stat.st_ino)
+            self._indexes[user_id] = index
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.cache_size:
+                self._indexes.popitem(last=False)
+        with index.lock:
+            if stat.st_size > index.offset:
+                with open(path, "rb") as f:
+                    f.seek(index.offset)
+                    data = f.read()
+                complete = data[:data.rfind(b"\n") + 1]  # a line still being written waits for next time
+                docs = [json.loads(line) for line in complete.splitlines() if line.strip()]
+                for doc in docs:
+                    index.add(doc)
+                index.offset += len(complete)
+                with self._lock:
+                    self.stats["docs_loaded"] += len(docs)
+        return index
+
+    def search(self, user_id: str, query: str, k: int, skip_recent: int = 0,
+               notes: Optional[list[str]] = None) -> list[dict]:
+        """The k documents that best match the query.
+
+        The newest `skip_recent` turns are left out (they're already in the prompt).
+        Notes are indexed on first sight, and only those still in `notes` are returned.
+        """
+        with metrics.span("recall"):
+            path = self._path(user_id)
+            if not path.exists():
+                if not path.parent.is_dir():
+                    return []  # nothing stored for this user, so don't create anything
+                self._backfill(user_id)
+            index = self._load(user_id)
+            new_notes = [n for n in (notes or []) if n not in index.notes]
+            if new_notes:
+                self._append(user_id, [{"kind": "note", "text": n} for n in dict.fromkeys(new_notes)])
+                index = self._load(user_id)
+
+            query_terms = set(terms(query))
+            if not query_terms or not index.docs:
+                return []
+            skipped = set(index.turns[max(len(index.turns) - skip_recent, 0):]) if skip_recent else set()
+            current_notes = set(notes or [])
+
+            n = len(index.docs)
+            average = index.total_length / n or 1
+            scores: dict[int, float] = {}
+            for term in query_terms:
+                postings = index.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc, count in postings:
+                    norm = K1 * (1 - B + B * index.lengths[doc] / average)
+                    scores[doc] = scores.get(doc, 0.0) + idf * count * (K1 + 1) / (count + norm)
+
+            results = []
+            seen = set()
+            for doc in sorted(scores, key=scores.get, reverse=True):
+                entry = index.docs[doc]
+                if doc in skipped or entry["text"] in seen:
+                    continue
+                if entry["kind"] == "note" and entry["text"] not in current_notes:
+                    continue
+                seen.add(entry["text"])
+                results.append(entry)
+                if len(results) == k:
+                    break
+            with self._lock:
+                self.stats["searches"] += 1
+                self.stats["snippets"] += len(results)
+            return results
+
+
+def _turn_doc(turn: dict) -> dict:
+    return {"kind": "turn", "role": turn["role"], "text": turn["content"], "ts": turn.get("timestamp", "")}
+
+
+def format_snippets(docs: list[dict], max_chars: int) -> str:
+    """Render recalled documents as prompt lines."""
+    lines = []
+    for doc in docs:
+        text = " ".join(doc["text"].split())
+        if len(text) > max_chars:
+            text = text[:max_chars].rsplit(" ", 1)[0] + " …"
+        if doc["kind"] == "note":
+            lines.append(f"- Note: {text}")
+        else:
+            lines.append(f"- {doc['ts'][:10]}, {'user' if doc['role'] == 'user' else 'you'}: {text}")
+    return "\n".join(lines)
+
+
+recall_index = RecallIndex(RECALL_CACHE_SIZE)
+metrics.register_collector(metrics.counters("nori_recall", recall_index.stats, "Recall index searches and loads."))
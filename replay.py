@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Offline replay of user transcripts under every prompt variant.
+
+Each transcript is run through assistant.chat once per variant in VARIANTS,
+spread over a process pool, against a deterministic in-process fake model:
+chat turns get the transcript's scripted (or recorded) replies, and profile
+extraction gets its scripted updates. Every turn's latency is simulated from
+its token counts instead of slept, so a run takes seconds and gives the same
+numbers every time. Per-variant turns, turns to plan, prompt tokens, simulated
+latency and extraction calls are printed, and can be saved and compared
+between prompt changes:
+
+    python replay.py --output replay/before.json
+    python replay.py --output replay/after.json --compare replay/before.json
+
+Transcripts are JSONL files. A line with "messages" is a scripted user:
+
+    {"id": "sam", "messages": ["I want to lose 30 lbs", {"text": "6ft, 230", "updates": {"height": "6ft"}}],
+     "replies": ["Do you have a target date in mind?"], "variant": "coach"}
+
+"replies" may also map variants to lists, and "variant" limits a transcript to
+one variant. A file of {"role", "content"} lines, as written by
+`python storage.py export USER_ID`, is one recorded user, replayed with its
+recorded replies. Runs against throwaway data directories; your data/ is never
+touched.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from bench import git_commit
+
+# Built-in scripted users, replayed when no transcript files are given
+SCRIPTS = [
+    {
+        "id": "steady",
+        "messages": [
+            "Hi, I want to lose some weight",
+            {"text": "About 30 lbs", "updates": {"target_weight": "30 lbs less"}},
+            "Maybe by summer",
+            {"text": "I'm 5'10 and 210 lbs", "updates": {"height": "5'10\"", "current_weight": "210 lbs"}},
+            "None",
+            "ok",
+            {"text": "Diet and exercise", "updates": {"chosen_strategies": ["diet", "exercise"]}},
+            "I drink a lot of soda, I could cut that",
+            "I like walking, 3 times a week",
+            {"text": "Looks good", "updates": {"plan": "Cut soda, walk 3x/week, 1700 kcal/day"}},
+            {"text": "Work travel", "updates": {"barriers": ["travels for work"]}},
+            "That works",
+            "Yes, I'm ready",
+        ],
+    },
+    {
+        "id": "upfront",
+        "messages": [
+            {"text": "I'm 6ft, 260 lbs and want to get to 200 by next year. I have type 2 diabetes.",
+             "updates": {"height": "6ft", "current_weight": "260 lbs", "target_weight": "200 lbs",
+                         "target_date": "next year", "conditions": ["type 2 diabetes"]}},
+            "What would you recommend?",
+            {"text": "Diet only for now", "updates": {"chosen_strategies": ["diet"]}},
+            "I snack a lot at night",
+            {"text": "Sounds good", "updates": {"plan": "1900 kcal/day, no snacks after 8pm"}},
+            "Stress at work",
+            "Yes",
+            {"text": "Let's do it", "updates": {"committed": True}},
+        ],
+        "replies": [
+            "That's a realistic goal for next year. Would you like to focus on diet, exercise, or both?",
+            "With type 2 diabetes, a steady calorie deficit is a safe start. Diet, exercise, or both?",
+            "Good choice. What does a typical day of eating look like?",
+            "Here's your plan: 1900 kcal/day and no snacks after 8pm. How does that look?",
+            "What might get in the way of sticking to it?",
+            "Planning a simple dinner ahead helps on stressful days. Does that work for you?",
+            "Are you ready to start this tomorrow?",
+            "Great, we start tomorrow. Check in any time.",
+        ],
+    },
+    {
+        "id": "drifter",
+        "messages": [
+            "hey",
+            "I just want to feel better",
+            {"text": "Maybe 15 pounds", "updates": {"target_weight": "15 lbs less"}},
+            "I don't know my weight exactly",
+            "What should I eat for breakfast?",
+            "Do you have any recipes?",
+            "I'll check later",
+        ],
+    },
+]
+
+STAGES_WITH_PLAN = ("commitment", "ongoing")
+
+# Set in each worker process by _init_worker
+_worker: dict = {}
+
+
+def _message(entry) -> dict:
+    return {"text": entry, "updates": None} if isinstance(entry, str) else {"updates": None, **entry}
+
+
+def _from_turns(transcript_id: str, turns: list[dict]) -> dict:
+    """A recorded conversation as a transcript: runs of user turns are one message, the next reply its reply."""
+    messages, replies, pending = [], [], []
+    for turn in turns:
+        if turn["role"] == "user":
+            pending.append(turn["content"])
+            continue
+        if pending:
+            messages.append(_message("\n\n".join(pending)))
+            replies.append(turn["content"])
+            pending = []
+    if pending:
+        messages.append(_message("\n\n".join(pending)))
+    return {"id": transcript_id, "messages": messages, "replies": replies, "variant": None}
+
+
+def load_transcripts(paths: list[str]) -> list[dict]:
+    """Scripted and recorded transcripts from JSONL files, or the built-in scripts."""
+    def scripted(record: dict, default_id: str) -> dict:
+        return {
+            "id": record.get("id") or default_id,
+            "messages": [_message(m) for m in record["messages"]],
+            "replies": record.get("replies") or [],
+            "variant": record.get("variant"),
+        }
+
+    if not paths:
+        return [scripted(record, "") for record in SCRIPTS]
+
+    transcripts = []
+    for path in paths:
+        records = [json.loads(line) for line in Path(path).read_text().splitlines() if line.strip()]
+        if records and "role" in records[0]:
+            transcripts.append(_from_turns(Path(path).stem, records))
+            continue
+        transcripts += [scripted(record, f"{Path(path).stem}-{n}") for n, record in enumerate(records, 1)]
+    return transcripts
+
+
+class ScriptedModel:
+    """Deterministic replies for FakeAnthropic, with simulated latency per chat call.
+
+    Chat calls (those with a system prompt) get the transcript's replies in turn,
+    then the fake server's default. Extraction calls get the merged scripted
+    updates of the messages they cover, or "null".
+    """
+
+    def __init__(self, ttft: float, prefill: float, token_latency: float):
+        self.ttft = ttft                    # seconds before the first token
+        self.prefill = prefill              # seconds per input token
+        self.token_latency = token_latency  # seconds per output token
+        self.start([], [])
+
+    def start(self, replies: list[str], messages: list[dict]):
+        self.replies = list(replies)
+        self.updates = {m["text"]: m["updates"] for m in messages if m["updates"]}
+        self.latencies: list[float] = []
+
+    def __call__(self, body: dict) -> str:
+        from fake_anthropic import DEFAULT_REPLY, build_message
+        if not body.get("system"):
+            prompt = body["messages"][0]["content"]
+            merged = {}
+            for text, updates in self.updates.items():
+                if f"User said: {text}\n" in prompt:
+                    merged.update(updates)
+            return json.dumps(merged) if merged else "null"
+        reply = self.replies.pop(0) if self.replies else DEFAULT_REPLY
+        usage = build_message(body, reply)["usage"]
+        self.latencies.append(self.ttft + usage["input_tokens"] * self.prefill
+                              + usage["output_tokens"] * self.token_latency)
+        return reply
+
+
+def _init_worker(data_root: str, ttft: float, prefill: float, token_latency: float):
+    # Point every module at this worker's scratch data directory before they import config
+    os.environ["NORI_DATA_ROOT"] = tempfile.mkdtemp(dir=data_root)
+    os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+    import assistant
+    from fake_anthropic import FakeAnthropic
+    model = ScriptedModel(ttft, prefill, token_latency)
+    assistant.client = FakeAnthropic(responder=model)
+    _worker["model"] = model
+
+
+def replay_one(job: tuple[dict, str]) -> dict:
+    """Run one transcript under one variant in this worker."""
+    import assistant
+    from playbooks import playbook_stage
+    from session_state import get_session
+    from storage import get_storage
+    from user_profile import load_profile
+
+    transcript, variant = job
+    replies = transcript["replies"]
+    if isinstance(replies, dict):
+        replies = replies.get(variant) or []
+    model = _worker["model"]
+    model.start(replies, transcript["messages"])
+    user_id = f"replay-{variant}-{transcript['id']}"
+    avoided = assistant.extraction_stats["calls_avoided"]
+
+    stage, turns_to_plan = None, None
+    for turn, message in enumerate(transcript["messages"], 1):
+        assistant.chat(user_id, message["text"], variant)
+        assistant.flush_profile_updates(user_id)
+        stage = playbook_stage(load_profile(user_id), get_session(user_id)["plan_turns"])
+        if turns_to_plan is None and stage in STAGES_WITH_PLAN:
+            turns_to_plan = turn
+
+    routes = get_storage().usage_totals(user_id)["routes"]
+    chat_routes = [counts for route, counts in routes.items() if route.startswith("chat")]
+    return {
+        "transcript": transcript["id"],
+        "variant": variant,
+        "turns": len(transcript["messages"]),
+        "turns_to_plan": turns_to_plan,
+        "final_stage": stage,
+        "prompt_tokens": sum(counts["input"] for counts in chat_routes),
+        "output_tokens": sum(counts["output"] for counts in chat_routes),
+        "extraction_calls": routes.get("extraction", {}).get("calls", 0),
+        "extractions_local": assistant.extraction_stats["calls_avoided"] - avoided,
+        "summary_calls": routes.get("summary", {}).get("calls", 0),
+        "latency": [round(seconds, 4) for seconds in model.latencies],
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+
+def aggregate(results: list[dict]) -> dict:
+    """Per-variant totals and averages."""
+    by_variant: dict[str, list[dict]] = {}
+    for r in results:
+        by_variant.setdefault(r["variant"], []).append(r)
+
+    summary = {}
+    for variant, runs in by_variant.items():
+        turns = sum(r["turns"] for r in runs)
+        latencies = sorted(s for r in runs for s in r["latency"])
+        reached = [r["turns_to_plan"] for r in runs if r["turns_to_plan"] is not None]
+        summary[variant] = {
+            "transcripts": len(runs),
+            "turns": turns,
+            "plans_reached": len(reached),
+            "turns_to_plan": round(statistics.fmean(reached), 2) if reached else None,
+            "prompt_tokens": sum(r["prompt_tokens"] for r in runs),
+            "prompt_tokens_per_turn": round(sum(r["prompt_tokens"] for r in runs) / turns, 1) if turns else 0,
+            "output_tokens": sum(r["output_tokens"] for r in runs),
+            "latency_p50": round(_percentile(latencies, 0.5), 3),
+            "latency_p95": round(_percentile(latencies, 0.95), 3),
+            "latency_total": round(sum(latencies), 2),
+            "extraction_calls": sum(r["extraction_calls"] for r in runs),
+            "extractions_local": sum(r["extractions_local"] for r in runs),
+            "summary_calls": sum(r["summary_calls"] for r in runs),
+        }
+    return summary
+
+
+def print_report(summary: dict):
+    print(f"{'variant':<10} {'runs':>5} {'turns':>6} {'to plan':>12} {'prompt tok':>11} {'tok/turn':>9} "
+          f"{'lat p50':>8} {'lat p95':>8} {'extract':>8} {'local':>6}")
+    for variant, s in summary.items():
+        to_plan = f"{s['turns_to_plan']} ({s['plans_reached']}/{s['transcripts']})" if s["plans_reached"] else "-"
+        print(f"{variant:<10} {s['transcripts']:>5} {s['turns']:>6} {to_plan:>12} {s['prompt_tokens']:>11} "
+              f"{s['prompt_tokens_per_turn']:>9} {s['latency_p50']:>7.2f}s {s['latency_p95']:>7.2f}s "
+              f"{s['extraction_calls']:>8} {s['extractions_local']:>6}")
+
+
+def compare(summary: dict, baseline_path: str):
+    """Print each variant's aggregates against a previous run."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('commit') or 'unknown commit'}):")
+    for variant, s in summary.items():
+        old = baseline["summary"].get(variant)
+        if not old:
+            continue
+        for key in ("turns_to_plan", "prompt_tokens_per_turn", "latency_p50", "latency_p95", "extraction_calls"):
+            if s[key] == old.get(key):
+                continue
+            change = ""
+            if isinstance(s[key], (int, float)) and old.get(key):
+                change = f"  {s[key] / old[key] - 1:+.1%}"
+            print(f"  {variant:<10} {key:<24} {old.get(key)} -> {s[key]}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay transcripts under each prompt variant against a fake model")
+    parser.add_argument("transcripts", nargs="*", help="JSONL transcript files (default: built-in scripts)")
+    parser.add_argument("--variants", nargs="+", help="variants to run (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--ttft", type=float, default=0.4, help="simulated seconds before the first token")
+    parser.add_argument("--prefill", type=float, default=0.0002, help="simulated seconds per input token")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="simulated seconds per output token")
+    parser.add_argument("--output", help="write per-transcript results and aggregates as JSON here")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    # Scratch data for every process; the workers each get a directory of their own
+    data_root = tempfile.mkdtemp(prefix="nori-replay-")
+    os.environ["NORI_DATA_ROOT"] = os.path.join(data_root, "main")
+    os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+    from assistant import VARIANTS
+
+    variants = args.variants or list(VARIANTS)
+    unknown = [v for v in variants if v not in VARIANTS]
+    if unknown:
+        parser.error(f"unknown variant {', '.join(unknown)}; choose from {', '.join(VARIANTS)}")
+    transcripts = load_transcripts(args.transcripts)
+    jobs = [(t, v) for v in variants for t in transcripts if t["variant"] in (None, v)]
+
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs))),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(data_root, args.ttft, args.prefill, args.token_latency)) as pool:
+            results = list(pool.map(replay_one, jobs))
+    finally:
+        shutil.rmtree(data_root, ignore_errors=True)
+    print(f"Replayed {len(transcripts)} transcripts x {len(variants)} variants "
+          f"in {time.perf_counter() - started:.1f}s\n")
+
+    summary = aggregate(results)
+    print_report(summary)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "timestamp": datetime.now().isoformat(),
+                "python": sys.version.split()[0],
+                "transcripts": [t["id"] for t in transcripts],
+                "ttft": args.ttft,
+                "prefill": args.prefill,
+                "token_latency": args.token_latency,
+            },
+            "summary": summary,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+    if args.compare:
+        compare(summary, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+"""
+Resilient calls to the Messages API.
+
+Every model call goes through a ModelCaller, which adds:
+
+- a deadline per task (chat, extraction, summary) covering every attempt;
+- retries with jittered exponential backoff on rate limits, overload, 5xx and
+  connection errors, honouring retry-after when it fits in the deadline;
+- hedging for selected tasks: if the first request has produced no token (or,
+  without streaming, no response) by the recent p95, an identical second
+  request is sent and whichever answers first is used;
+- a circuit breaker over recent attempts. Background tasks (extraction,
+  summaries) are shed first, as soon as failures start to rise; chat only
+  fails fast once most attempts fail, until a trial call succeeds.
+
+The SDK clients are created with max_retries=0 so retries happen here only.
+"""
+
+import asyncio
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+import anthropic
+
+RETRYABLE = (anthropic.RateLimitError, anthropic.OverloadedError, anthropic.ServiceUnavailableError,
+             anthropic.InternalServerError, anthropic.APIConnectionError)
+BACKGROUND_TASKS = ("extraction", "summary")
+
+
+class ModelUnavailableError(Exception):
+    """The model was not called (circuit breaker) or didn't answer within the deadline."""
+
+
+class CircuitBreaker:
+    """Failure-rate breaker over the last `window` attempts, with a degraded stage for background work."""
+
+    CLOSED, DEGRADED, OPEN = "closed", "degraded", "open"
+
+    def __init__(self, window: int = 20, degrade_rate: float = 0.25, open_rate: float = 0.5,
+                 cooldown: float = 30.0, min_calls: int = 5):
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.degrade_rate = degrade_rate
+        self.open_rate = open_rate
+        self.cooldown = cooldown
+        self.min_calls = min_calls
+        self.opens = 0
+        self._opened_at: Optional[float] = None
+        self._probe_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _failure_rate(self) -> float:
+        if len(self.outcomes) < self.min_calls:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is not None:
+                return self.OPEN
+            return self.DEGRADED if self._failure_rate() >= self.degrade_rate else self.CLOSED
+
+    def allow(self, background: bool) -> bool:
+        """Whether a call may go out now."""
+        with self._lock:
+            if self._opened_at is not None:
+                now = time.monotonic()
+                if background or now - self._opened_at < self.cooldown:
+                    return False
+                if self._probe_at is not None and now - self._probe_at < self.cooldown:
+                    return False
+                self._probe_at = now  # half-open: one foreground call decides
+                return True
+            return not (background and self._failure_rate() >= self.degrade_rate)
+
+    def record(self, ok: bool):
+        with self._lock:
+            if self._opened_at is not None:
+                if ok:
+                    self._opened_at = None
+                    self.outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+                self._probe_at = None
+                return
+            self.outcomes.append(ok)
+            if self._failure_rate() >= self.open_rate:
+                self._opened_at = time.monotonic()
+                self.opens += 1
+
+
+class LatencyWindow:
+    """Recent latencies of one task, for the hedging threshold."""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+class ModelCaller:
+    """Deadlines, retries, hedging and a circuit breaker around client.messages.create/stream."""
+
+    def __init__(self, deadlines: dict, max_retries: int = 2, retry_base_delay: float = 0.5,
+                 hedge_tasks: tuple = (), hedge_percentile: float = 95, hedge_min_delay: float = 1.0,
+                 hedge_min_samples: int = 20, breaker: Optional[CircuitBreaker] = None):
+        self.deadlines = deadlines
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.hedge_tasks = hedge_tasks
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latency: dict[str, LatencyWindow] = {}
+        self.stats = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "deadline_exceeded": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "shed": 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    # -- Policy --
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _window(self, task: str) -> LatencyWindow:
+        window = self.latency.get(task)
+        if window is None:
+            window = self.latency.setdefault(task, LatencyWindow())
+        return window
+
+    def _admit(self, task: str):
+        if not self.breaker.allow(task in BACKGROUND_TASKS):
+            self._count("shed")
+            raise ModelUnavailableError(f"Model calls for {task} are paused (circuit {self.breaker.state()})")
+        self._count("calls")
+
+    @staticmethod
+    def _key(task: str, kwargs: dict, suffix: str = "") -> str:
+        """Latency window key; models on the same task have their own latency profile."""
+        return f"{task}{suffix}:{kwargs.get('model')}"
+
+    def _hedge_delay(self, task: str, key: str) -> Optional[float]:
+        """Seconds to wait for the first request before hedging, or None to not hedge."""
+        if task not in self.hedge_tasks or self.breaker.state() != CircuitBreaker.CLOSED:
+            return None  # hedging adds load; never do it while the upstream is struggling
+        p = self._window(key).percentile(self.hedge_percentile, self.hedge_min_samples)
+        return None if p is None else max(p, self.hedge_min_delay)
+
+    def _remaining(self, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._failed()
+            self._count("deadline_exceeded")
+            raise ModelUnavailableError("Model call deadline exceeded")
+        return remaining
+
+    def _failed(self):
+        self.breaker.record(False)
+        self._count("failures")
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """Seconds to sleep before retrying, or None if there's no attempt or time left."""
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, self.retry_base_delay * 2 ** attempt)
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", "")))
+            except ValueError:
+                pass
+        if time.monotonic() + delay >= deadline:
+            return None
+        self._count("retries")
+        return delay
+
+    def _succeeded(self, key: str, seconds: float, hedged_winner: Optional[int] = None):
+        self.breaker.record(True)
+        self._window(key).observe(seconds)
+        if hedged_winner == 1:
+            self._count("hedge_wins")
+
+    # -- Sync --
+
+    def create(self, client, task: str, **kwargs):
+        """client.messages.create with the task's deadline, retries, hedging and breaker."""
+        deadline = time.monotonic() + self.deadlines[task]
+        for attempt in range(self.max_retries + 1):
+            self._admit(task)
+            started = time.monotonic()
+            try:
+                response, winner = self._create_once(client, task, kwargs, deadline)
+            except RETRYABLE as e:
+                self._failed()
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise ModelUnavailableError(f"Model call for {task} failed: {e}") from e
+                time.sleep(delay)
+                continue
+            self._succeeded(self._key(task, kwargs), time.monotonic() - started, winner)
+            return response
+
+    def _create_once(self, client, task: str, kwargs: dict, deadline: float):
+        timeout = self._remaining(deadline)
+        hedge_delay = self._hedge_delay(task, self._key(task, kwargs))
+        if hedge_delay is None or hedge_delay >= timeout:
+            return client.messages.create(timeout=timeout, **kwargs), 0
+
+        results: queue.Queue = queue.Queue()
+
+        def run(index: int):
+            try:
+                results.put((index, client.messages.create(timeout=timeout, **kwargs), None))
+            except Exception as e:
+                results.put((index, None, e))
+
+        threading.Thread(target=run, args=(0,), daemon=True).start()
+        started = 1
+        error = None
+        while True:
+            wait = hedge_delay if started == 1 and error is None else self._remaining(deadline)
+            try:
+                index, response, e = results.get(timeout=wait)
+            except queue.Empty:
+                if started == 1 and error is None:
+                    self._count("hedges")
+                    threading.Thread(target=run, args=(1,), daemon=True).start()
+                    started = 2
+                    continue
+                self._remaining(deadline)
+                continue
+            if e is None:
+                return response, index  # the slower request finishes in the background
+            error = error or e
+            started -= 1
+            if started == 0:
+                raise error
+
+    def stream(self, client, task: str, **kwargs) -> "ResilientStream":
+        """client.messages.stream with the task's deadline, retries, hedging and breaker.
+
+        Retries and hedges only happen before the first token; once text has
+        been yielded, errors propagate.
+        """
+        return ResilientStream(self, client, task, kwargs)
+
+    def _stream_events(self, client, task: str, kwargs: dict, deadline: float):
+        """Yield ("text", chunk) and finally ("final", message) from one attempt, hedged if slow."""
+        timeout = self._remaining(deadline)
+        hedge_delay = self._hedge_delay(task, self._key(task, kwargs, "_ttft"))
+        if hedge_delay is None or hedge_delay >= timeout:
+            with client.messages.stream(timeout=timeout, **kwargs) as stream:
+                for text in stream.text_stream:
+                    yield "text", text
+                yield "final", stream.get_final_message()
+            return
+
+        events: queue.Queue = queue.Queue()
+        cancelled = [False, False]
+
+        def run(index: int):
+            try:
+                with client.messages.stream(timeout=timeout, **kwargs) as stream:
+                    for text in stream.text_stream:
+                        if cancelled[index]:
+                            return
+                        events.put((index, "text", text))
+                    events.put((index, "final", stream.get_final_message()))
+            except Exception as e:
+                events.put((index, "error", e))
+
+        threading.Thread(target=run, args=(0,), daemon=True).start()
+        running, hedged, winner, error = 1, False, None, None
+        try:
+            while True:
+                wait = hedge_delay if not hedged and winner is None else self._remaining(deadline)
+                try:
+                    index, kind, value = events.get(timeout=wait)
+                except queue.Empty:
+                    if not hedged and winner is None:
+                        hedged = True
+                        running += 1
+                        self._count("hedges")
+                        threading.Thread(target=run, args=(1,), daemon=True).start()
+                    continue
+                if winner is None and kind != "error":
+                    winner = index
+                    cancelled[1 - index] = True
+                    yield "winner", index
+                if index != winner:
+                    if kind == "error":
+                        error = error or value
+                        running -= 1
+                        if running == 0:
+                            raise error
+                    continue
+                if kind == "error":
+                    raise value
+                yield kind, value
+                if kind == "final":
+                    return
+        finally:
+            cancelled[0] = cancelled[1] = True
+
+    # -- Async --
+
+    async def acreate(self, client, task: str, **kwargs):
+        """Async version of create, for AsyncAnthropic clients."""
+        deadline = time.monotonic() + self.deadlines[task]
+        for attempt in range(self.max_retries + 1):
+            self._admit(task)
+            started = time.monotonic()
+            try:
+                response, winner = await self._acreate_once(client, task, kwargs, deadline)
+            except RETRYABLE as e:
+                self._failed()
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise ModelUnavailableError(f"Model call for {task} failed: {e}") from e
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(self._key(task, kwargs), time.monotonic() - started, winner)
+            return response
+
+    async def _acreate_once(self, client, task: str, kwargs: dict, deadline: float):
+        timeout = self._remaining(deadline)
+        hedge_delay = self._hedge_delay(task, self._key(task, kwargs))
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await client.messages.create(timeout=timeout, **kwargs), 0
+
+        tasks = [asyncio.ensure_future(client.messages.create(timeout=timeout, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                self._count("hedges")
+                tasks.append(asyncio.ensure_future(client.messages.create(timeout=timeout, **kwargs)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self._remaining(deadline),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        return finished.result(), tasks.index(finished)
+            raise next(t.exception() for t in tasks if t.done() and t.exception())
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def astream(self, client, task: str, **kwargs) -> "AsyncResilientStream":
+        """Async version of stream."""
+        return AsyncResilientStream(self, client, task, kwargs)
+
+    async def _astream_events(self, client, task: str, kwargs: dict, deadline: float):
+        timeout = self._remaining(deadline)
+        hedge_delay = self._hedge_delay(task, self._key(task, kwargs, "_ttft"))
+        if hedge_delay is None or hedge_delay >= timeout:
+            async with client.messages.stream(timeout=timeout, **kwargs) as stream:
+                async for text in stream.text_stream:
+                    yield "text", text
+                yield "final", await stream.get_final_message()
+            return
+
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def run(index: int):
+            try:
+                async with client.messages.stream(timeout=timeout, **kwargs) as stream:
+                    async for text in stream.text_stream:
+                        await events.put((index, "text", text))
+                    await events.put((index, "final", await stream.get_final_message()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await events.put((index, "error", e))
+
+        runners = [asyncio.ensure_future(run(0))]
+        winner, error, failed = None, None, 0
+        try:
+            while True:
+                hedging = len(runners) == 1 and winner is None
+                try:
+                    index, kind, value = await asyncio.wait_for(
+                        events.get(), hedge_delay if hedging else self._remaining(deadline))
+                except asyncio.TimeoutError:
+                    if hedging:
+                        self._count("hedges")
+                        runners.append(asyncio.ensure_future(run(1)))
+                    continue
+                if winner is None and kind != "error":
+                    winner = index
+                    for i, runner in enumerate(runners):
+                        if i != index:
+                            runner.cancel()
+                    yield "winner", index
+                if index != winner:
+                    if kind == "error":
+                        error = error or value
+                        failed += 1
+                        if failed == len(runners):
+                            raise error
+                    continue
+                if kind == "error":
+                    raise value
+                yield kind, value
+                if kind == "final":
+                    return
+        finally:
+            for runner in runners:
+                runner.cancel()
+
+
+class ResilientStream:
+    """Drop-in for the SDK's MessageStream: `text_stream` and `get_final_message()`."""
+
+    def __init__(self, caller: ModelCaller, client, task: str, kwargs: dict):
+        self._caller = caller
+        self._client = client
+        self._task = task
+        self._kwargs = kwargs
+        self._final = None
+        self.time_to_first_token: Optional[float] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        caller = self._caller
+        deadline = time.monotonic() + caller.deadlines[self._task]
+        for attempt in range(caller.max_retries + 1):
+            caller._admit(self._task)
+            started = time.monotonic()
+            winner = 0
+            try:
+                for kind, value in caller._stream_events(self._client, self._task, self._kwargs, deadline):
+                    if kind == "winner":
+                        winner = value
+                    elif kind == "text":
+                        if self.time_to_first_token is None:
+                            self.time_to_first_token = time.monotonic() - started
+                        yield value
+                    else:
+                        self._final = value
+            except RETRYABLE as e:
+                caller._failed()
+                delay = None if self.time_to_first_token is not None else caller._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise ModelUnavailableError(f"Model call for {self._task} failed: {e}") from e
+                time.sleep(delay)
+                continue
+            caller._succeeded(caller._key(self._task, self._kwargs, "_ttft"),
+                              self.time_to_first_token or time.monotonic() - started, winner)
+            return
+
+    def get_final_message(self):
+        return self._final
+
+
+class AsyncResilientStream:
+    """Drop-in for the SDK's AsyncMessageStream."""
+
+    def __init__(self, caller: ModelCaller, client, task: str, kwargs: dict):
+        self._caller = caller
+        self._client = client
+        self._task = task
+        self._kwargs = kwargs
+        self._final = None
+        self.time_to_first_token: Optional[float] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        caller = self._caller
+        deadline = time.monotonic() + caller.deadlines[self._task]
+        for attempt in range(caller.max_retries + 1):
+            caller._admit(self._task)
+            started = time.monotonic()
+            winner = 0
+            try:
+                async for kind, value in caller._astream_events(self._client, self._task, self._kwargs, deadline):
+                    if kind == "winner":
+                        winner = value
+                    elif kind == "text":
+                        if self.time_to_first_token is None:
+                            self.time_to_first_token = time.monotonic() - started
+                        yield value
+                    else:
+                        self._final = value
+            except RETRYABLE as e:
+                caller._failed()
+                delay = None if self.time_to_first_token is not None else caller._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise ModelUnavailableError(f"Model call for {self._task} failed: {e}") from e
+                await asyncio.sleep(delay)
+                continue
+            caller._succeeded(caller._key(self._task, self._kwargs, "_ttft"),
+                              self.time_to_first_token or time.monotonic() - started, winner)
+            return
+
+    async def get_final_message(self):
+        return self._final
@@ -0,0 +1,49 @@
+"""
+Per-call model routing.
+
+Every model call names a route, and config.MODEL_ROUTES gives the route's model
+and max_tokens. Chat turns are routed by where the user is in the variant's
+steps: intake questions go to the fast model, the steps from feasibility to
+commitment (where the plan is built) to the large one, and ongoing coaching to
+the default. Latency and token usage are recorded per route for /metrics, and
+usage is stored per user for quotas (see usage.py).
+"""
+
+from typing import Optional
+import metrics
+from config import MODEL_ROUTES
+from usage import record_usage, usage_counts
+
+# Profile fields collected during intake; the plan can't be built until they're known
+INTAKE_FIELDS = ("target_weight", "height", "current_weight")
+
+
+def chat_route(profile: dict) -> str:
+    """The route for the user's next chat turn, from their profile."""
+    if any(profile.get(field) is None for field in INTAKE_FIELDS):
+        return "chat_intake"
+    if profile.get("committed") is None:
+        return "chat_plan"
+    return "chat"
+
+
+def route_params(route: str, variant: Optional[str] = None) -> dict:
+    """Model and max_tokens for a route, with any per-variant override applied."""
+    params = MODEL_ROUTES.get(f"{variant}:{route}") if variant else None
+    return dict(params or MODEL_ROUTES[route])
+
+
+def record_call(route: str, model: str, seconds: float, usage, ttft: Optional[float] = None,
+                user_id: Optional[str] = None, variant: Optional[str] = None):
+    """Record one completed model call's latency and token usage under its route (and user)."""
+    labels = {"route": route, "model": model}
+    metrics.observe("nori_model_route_seconds", seconds, **labels)
+    if ttft is not None:
+        metrics.observe("nori_model_route_ttft_seconds", ttft, **labels)
+    metrics.increment("nori_model_route_calls_total", **labels)
+    for kind, count in usage_counts(usage).items():
+        metrics.increment("nori_model_route_tokens_total", count, kind=kind, **labels)
+        if variant is not None:
+            metrics.increment("nori_variant_tokens_total", count, kind=kind, variant=variant)
+    if user_id is not None:
+        record_usage(user_id, route, model, variant, usage)
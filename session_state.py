@@ -0,0 +1,75 @@
+"""
+Per-user session state shared across worker processes.
+
+State lives in the storage backend (session.json or the SQLite sessions
+table), so every gunicorn worker sees the same active variant. Each process
+keeps a small read cache that is revalidated with the backend's version stamp.
+Updates hold the user's "session" lock, so concurrent workers don't drop writes.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from config import SESSION_CACHE_SIZE
+from storage import get_storage
+from turns import user_locks
+
+DEFAULT_SESSION = {
+    "variant": None,            # active prompt variant; None means the default
+    "greeting_seeded": False,   # has the variant greeting been shown for this conversation?
+    "last_activity": None,      # ISO timestamp of the last request
+    "plan_turns": 0,            # chat turns answered in the playbook's plan stage
+}
+
+_cache: OrderedDict[str, tuple] = OrderedDict()   # user_id -> (version, state)
+_lock = threading.Lock()
+
+
+def get_session(user_id: str) -> dict:
+    """Return the user's session state."""
+    storage = get_storage()
+    version = storage.session_version(user_id)
+    with _lock:
+        cached = _cache.get(user_id)
+        if cached and version is not None and cached[0] == version:
+            _cache.move_to_end(user_id)
+            return dict(cached[1])
+
+    state = dict(DEFAULT_SESSION)
+    state.update(storage.load_session(user_id))
+    _remember(user_id, version, state)
+    return dict(state)
+
+
+def update_session(user_id: str, **changes) -> dict:
+    """Update fields of the user's session state and return the new state."""
+    with user_locks.hold(user_id, "session"):
+        state = get_session(user_id)
+        state.update(changes)
+        storage = get_storage()
+        storage.save_session(user_id, state)
+        _remember(user_id, storage.session_version(user_id), state)
+    return dict(state)
+
+
+def touch_session(user_id: str, **changes) -> dict:
+    """Record activity for the user, along with any other changes."""
+    return update_session(user_id, last_activity=datetime.now().isoformat(), **changes)
+
+
+def clear_session(user_id: str):
+    """Reset the user's session state to defaults."""
+    with user_locks.hold(user_id, "session"):
+        storage = get_storage()
+        storage.save_session(user_id, dict(DEFAULT_SESSION))
+        _remember(user_id, storage.session_version(user_id), dict(DEFAULT_SESSION))
+
+
+def _remember(user_id: str, version, state: dict):
+    if version is None:
+        return
+    with _lock:
+        _cache[user_id] = (version, dict(state))
+        _cache.move_to_end(user_id)
+        while len(_cache) > SESSION_CACHE_SIZE:
+            _cache.popitem(last=False)
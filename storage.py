@@ -0,0 +1,1059 @@
+#!/usr/bin/env python3
+"""
+Storage backends for conversations, summaries, profiles and session state.
+
+The JSON-file backend keeps one directory per user under config.DATA_DIR.
+The SQLite backend keeps everything in one WAL-mode database that several
+gunicorn workers can share safely. Pick one with config.STORAGE_BACKEND.
+
+Token usage is stored per model call, with running totals per user by day,
+call site (route) and variant for quotas and reporting.
+
+Only the active conversation segment is read on the hot path. Closed segments
+(after /new, /reset, or once already-summarized turns pile up) are moved into
+gzip-compressed archive segments, listed in a per-user manifest.
+
+    python storage.py shard              # move flat data/users/<id> dirs into the sharded layout
+    python storage.py migrate            # import data/users/* into SQLite
+    python storage.py archives USER_ID   # list archived segments
+    python storage.py export USER_ID     # archived and active turns as JSONL (--summary: the rolling summary)
+    python storage.py usage [USER_ID]    # token totals for a user, or per variant for everyone
+"""
+
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import struct
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+from config import DATA_DIR, SQLITE_PATH, SQLITE_POOL_SIZE, STORAGE_BACKEND, USER_DIR_CACHE_SIZE
+
+# Token counts kept per model call, as reported in the API's usage fields
+USAGE_KINDS = ("input", "output", "cache_read", "cache_write")
+
+
+class StorageBackend:
+    """Interface shared by all storage backends."""
+
+    # -- Conversations --
+
+    def append_turn(self, user_id: str, turn: dict):
+        raise NotImplementedError
+
+    def load_turns(self, user_id: str) -> list[dict]:
+        raise NotImplementedError
+
+    def recent_turns(self, user_id: str, limit: int) -> list[dict]:
+        raise NotImplementedError
+
+    def count_turns(self, user_id: str) -> int:
+        raise NotImplementedError
+
+    def turns_range(self, user_id: str, start: int, end: int) -> list[dict]:
+        """Return turns[start:end] in chronological order."""
+        raise NotImplementedError
+
+    def clear_turns(self, user_id: str):
+        raise NotImplementedError
+
+    # -- Archived segments --
+
+    def archive_turns(self, user_id: str, count: Optional[int] = None, reason: str = "") -> Optional[dict]:
+        """Move the oldest `count` turns (default: all) into a compressed archive segment.
+
+        Returns the segment's manifest entry, or None if there was nothing to archive.
+        """
+        raise NotImplementedError
+
+    def list_archives(self, user_id: str) -> list[dict]:
+        """Manifest entries for the user's archived segments, oldest first."""
+        raise NotImplementedError
+
+    def load_archive(self, user_id: str, segment_id: str) -> list[dict]:
+        """Return the turns of one archived segment."""
+        raise NotImplementedError
+
+    # -- Rolling summary --
+
+    def load_summary(self, user_id: str) -> Optional[dict]:
+        """Return the summary of turns that left the history window, or None."""
+        raise NotImplementedError
+
+    def save_summary(self, user_id: str, summary: dict):
+        raise NotImplementedError
+
+    def clear_summary(self, user_id: str):
+        raise NotImplementedError
+
+    # -- Profiles --
+
+    def load_profile(self, user_id: str) -> Optional[dict]:
+        """Return the saved profile, or None if the user has none."""
+        raise NotImplementedError
+
+    def save_profile(self, user_id: str, profile: dict):
+        raise NotImplementedError
+
+    def profile_version(self, user_id: str):
+        """Return a cheap stamp that changes whenever the saved profile changes.
+
+        Used to validate cached profiles without re-reading them. None means
+        the backend can't tell, and callers should reload.
+        """
+        return None
+
+    # -- Session state --
+
+    def load_session(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    def save_session(self, user_id: str, state: dict):
+        raise NotImplementedError
+
+    def session_version(self, user_id: str):
+        """Like profile_version, for session state."""
+        return None
+
+    # -- Token usage --
+
+    def record_usage(self, user_id: str, record: dict):
+        """Store one model call's usage and add it to the user's totals.
+
+        A record has ts, day (UTC, YYYY-MM-DD), route, model, variant and a count per USAGE_KINDS.
+        """
+        raise NotImplementedError
+
+    def usage_records(self, user_id: str) -> list[dict]:
+        """Every usage record for the user, oldest first."""
+        raise NotImplementedError
+
+    def usage_totals(self, user_id: str) -> dict:
+        """Totals as {"total": counts, "days": {day: counts}, "routes": {...}, "variants": {...}}."""
+        raise NotImplementedError
+
+    def usage_on_day(self, user_id: str, day: str) -> dict:
+        """Counts (calls and USAGE_KINDS) for one UTC day."""
+        return self.usage_totals(user_id)["days"].get(day) or _usage_counts()
+
+    # -- Users --
+
+    def list_users(self) -> list[str]:
+        raise NotImplementedError
+
+
+def _atomic_write(path: Path, data: bytes):
+    """Write a file via a temp file and rename so readers never see a partial write."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def _usage_counts() -> dict:
+    return dict.fromkeys(("calls",) + USAGE_KINDS, 0)
+
+
+def _add_usage(totals: dict, record: dict) -> dict:
+    """Add a usage record (or a pre-summed group with a "calls" count) into totals."""
+    for group, key in (("total", None), ("days", "day"), ("routes", "route"), ("variants", "variant")):
+        if key is None:
+            counts = totals.setdefault(group, _usage_counts())
+        else:
+            counts = totals.setdefault(group, {}).setdefault(str(record.get(key)), _usage_counts())
+        counts["calls"] += record.get("calls", 1)
+        for kind in USAGE_KINDS:
+            counts[kind] += record.get(kind, 0)
+    return totals
+
+
+def _segment_entry(segment_id: str, first: dict, last: dict, turns: int,
+                   compressed: bytes, raw_bytes: int, reason: str) -> dict:
+    """Manifest entry describing one archived segment."""
+    return {
+        "id": segment_id,
+        "started": first.get("timestamp"),
+        "ended": last.get("timestamp"),
+        "turns": turns,
+        "bytes": len(compressed),
+        "raw_bytes": raw_bytes,
+        "archived_at": datetime.now().isoformat(),
+        "reason": reason,
+    }
+
+
+class UserDirs:
+    """Per-user data directories, hash-sharded as <root>/ab/cd/<user_id>.
+
+    Paths are computed without touching the filesystem. Directories are created
+    on first write and remembered, so repeat writes skip the mkdir. Users left
+    in the old flat layout (<root>/<user_id>) are still found until
+    `python storage.py shard` has moved them; which layout each user is in is
+    looked up once and remembered, since sharding only runs offline.
+    """
+
+    def __init__(self, root: Path, cache_size: int = USER_DIR_CACHE_SIZE):
+        self.root = Path(root)
+        self.cache_size = cache_size
+        self._known: set[str] = set()
+        self._flat_users: dict[str, bool] = {}  # user -> still in the flat layout
+        self._flat: Optional[bool] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_shard(name: str) -> bool:
+        return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+    def sharded_path(self, user_id: str) -> Path:
+        digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+        return self.root / digest[:2] / digest[2:4] / user_id
+
+    def has_flat_layout(self) -> bool:
+        """True if any user directories still sit directly under the root."""
+        if self._flat is None:
+            self._flat = self.root.exists() and any(
+                p.is_dir() and not self._is_shard(p.name) for p in self.root.iterdir()
+            )
+        return self._flat
+
+    def path(self, user_id: str) -> Path:
+        """Where the user's files live. Does not create anything."""
+        if user_id in self._known or not self.has_flat_layout():
+            return self.sharded_path(user_id)
+        flat = self._flat_users.get(user_id)
+        if flat is None:
+            flat = (self.root / user_id).is_dir()
+            with self._lock:
+                if len(self._flat_users) >= self.cache_size:
+                    self._flat_users.clear()
+                self._flat_users[user_id] = flat
+        return self.root / user_id if flat else self.sharded_path(user_id)
+
+    def ensure(self, user_id: str) -> Path:
+        """The user's directory, created if this is their first write."""
+        if user_id in self._known:
+            return self.sharded_path(user_id)
+        path = self.path(user_id)
+        path.mkdir(parents=True, exist_ok=True)
+        if path.parent != self.root:
+            with self._lock:
+                if len(self._known) >= self.cache_size:
+                    self._known.clear()
+                self._known.add(user_id)
+        return path
+
+    def list_users(self) -> list[str]:
+        if not self.root.exists():
+            return []
+        users = []
+        for top in self.root.iterdir():
+            if not top.is_dir():
+                continue
+            if not self._is_shard(top.name):
+                users.append(top.name)  # flat layout
+                continue
+            for shard in top.iterdir():
+                if shard.is_dir():
+                    users.extend(p.name for p in shard.iterdir() if p.is_dir())
+        return sorted(users)
+
+    def migrate(self) -> int:
+        """Move flat user directories into their shards.
+
+        Run it with the app stopped: serving processes remember which layout
+        each user is in, and a write that already resolved the flat path would
+        land in a directory that has moved.
+        """
+        moved = 0
+        if not self.root.exists():
+            return moved
+        for flat in sorted(self.root.iterdir()):
+            if not flat.is_dir() or self._is_shard(flat.name):
+                continue
+            target = self.sharded_path(flat.name)
+            if target.exists():
+                print(f"Skipped {flat.name}: {target} already exists")
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Hold the conversation lock so no append is half-done when the directory moves
+            with open(flat / JSONFileBackend.LOCK_FILE, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                flat.rename(target)
+            moved += 1
+        self._flat = False
+        return moved
+
+
+_user_dirs: Optional[UserDirs] = None
+_user_dirs_lock = threading.Lock()
+
+
+def get_user_dirs() -> UserDirs:
+    """Return the process-wide layout of per-user directories under config.DATA_DIR."""
+    global _user_dirs
+    if _user_dirs is None:
+        with _user_dirs_lock:
+            if _user_dirs is None:
+                _user_dirs = UserDirs(DATA_DIR)
+    return _user_dirs
+
+
+class JSONFileBackend(StorageBackend):
+    """One directory of JSON files per user.
+
+    Conversations are newline-delimited JSON (one turn per line) with a sidecar
+    index of fixed-width byte offsets, so appends are O(1) and the last N turns
+    can be read by seeking from the tail. Archived segments are gzipped JSONL
+    files in archive/, described by archive/manifest.json.
+    """
+
+    LOG_FILE = "conversations.jsonl"
+    INDEX_FILE = "conversations.idx"
+    LOCK_FILE = "conversations.lock"
+    REWRITE_MARKER = "conversations.rewrite"
+    LEGACY_FILE = "conversations.json"
+    ARCHIVE_DIR = "archive"
+    MANIFEST_FILE = "manifest.json"
+    SUMMARY_FILE = "summary.json"
+    PROFILE_FILE = "profile.json"
+    SESSION_FILE = "session.json"
+    USAGE_LOG = "usage.jsonl"
+    USAGE_FILE = "usage.json"
+    USAGE_LOCK = "usage.lock"
+
+    OFFSET = struct.Struct("<Q")
+
+    def __init__(self, data_dir: Path, dirs: Optional[UserDirs] = None):
+        self.data_dir = Path(data_dir)
+        self.dirs = dirs or UserDirs(self.data_dir)
+
+    def user_dir(self, user_id: str) -> Path:
+        """The user's directory, created on first use. Write paths only."""
+        return self.dirs.ensure(user_id)
+
+    @staticmethod
+    def _encode_turn(turn: dict) -> bytes:
+        return (json.dumps(turn, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _rebuild_index(self, user_dir: Path):
+        """Rebuild the offset index by scanning the log."""
+        offsets = bytearray()
+        log_file = user_dir / self.LOG_FILE
+        if log_file.exists():
+            with open(log_file, "rb") as f:
+                pos = 0
+                for line in f:
+                    if line.strip():
+                        offsets += self.OFFSET.pack(pos)
+                    pos += len(line)
+        (user_dir / self.INDEX_FILE).write_bytes(bytes(offsets))
+
+    def _migrate_legacy(self, user_dir: Path):
+        """Convert a legacy conversations.json into the append-only log."""
+        legacy_file = user_dir / self.LEGACY_FILE
+        if not legacy_file.exists() or (user_dir / self.LOG_FILE).exists():
+            return
+
+        conversations = json.loads(legacy_file.read_text() or "[]")
+        offsets = bytearray()
+        pos = 0
+        with open(user_dir / self.LOG_FILE, "wb") as f:
+            for turn in conversations:
+                line = self._encode_turn(turn)
+                f.write(line)
+                offsets += self.OFFSET.pack(pos)
+                pos += len(line)
+        (user_dir / self.INDEX_FILE).write_bytes(bytes(offsets))
+        legacy_file.rename(user_dir / (self.LEGACY_FILE + ".bak"))
+
+    @contextmanager
+    def _log_lock(self, user_dir: Path, name: str = LOCK_FILE, shared: bool = False):
+        """Lock on the user's log and index (or another file), held across workers.
+
+        Readers take it shared, so they never pair an index with a log that an
+        archive or clear is replacing.
+        """
+        with open(user_dir / name, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    def _open_log(self, user_id: str, create: bool = False) -> Path:
+        """Return the user dir, migrating and repairing the log as needed."""
+        user_dir = self.user_dir(user_id) if create else self.dirs.path(user_id)
+        if not create and not user_dir.is_dir():
+            return user_dir  # unknown user: one stat, nothing created
+        self._migrate_legacy(user_dir)
+        if (user_dir / self.REWRITE_MARKER).exists():
+            # An archive was interrupted between replacing the log and its index
+            with self._log_lock(user_dir):
+                if (user_dir / self.REWRITE_MARKER).exists():
+                    self._rebuild_index(user_dir)
+                    (user_dir / self.REWRITE_MARKER).unlink()
+        index_file = user_dir / self.INDEX_FILE
+        if (user_dir / self.LOG_FILE).exists():
+            if not index_file.exists() or index_file.stat().st_size % self.OFFSET.size:
+                self._rebuild_index(user_dir)
+        return user_dir
+
+    def append_turn(self, user_id: str, turn: dict):
+        user_dir = self._open_log(user_id, create=True)
+        line = self._encode_turn(turn)
+        # Hold the log lock until the index is written so offsets stay in order across workers
+        with self._log_lock(user_dir):
+            with open(user_dir / self.LOG_FILE, "ab") as f:
+                offset = f.seek(0, 2)
+                f.write(line)
+                f.flush()
+            with open(user_dir / self.INDEX_FILE, "ab") as index:
+                index.write(self.OFFSET.pack(offset))
+
+    def load_turns(self, user_id: str) -> list[dict]:
+        user_dir = self._open_log(user_id)
+        log_file = user_dir / self.LOG_FILE
+        if not log_file.exists():
+            return []
+        with self._log_lock(user_dir, shared=True), open(log_file, "rb") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def recent_turns(self, user_id: str, limit: int) -> list[dict]:
+        user_dir = self._open_log(user_id)
+        index_file = user_dir / self.INDEX_FILE
+        if not index_file.exists():
+            return []
+
+        with self._log_lock(user_dir, shared=True):
+            count = index_file.stat().st_size // self.OFFSET.size
+            start = max(count - limit, 0)
+            if start == count:
+                return []
+
+            with open(index_file, "rb") as f:
+                f.seek(start * self.OFFSET.size)
+                first_offset = self.OFFSET.unpack(f.read(self.OFFSET.size))[0]
+
+            with open(user_dir / self.LOG_FILE, "rb") as f:
+                f.seek(first_offset)
+                lines = [line for line in f.read().split(b"\n") if line.strip()]
+        return [json.loads(line) for line in lines[-limit:]]
+
+    def count_turns(self, user_id: str) -> int:
+        index_file = self._open_log(user_id) / self.INDEX_FILE
+        if not index_file.exists():
+            return 0
+        return index_file.stat().st_size // self.OFFSET.size
+
+    def turns_range(self, user_id: str, start: int, end: int) -> list[dict]:
+        user_dir = self._open_log(user_id)
+        index_file = user_dir / self.INDEX_FILE
+        if not index_file.exists():
+            return []
+
+        with self._log_lock(user_dir, shared=True):
+            count = index_file.stat().st_size // self.OFFSET.size
+            start, end = max(start, 0), min(end, count)
+            if start >= end:
+                return []
+
+            with open(index_file, "rb") as f:
+                f.seek(start * self.OFFSET.size)
+                offsets = f.read((end - start + 1) * self.OFFSET.size)
+            first = self.OFFSET.unpack_from(offsets, 0)[0]
+            with open(user_dir / self.LOG_FILE, "rb") as f:
+                f.seek(first)
+                if len(offsets) > (end - start) * self.OFFSET.size:
+                    data = f.read(self.OFFSET.unpack_from(offsets, (end - start) * self.OFFSET.size)[0] - first)
+                else:
+                    data = f.read()
+        lines = [line for line in data.split(b"\n") if line.strip()]
+        return [json.loads(line) for line in lines[:end - start]]
+
+    def clear_turns(self, user_id: str):
+        user_dir = self.dirs.path(user_id)
+        if not user_dir.is_dir():
+            return
+        self._migrate_legacy(user_dir)
+        with self._log_lock(user_dir):
+            for name in (self.LOG_FILE, self.INDEX_FILE):
+                path = user_dir / name
+                if path.exists():
+                    path.write_bytes(b"")
+
+    def _manifest(self, user_dir: Path) -> list[dict]:
+        path = user_dir / self.ARCHIVE_DIR / self.MANIFEST_FILE
+        return json.loads(path.read_text()) if path.exists() else []
+
+    def archive_turns(self, user_id: str, count: Optional[int] = None, reason: str = "") -> Optional[dict]:
+        user_dir = self._open_log(user_id)
+        log_file = user_dir / self.LOG_FILE
+        if not log_file.exists():
+            return None
+        with self._log_lock(user_dir):
+            if not log_file.exists():
+                return None
+            with open(log_file, "rb") as f:
+                lines = [line for line in f if line.strip()]
+            if count is not None:
+                lines, rest = lines[:count], lines[count:]
+            else:
+                rest = []
+            if not lines:
+                return None
+
+            # Archive and manifest first: a crash after this leaves the turns in
+            # both places, never in neither
+            archive_dir = user_dir / self.ARCHIVE_DIR
+            archive_dir.mkdir(exist_ok=True)
+            manifest = self._manifest(user_dir)
+            segment_id = f"{int(manifest[-1]['id']) + 1 if manifest else 1:05d}"
+            raw = b"".join(lines)
+            compressed = gzip.compress(raw)
+            _atomic_write(archive_dir / f"{segment_id}.jsonl.gz", compressed)
+            entry = _segment_entry(segment_id, json.loads(lines[0]), json.loads(lines[-1]),
+                                   len(lines), compressed, len(raw), reason)
+            manifest.append(entry)
+            _atomic_write(archive_dir / self.MANIFEST_FILE, json.dumps(manifest, indent=2).encode("utf-8"))
+
+            offsets = bytearray()
+            pos = 0
+            for line in rest:
+                offsets += self.OFFSET.pack(pos)
+                pos += len(line)
+            (user_dir / self.REWRITE_MARKER).touch()
+            _atomic_write(log_file, b"".join(rest))
+            _atomic_write(user_dir / self.INDEX_FILE, bytes(offsets))
+            (user_dir / self.REWRITE_MARKER).unlink()
+        return entry
+
+    def list_archives(self, user_id: str) -> list[dict]:
+        return self._manifest(self.dirs.path(user_id))
+
+    def load_archive(self, user_id: str, segment_id: str) -> list[dict]:
+        path = self.dirs.path(user_id) / self.ARCHIVE_DIR / f"{int(segment_id):05d}.jsonl.gz"
+        if not path.exists():
+            raise KeyError(f"No archived segment {segment_id} for {user_id}")
+        return [json.loads(line) for line in gzip.decompress(path.read_bytes()).splitlines() if line.strip()]
+
+    def _load_json(self, user_id: str, name: str) -> Optional[dict]:
+        try:
+            return json.loads((self.dirs.path(user_id) / name).read_text())
+        except FileNotFoundError:
+            return None
+
+    def load_summary(self, user_id: str) -> Optional[dict]:
+        return self._load_json(user_id, self.SUMMARY_FILE)
+
+    def save_summary(self, user_id: str, summary: dict):
+        _atomic_write(self.user_dir(user_id) / self.SUMMARY_FILE, json.dumps(summary, indent=2).encode("utf-8"))
+
+    def clear_summary(self, user_id: str):
+        (self.dirs.path(user_id) / self.SUMMARY_FILE).unlink(missing_ok=True)
+
+    def load_profile(self, user_id: str) -> Optional[dict]:
+        return self._load_json(user_id, self.PROFILE_FILE)
+
+    def save_profile(self, user_id: str, profile: dict):
+        _atomic_write(self.user_dir(user_id) / self.PROFILE_FILE, json.dumps(profile, indent=2).encode("utf-8"))
+
+    def profile_version(self, user_id: str):
+        return self._file_version(user_id, self.PROFILE_FILE)
+
+    def load_session(self, user_id: str) -> dict:
+        return self._load_json(user_id, self.SESSION_FILE) or {}
+
+    def save_session(self, user_id: str, state: dict):
+        _atomic_write(self.user_dir(user_id) / self.SESSION_FILE, json.dumps(state, indent=2).encode("utf-8"))
+
+    def _file_version(self, user_id: str, name: str):
+        try:
+            stat = (self.dirs.path(user_id) / name).stat()
+        except FileNotFoundError:
+            return 0
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def session_version(self, user_id: str):
+        return self._file_version(user_id, self.SESSION_FILE)
+
+    def record_usage(self, user_id: str, record: dict):
+        user_dir = self.user_dir(user_id)
+        with self._log_lock(user_dir, self.USAGE_LOCK):
+            with open(user_dir / self.USAGE_LOG, "ab") as f:
+                f.write(self._encode_turn(record))
+            totals = _add_usage(self._load_json(user_id, self.USAGE_FILE) or {}, record)
+            _atomic_write(user_dir / self.USAGE_FILE, json.dumps(totals).encode("utf-8"))
+
+    def usage_records(self, user_id: str) -> list[dict]:
+        try:
+            with open(self.dirs.path(user_id) / self.USAGE_LOG, "rb") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def usage_totals(self, user_id: str) -> dict:
+        totals = self._load_json(user_id, self.USAGE_FILE) or {}
+        return {"total": totals.get("total") or _usage_counts(), "days": totals.get("days", {}),
+                "routes": totals.get("routes", {}), "variants": totals.get("variants", {})}
+
+    def list_users(self) -> list[str]:
+        return self.dirs.list_users()
+
+
+class _ConnectionPool:
+    """A small per-process pool of SQLite connections."""
+
+    def __init__(self, path: Path, size: int):
+        self.path = Path(path)
+        self.size = size
+        self._pid = None
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # Connections must not cross a fork, so start a fresh pool in each worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if self._idle.qsize() < self.size:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+
+class SQLiteBackend(StorageBackend):
+    """All users in one SQLite database in WAL mode."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS turns_user_ts ON turns (user_id, ts);
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            started TEXT,
+            ended TEXT,
+            turns INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            archived_at TEXT NOT NULL,
+            reason TEXT,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archives_user ON archives (user_id, id);
+        CREATE TABLE IF NOT EXISTS usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            day TEXT NOT NULL,
+            route TEXT,
+            model TEXT,
+            variant TEXT,
+            input INTEGER NOT NULL DEFAULT 0,
+            output INTEGER NOT NULL DEFAULT 0,
+            cache_read INTEGER NOT NULL DEFAULT 0,
+            cache_write INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS usage_user_day ON usage (user_id, day);
+    """
+
+    ARCHIVE_COLUMNS = "id, started, ended, turns, bytes, raw_bytes, archived_at, reason"
+
+    def __init__(self, path: Path, pool_size: int = 4):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.pool = _ConnectionPool(self.path, pool_size)
+        with self.pool.connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _row_to_turn(row) -> dict:
+        turn = json.loads(row[3]) if row[3] else {}
+        turn.update({"role": row[0], "content": row[1], "timestamp": row[2]})
+        return turn
+
+    @staticmethod
+    def _turn_params(user_id: str, turn: dict) -> tuple:
+        extra = {k: v for k, v in turn.items() if k not in ("role", "content", "timestamp")}
+        return (user_id, turn.get("timestamp", ""), turn["role"], turn["content"],
+                json.dumps(extra) if extra else None)
+
+    def append_turn(self, user_id: str, turn: dict):
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO turns (user_id, ts, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+                self._turn_params(user_id, turn),
+            )
+
+    def load_turns(self, user_id: str) -> list[dict]:
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT role, content, ts, extra FROM turns WHERE user_id = ? ORDER BY ts, id",
+                (user_id,),
+            ).fetchall()
+        return [self._row_to_turn(r) for r in rows]
+
+    def recent_turns(self, user_id: str, limit: int) -> list[dict]:
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT role, content, ts, extra FROM turns WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [self._row_to_turn(r) for r in reversed(rows)]
+
+    def count_turns(self, user_id: str) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM turns WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def turns_range(self, user_id: str, start: int, end: int) -> list[dict]:
+        start = max(start, 0)
+        if start >= end:
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT role, content, ts, extra FROM turns WHERE user_id = ? "
+                "ORDER BY ts, id LIMIT ? OFFSET ?",
+                (user_id, end - start, start),
+            ).fetchall()
+        return [self._row_to_turn(r) for r in rows]
+
+    def clear_turns(self, user_id: str):
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+
+    def _insert_archive(self, conn: sqlite3.Connection, user_id: str, entry: dict, data: bytes) -> int:
+        return conn.execute(
+            "INSERT INTO archives (user_id, started, ended, turns, bytes, raw_bytes, archived_at, reason, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, entry["started"], entry["ended"], entry["turns"], entry["bytes"],
+             entry["raw_bytes"], entry["archived_at"], entry["reason"], data),
+        ).lastrowid
+
+    def archive_turns(self, user_id: str, count: Optional[int] = None, reason: str = "") -> Optional[dict]:
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT role, content, ts, extra, id FROM turns WHERE user_id = ? ORDER BY ts, id LIMIT ?",
+                    (user_id, -1 if count is None else count),
+                ).fetchall()
+                if not rows:
+                    conn.execute("ROLLBACK")
+                    return None
+                turns = [self._row_to_turn(r) for r in rows]
+                raw = "".join(json.dumps(t, ensure_ascii=False) + "\n" for t in turns).encode("utf-8")
+                compressed = gzip.compress(raw)
+                entry = _segment_entry("", turns[0], turns[-1], len(turns), compressed, len(raw), reason)
+                entry["id"] = str(self._insert_archive(conn, user_id, entry, compressed))
+                conn.executemany("DELETE FROM turns WHERE id = ?", [(r[4],) for r in rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return entry
+
+    def list_archives(self, user_id: str) -> list[dict]:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                f"SELECT {self.ARCHIVE_COLUMNS} FROM archives WHERE user_id = ? ORDER BY id", (user_id,)
+            )
+            names = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+        return [dict(zip(names, (str(row[0]),) + row[1:])) for row in rows]
+
+    def load_archive(self, user_id: str, segment_id: str) -> list[dict]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT data FROM archives WHERE user_id = ? AND id = ?", (user_id, int(segment_id))
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No archived segment {segment_id} for {user_id}")
+        return [json.loads(line) for line in gzip.decompress(row[0]).splitlines() if line.strip()]
+
+    def import_archive(self, user_id: str, entry: dict, turns: list[dict]):
+        """Store an archived segment copied from another backend."""
+        raw = "".join(json.dumps(t, ensure_ascii=False) + "\n" for t in turns).encode("utf-8")
+        with self.pool.connection() as conn:
+            self._insert_archive(conn, user_id, entry, gzip.compress(raw))
+
+    def _load_json(self, table: str, user_id: str) -> Optional[dict]:
+        with self.pool.connection() as conn:
+            row = conn.execute(f"SELECT data FROM {table} WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_json(self, table: str, user_id: str, data: dict):
+        with self.pool.connection() as conn:
+            conn.execute(
+                f"INSERT INTO {table} (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = version + 1",
+                (user_id, json.dumps(data)),
+            )
+
+    def _version(self, table: str, user_id: str) -> int:
+        with self.pool.connection() as conn:
+            row = conn.execute(f"SELECT version FROM {table} WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def load_summary(self, user_id: str) -> Optional[dict]:
+        return self._load_json("summaries", user_id)
+
+    def save_summary(self, user_id: str, summary: dict):
+        self._save_json("summaries", user_id, summary)
+
+    def clear_summary(self, user_id: str):
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+
+    def load_profile(self, user_id: str) -> Optional[dict]:
+        return self._load_json("profiles", user_id)
+
+    def save_profile(self, user_id: str, profile: dict):
+        self._save_json("profiles", user_id, profile)
+
+    def profile_version(self, user_id: str):
+        return self._version("profiles", user_id)
+
+    def load_session(self, user_id: str) -> dict:
+        return self._load_json("sessions", user_id) or {}
+
+    def save_session(self, user_id: str, state: dict):
+        self._save_json("sessions", user_id, state)
+
+    def session_version(self, user_id: str):
+        return self._version("sessions", user_id)
+
+    def record_usage(self, user_id: str, record: dict):
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO usage (user_id, ts, day, route, model, variant, input, output, cache_read, cache_write) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, record["ts"], record["day"], record.get("route"), record.get("model"),
+                 record.get("variant")) + tuple(record.get(kind, 0) for kind in USAGE_KINDS),
+            )
+
+    def usage_records(self, user_id: str) -> list[dict]:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                f"SELECT ts, day, route, model, variant, {', '.join(USAGE_KINDS)} FROM usage "
+                "WHERE user_id = ? ORDER BY id",
+                (user_id,),
+            )
+            names = [c[0] for c in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def usage_totals(self, user_id: str) -> dict:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                f"SELECT day, route, variant, COUNT(*) AS calls, "
+                f"{', '.join(f'SUM({kind}) AS {kind}' for kind in USAGE_KINDS)} FROM usage "
+                "WHERE user_id = ? GROUP BY day, route, variant",
+                (user_id,),
+            )
+            names = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+        totals = {"total": _usage_counts(), "days": {}, "routes": {}, "variants": {}}
+        for row in rows:
+            _add_usage(totals, dict(zip(names, row)))
+        return totals
+
+    def usage_on_day(self, user_id: str, day: str) -> dict:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                f"SELECT COUNT(*), {', '.join(f'COALESCE(SUM({kind}), 0)' for kind in USAGE_KINDS)} FROM usage "
+                "WHERE user_id = ? AND day = ?",
+                (user_id, day),
+            ).fetchone()
+        return dict(zip(("calls",) + USAGE_KINDS, row))
+
+    def list_users(self) -> list[str]:
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT user_id FROM turns UNION SELECT user_id FROM profiles "
+                "UNION SELECT user_id FROM sessions UNION SELECT user_id FROM archives ORDER BY 1"
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def import_user(self, user_id: str, turns: list[dict], profile: Optional[dict], session: dict,
+                    summary: Optional[dict] = None):
+        """Replace everything stored for a user in a single transaction.
+
+        Archived segments and usage records are dropped too; import them again
+        with import_archive and record_usage.
+        """
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+                conn.executemany(
+                    "INSERT INTO turns (user_id, ts, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+                    [self._turn_params(user_id, t) for t in turns],
+                )
+                conn.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+                conn.execute("DELETE FROM archives WHERE user_id = ?", (user_id,))
+                conn.execute("DELETE FROM usage WHERE user_id = ?", (user_id,))
+                if summary is not None:
+                    conn.execute("INSERT INTO summaries (user_id, data) VALUES (?, ?)", (user_id, json.dumps(summary)))
+                if profile is not None:
+                    conn.execute(
+                        "INSERT INTO profiles (user_id, data) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = version + 1",
+                        (user_id, json.dumps(profile)),
+                    )
+                if session:
+                    conn.execute(
+                        "INSERT INTO sessions (user_id, data) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = version + 1",
+                        (user_id, json.dumps(session)),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+
+_backend: Optional[StorageBackend] = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name: str) -> StorageBackend:
+    """Instantiate a backend by name ("json" or "sqlite")."""
+    if name == "json":
+        return JSONFileBackend(DATA_DIR, get_user_dirs())
+    if name == "sqlite":
+        return SQLiteBackend(SQLITE_PATH, SQLITE_POOL_SIZE)
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+def get_storage() -> StorageBackend:
+    """Return the process-wide storage backend selected in config."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(STORAGE_BACKEND)
+    return _backend
+
+
+def migrate_json_to_sqlite(data_dir: Path, db_path: Path) -> int:
+    """Import every data/users/* directory into SQLite. Returns the number of users."""
+    source = JSONFileBackend(data_dir)
+    target = SQLiteBackend(db_path, SQLITE_POOL_SIZE)
+    users = source.list_users()
+    for user_id in users:
+        target.import_user(
+            user_id,
+            source.load_turns(user_id),
+            source.load_profile(user_id),
+            source.load_session(user_id),
+            source.load_summary(user_id),
+        )
+        for entry in source.list_archives(user_id):
+            target.import_archive(user_id, entry, source.load_archive(user_id, entry["id"]))
+        for record in source.usage_records(user_id):
+            target.record_usage(user_id, record)
+        print(f"Imported {user_id}")
+    return len(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nori storage maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    shard = commands.add_parser("shard", help="Move flat user directories into the sharded layout (app stopped)")
+    shard.add_argument("--data-dir", type=Path, default=DATA_DIR)
+
+    migrate = commands.add_parser("migrate", help="Import JSON user directories into SQLite")
+    migrate.add_argument("--data-dir", type=Path, default=DATA_DIR)
+    migrate.add_argument("--db", type=Path, default=SQLITE_PATH)
+
+    archives = commands.add_parser("archives", help="List a user's archived conversation segments")
+    archives.add_argument("user_id")
+
+    export = commands.add_parser("export", help="Write a user's turns to stdout as JSONL")
+    export.add_argument("user_id")
+    export.add_argument("--segment", help="only this archived segment (default: all segments, then the active one)")
+    export.add_argument("--summary", action="store_true", help="write the rolling summary as JSON instead of turns")
+
+    usage = commands.add_parser("usage", help="Token usage totals for a user, or per variant across users")
+    usage.add_argument("user_id", nargs="?")
+
+    args = parser.parse_args()
+    if args.command == "shard":
+        count = UserDirs(args.data_dir).migrate()
+        print(f"Moved {count} users into {args.data_dir}/ab/cd/<user_id>")
+    elif args.command == "migrate":
+        count = migrate_json_to_sqlite(args.data_dir, args.db)
+        print(f"Migrated {count} users to {args.db}")
+    elif args.command == "archives":
+        for entry in get_storage().list_archives(args.user_id):
+            print(f"{entry['id']:>6}  {entry['started'] or '?'} .. {entry['ended'] or '?'}  "
+                  f"{entry['turns']:>5} turns  {entry['bytes']:>9,} bytes ({entry['raw_bytes']:,} raw)  "
+                  f"{entry['reason'] or ''}")
+    elif args.command == "export":
+        storage = get_storage()
+        if args.summary:
+            print(json.dumps(storage.load_summary(args.user_id), indent=2, ensure_ascii=False))
+            return
+        if args.segment:
+            segments = [storage.load_archive(args.user_id, args.segment)]
+        else:
+            segments = [storage.load_archive(args.user_id, e["id"]) for e in storage.list_archives(args.user_id)]
+            segments.append(storage.load_turns(args.user_id))
+        for turns in segments:
+            for turn in turns:
+                sys.stdout.write(json.dumps(turn, ensure_ascii=False) + "\n")
+    elif args.command == "usage":
+        storage = get_storage()
+        if args.user_id:
+            print(json.dumps(storage.usage_totals(args.user_id), indent=2))
+        else:
+            variants: dict = {}
+            for user_id in storage.list_users():
+                for variant, counts in storage.usage_totals(user_id)["variants"].items():
+                    summed = variants.setdefault(variant, _usage_counts())
+                    for key in summed:
+                        summed[key] += counts.get(key, 0)
+            print(json.dumps(variants, indent=2))
+
+
+if __name__ == "__main__":
+    main()
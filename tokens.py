@@ -0,0 +1,32 @@
+"""
+Local token estimation.
+
+A cheap stand-in for the provider tokenizer, good enough for budgeting
+context. English prose averages about four characters per token; short
+words and punctuation push the count up, so take the larger of a
+character-based and a word-based estimate.
+"""
+
+import re
+
+_WORD = re.compile(r"\w+|[^\w\s]")
+
+# Per-message framing overhead (role markers etc.)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a piece of text."""
+    if not text:
+        return 0
+    by_chars = (len(text) + 3) // 4
+    by_words = int(len(_WORD.findall(text)) * 0.75) + 1
+    return max(by_chars, by_words)
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """Estimate the tokens a chat message contributes to a request."""
+    content = message.get("content", "")
+    if isinstance(content, list):
+        content = " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return estimate_tokens(content) + MESSAGE_OVERHEAD
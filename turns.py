@@ -0,0 +1,214 @@
+"""
+Per-user ordering of turns and profile updates.
+
+UserLocks gives each (user, name) pair a lock that holds across threads and
+gunicorn workers: an in-process lock first, then an flock on a file in the
+user's directory. One user's turns run one at a time; different users still
+run in parallel.
+
+TurnGate uses it for chat turns. Each message is queued in the user's pending
+file before waiting for the turn lock. Whoever gets the lock next takes every
+queued message, so messages sent while a reply is still being generated (a
+double-tap, a second tab) are answered together by one model call. The ASGI
+app waits with aenter(), which retries the turn lock when it is released in this
+process (and polls for other workers) instead of parking a thread from the
+default pool for as long as the turn ahead runs.
+"""
+
+import asyncio
+import fcntl
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+from memory import get_user_dir
+
+PENDING_FILE = "pending_turns.jsonl"
+
+
+class UserLocks:
+    """Named per-user locks, exclusive across threads and processes."""
+
+    def __init__(self):
+        self._locks: dict[tuple, list] = {}  # (user_id, name) -> [lock, waiters]
+        self._async_waiters: dict[tuple, set] = {}  # (user_id, name) -> {(loop, event)}
+        self._guard = threading.Lock()
+
+    def acquire(self, user_id: str, name: str) -> tuple:
+        """Block until the lock is held. Returns a handle for release()."""
+        key = (user_id, name)
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            lock_file = open(get_user_dir(user_id) / f"{name}.lock", "a")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except BaseException:
+            self._drop(key, entry)
+            raise
+        return key, entry, lock_file
+
+    def try_acquire(self, user_id: str, name: str) -> Optional[tuple]:
+        """Take the lock only if it is free right now. Returns a handle, or None."""
+        key = (user_id, name)
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        if not entry[0].acquire(blocking=False):
+            self._forget(key, entry)
+            return None
+        try:
+            lock_file = open(get_user_dir(user_id) / f"{name}.lock", "a")
+        except BaseException:
+            self._drop(key, entry)
+            raise
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BaseException as e:
+            lock_file.close()
+            self._drop(key, entry)
+            if isinstance(e, BlockingIOError):
+                return None  # held by another process
+            raise
+        return key, entry, lock_file
+
+    async def aacquire(self, user_id: str, name: str, max_delay: float = 0.05) -> tuple:
+        """acquire() for coroutines; waits without blocking a thread.
+
+        Retries as soon as a holder in this process releases the lock, and polls
+        with jittered backoff for holders in other processes.
+        """
+        key = (user_id, name)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        delay = 0.001
+        with self._guard:
+            self._async_waiters.setdefault(key, set()).add(waiter)
+        try:
+            while True:
+                waiter[1].clear()  # before trying, so a release in between still wakes us
+                handle = self.try_acquire(user_id, name)
+                if handle is not None:
+                    return handle
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), random.uniform(delay / 2, delay))
+                except asyncio.TimeoutError:
+                    delay = min(delay * 2, max_delay)
+        finally:
+            with self._guard:
+                waiters = self._async_waiters[key]
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._async_waiters[key]
+
+    def release(self, handle: tuple):
+        key, entry, lock_file = handle
+        lock_file.close()
+        self._drop(key, entry)
+        with self._guard:
+            waiters = list(self._async_waiters.get(key, ()))
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _drop(self, key: tuple, entry: list):
+        entry[0].release()
+        self._forget(key, entry)
+
+    def _forget(self, key: tuple, entry: list):
+        with self._guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextmanager
+    def hold(self, user_id: str, name: str):
+        handle = self.acquire(user_id, name)
+        try:
+            yield
+        finally:
+            self.release(handle)
+
+
+class TurnGate:
+    """Runs each user's chat turns in order and folds queued messages into one turn."""
+
+    def __init__(self, locks: UserLocks, coalesce_seconds: float = 0.0, poll_max: float = 0.05):
+        self.locks = locks
+        self.coalesce_seconds = coalesce_seconds
+        self.poll_max = poll_max
+        self.stats = {"turns": 0, "messages": 0, "coalesced": 0}
+        self._stats_lock = threading.Lock()
+
+    def enter(self, user_id: str, message: str) -> tuple[Optional[tuple], Optional[list[str]]]:
+        """Queue a message and wait for the user's turn.
+
+        Returns (handle, messages) with the turn lock held, or (None, None) if an
+        earlier request already answered this message along with its own.
+        """
+        token = self._queue(user_id, message)
+        handle = self.locks.acquire(user_id, "turn")
+        try:
+            if self.coalesce_seconds:
+                time.sleep(self.coalesce_seconds)  # let a double-tap land in the same turn
+            entries = self._take(user_id, token)
+        except BaseException:
+            self.locks.release(handle)
+            raise
+        return self._start(handle, entries)
+
+    async def aenter(self, user_id: str, message: str) -> tuple[Optional[tuple], Optional[list[str]]]:
+        """enter() for coroutines. Only the short pending-file updates run in a thread."""
+        token = await asyncio.to_thread(self._queue, user_id, message)
+        handle = await self.locks.aacquire(user_id, "turn", self.poll_max)
+        try:
+            if self.coalesce_seconds:
+                await asyncio.sleep(self.coalesce_seconds)
+            entries = await asyncio.to_thread(self._take, user_id, token)
+        except BaseException:
+            self.locks.release(handle)
+            raise
+        return self._start(handle, entries)
+
+    def _queue(self, user_id: str, message: str) -> str:
+        """Append the message to the user's pending file. Returns its token."""
+        token = uuid.uuid4().hex
+        with self.locks.hold(user_id, "pending"):
+            with open(get_user_dir(user_id) / PENDING_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"id": token, "message": message}, ensure_ascii=False) + "\n")
+        return token
+
+    def _take(self, user_id: str, token: str) -> Optional[list[dict]]:
+        """With the turn lock held, take every queued message, or None if ours is gone."""
+        pending = get_user_dir(user_id) / PENDING_FILE
+        with self.locks.hold(user_id, "pending"):
+            try:
+                lines = pending.read_text(encoding="utf-8").splitlines()
+            except FileNotFoundError:
+                lines = []  # taken, with ours, by the turn that just finished
+            entries = [json.loads(line) for line in lines if line]
+            if all(e["id"] != token for e in entries):
+                return None
+            pending.unlink()
+        return entries
+
+    def _start(self, handle: tuple, entries: Optional[list[dict]]) -> tuple[Optional[tuple], Optional[list[str]]]:
+        with self._stats_lock:
+            if entries is None:
+                self.stats["coalesced"] += 1
+            else:
+                self.stats["turns"] += 1
+                self.stats["messages"] += len(entries)
+        if entries is None:
+            self.locks.release(handle)
+            return None, None
+        return handle, [e["message"] for e in entries]
+
+    def leave(self, handle: Optional[tuple]):
+        if handle is not None:
+            self.locks.release(handle)
+
+
+user_locks = UserLocks()
@@ -0,0 +1,109 @@
+"""
+Per-user token accounting, rate limits and daily quotas.
+
+Every model call's token usage is stored against the user, route and variant
+(see StorageBackend.record_usage). Before a chat turn calls the model,
+ChatLimits checks the user's request rate with a token bucket and their tokens
+used today against a daily quota, so one heavy user gets a fast 429 instead of
+eating into the upstream rate limit everyone shares.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from storage import USAGE_KINDS, get_storage
+
+# Where each kind is found on the API's usage object
+USAGE_FIELDS = {
+    "input": "input_tokens",
+    "output": "output_tokens",
+    "cache_read": "cache_read_input_tokens",
+    "cache_write": "cache_creation_input_tokens",
+}
+
+
+def usage_counts(usage) -> dict:
+    """Token counts by kind from a response's usage."""
+    return {kind: getattr(usage, USAGE_FIELDS[kind], None) or 0 for kind in USAGE_KINDS}
+
+
+def today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def record_usage(user_id: str, route: str, model: str, variant: Optional[str], usage):
+    """Store one model call's token usage for the user."""
+    get_storage().record_usage(user_id, {
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "day": today(),
+        "route": route,
+        "model": model,
+        "variant": variant,
+        **usage_counts(usage),
+    })
+
+
+def tokens_today(user_id: str) -> int:
+    """All tokens (input, output and cache) the user's calls used today, UTC."""
+    counts = get_storage().usage_on_day(user_id, today())
+    return sum(counts[kind] for kind in USAGE_KINDS)
+
+
+class TokenBucket:
+    """Allows `burst` requests at once, refilled at `rate` per second."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, burst: float) -> float:
+        """Take one token. Returns 0, or the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class ChatLimits:
+    """Per-user request rate (per process) and daily token quota (shared through storage)."""
+
+    def __init__(self, rate_per_minute: float, burst: int, daily_tokens: int, max_users: int = 100_000):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.daily_tokens = daily_tokens
+        self.max_users = max_users
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "rate_limited": 0, "quota_exceeded": 0}
+
+    def check(self, user_id: str) -> Optional[tuple[str, float]]:
+        """Return None if the user may start a turn, else (reason, seconds to wait)."""
+        if self.rate > 0:
+            with self._lock:
+                bucket = self._buckets.get(user_id)
+                if bucket is None:
+                    bucket = self._buckets[user_id] = TokenBucket(self.burst)
+                    if len(self._buckets) > self.max_users:
+                        self._buckets.popitem(last=False)
+                self._buckets.move_to_end(user_id)
+                wait = bucket.take(self.rate, self.burst)
+                if wait:
+                    self.stats["rate_limited"] += 1
+                    return "rate_limited", wait
+
+        if self.daily_tokens and tokens_today(user_id) >= self.daily_tokens:
+            with self._lock:
+                self.stats["quota_exceeded"] += 1
+            tomorrow = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            return "quota_exceeded", (tomorrow - datetime.now(timezone.utc)).total_seconds()
+
+        with self._lock:
+            self.stats["allowed"] += 1
+        return None
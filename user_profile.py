@@ -1,6 +1,10 @@
-import json
-from pathlib import Path
-from memory import get_user_dir
+import copy
+from contextlib import contextmanager
+from config import PROFILE_CACHE_SIZE, PROFILE_CACHE_POLICY, PROFILE_WRITE_DELAY, PROFILE_PROMPT_NOTES
+import metrics
+from profile_cache import ProfileCache
+from storage import get_storage
+from turns import user_locks
 
 
 DEFAULT_PROFILE = {
@@ -22,44 +26,76 @@ DEFAULT_PROFILE = {
 }
 
 
+# Profiles are cached per process; saves are coalesced and written behind
+profile_cache = ProfileCache(
+    get_storage,
+    max_size=PROFILE_CACHE_SIZE,
+    policy=PROFILE_CACHE_POLICY,
+    write_delay=PROFILE_WRITE_DELAY,
+)
+metrics.register_collector(metrics.counters("nori_profile_cache", profile_cache.stats, "Profile cache events."))
+
+
+def _merge_defaults(saved: dict = None) -> dict:
+    # Merge with defaults to pick up any new fields
+    merged = copy.deepcopy(DEFAULT_PROFILE)
+    if saved:
+        merged.update(saved)
+    return merged
+
+
 def load_profile(user_id: str) -> dict:
     """Load user profile, creating default if doesn't exist."""
-    profile_file = get_user_dir(user_id) / "profile.json"
-    if profile_file.exists():
-        saved = json.loads(profile_file.read_text())
-        # Merge with defaults to pick up any new fields
-        merged = DEFAULT_PROFILE.copy()
-        merged.update(saved)
-        return merged
-    return DEFAULT_PROFILE.copy()
+    return _merge_defaults(profile_cache.get(user_id))
 
 
 def save_profile(user_id: str, profile: dict):
     """Save user profile."""
-    profile_file = get_user_dir(user_id) / "profile.json"
-    profile_file.write_text(json.dumps(profile, indent=2))
+    profile_cache.put(user_id, profile)
+
+
+def flush_profiles(user_id: str = None):
+    """Write any profile saves still pending in the write-behind cache."""
+    profile_cache.flush(user_id)
+
+
+@contextmanager
+def profile_update(user_id: str):
+    """Hold the user's profile lock around a read-modify-write.
+
+    The save is written through before the lock is released, so the next holder,
+    in this process or another worker, reads it rather than a stale copy.
+    """
+    with user_locks.hold(user_id, "profile"):
+        yield
+        profile_cache.flush(user_id)
 
 
 def update_profile(user_id: str, **updates):
     """Update specific fields in user profile."""
-    profile = load_profile(user_id)
-
-    for key, value in updates.items():
-        if key in profile:
-            if isinstance(profile[key], list) and not isinstance(value, list):
-                # Append to list fields
-                if value not in profile[key]:
-                    profile[key].append(value)
-            else:
-                profile[key] = value
-
-    save_profile(user_id, profile)
+    with profile_update(user_id):
+        profile = load_profile(user_id)
+
+        for key, value in updates.items():
+            if key in profile:
+                if isinstance(profile[key], list) and not isinstance(value, list):
+                    # Append to list fields
+                    if value not in profile[key]:
+                        profile[key].append(value)
+                else:
+                    profile[key] = value
+
+        save_profile(user_id, profile)
     return profile
 
 
 def format_profile_for_prompt(user_id: str) -> str:
     """Format user profile as text for the system prompt."""
-    profile = load_profile(user_id)
+    return profile_cache.render(user_id, "prompt", _render_prompt)
+
+
+def _render_prompt(saved: dict = None) -> str:
+    profile = _merge_defaults(saved)
 
     lines = []
 
@@ -91,8 +127,11 @@ def format_profile_for_prompt(user_id: str) -> str:
         lines.append(f"Current plan: {profile['plan']}")
     if profile.get("committed") is not None:
         lines.append(f"Committed to plan: {'Yes' if profile['committed'] else 'No'}")
-    if profile.get("notes"):
-        lines.append(f"Other notes: {', '.join(profile['notes'])}")
+    # Older notes reach the prompt through recall when they're relevant
+    notes = profile.get("notes") or []
+    newest = notes[max(len(notes) - PROFILE_PROMPT_NOTES, 0):]
+    if newest:
+        lines.append(f"Other notes: {', '.join(newest)}")
 
     if not lines:
         return "No information known yet about this person."
@@ -102,7 +141,11 @@ def format_profile_for_prompt(user_id: str) -> str:
 
 def display_profile(user_id: str) -> str:
     """Get a human-readable display of the profile."""
-    profile = load_profile(user_id)
+    return profile_cache.render(user_id, "display", _render_display)
+
+
+def _render_display(saved: dict = None) -> str:
+    profile = _merge_defaults(saved)
 
     output = ["\n=== Your Profile ==="]
     output.append(f"Name: {profile.get('name') or 'Not set'}")
@@ -3,20 +3,79 @@
 Web interface for Nori health assistant.
 """
 
-from flask import Flask, render_template, request, jsonify
-from assistant import chat, VARIANTS, DEFAULT_VARIANT
+import json
+import math
+import re
+from typing import Optional
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+import metrics
+from assistant import chat, chat_stream, flush_profile_updates, session_variant, VARIANTS, DEFAULT_VARIANT
+from config import (
+    IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_USER_KEYS, IDEMPOTENCY_RUNNING_TIMEOUT,
+    CHAT_RATE_PER_MINUTE, CHAT_BURST, DAILY_TOKEN_QUOTA, RATE_LIMIT_USERS,
+)
+from idempotency import ReplyCache
+from resilience import ModelUnavailableError
 from user_profile import display_profile, load_profile, save_profile
 from memory import clear_history
+from session_state import clear_session, touch_session, update_session
+from usage import ChatLimits
 
 app = Flask(__name__)
-USER_ID = "web_user"
+USER_ID = "web_user"  # used when a request doesn't name its user
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[\x21-\x7e]{1,255}$")
+UNAVAILABLE_MESSAGE = "I'm having trouble connecting right now. Please try again in a moment."
+LIMIT_MESSAGES = {
+    "rate_limited": "You're sending messages faster than I can keep up. Please wait a moment.",
+    "quota_exceeded": "You've reached today's message limit. Please come back tomorrow.",
+}
 
-# In-memory variant state per user
-active_variant = {}
+# Responses to replay when a client retries a /chat request with the same Idempotency-Key
+reply_cache = ReplyCache(IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_USER_KEYS, IDEMPOTENCY_RUNNING_TIMEOUT)
+metrics.register_collector(metrics.counters("nori_idempotency", reply_cache.stats, "Idempotency-Key replays."))
+metrics.register_collector(lambda: [(
+    "nori_idempotency_cached", "gauge", "Responses held for replay in this process.", reply_cache.size(),
+)])
+
+# Per-user rate limit and daily token quota, checked before any model call
+chat_limits = ChatLimits(CHAT_RATE_PER_MINUTE, CHAT_BURST, DAILY_TOKEN_QUOTA, RATE_LIMIT_USERS)
+metrics.register_collector(metrics.counters("nori_chat_limits", chat_limits.stats, "Chat turns allowed and refused."))
+
+
+def request_user_id(header: Optional[str], data: dict) -> Optional[str]:
+    """The user a request is for: X-User-Id header, then a user_id field, then USER_ID.
+
+    Returns None if the id isn't safe to use as a directory name.
+    """
+    user_id = header or data.get("user_id") or USER_ID
+    return user_id if isinstance(user_id, str) and USER_ID_PATTERN.match(user_id) else None
+
+
+def invalid_user_response():
+    return jsonify({"error": "Invalid user id"}), 400
+
+
+def valid_idempotency_key(key: Optional[str]) -> bool:
+    """No key, or printable ASCII of at most 255 characters."""
+    return key is None or IDEMPOTENCY_KEY_PATTERN.match(key) is not None
 
 
 def get_variant(user_id: str) -> str:
-    return active_variant.get(user_id, DEFAULT_VARIANT)
+    return session_variant(user_id)
+
+
+def limited_reply(user_id: str) -> Optional[tuple[dict, int]]:
+    """A 429 body if the user is over their rate limit or daily quota, else None."""
+    limited = chat_limits.check(user_id)
+    if limited is None:
+        return None
+    reason, retry_after = limited
+    return {"error": LIMIT_MESSAGES[reason], "reason": reason, "retry_after": math.ceil(retry_after)}, 429
+
+
+def limit_headers(payload: dict, status: int) -> dict:
+    return {"Retry-After": str(payload["retry_after"])} if status == 429 else {}
 
 
 @app.route("/")
@@ -26,7 +85,10 @@ def index():
 
 @app.route("/get-variant", methods=["GET"])
 def get_variant_endpoint():
-    variant = get_variant(USER_ID)
+    user_id = request_user_id(request.headers.get("X-User-Id"), request.args)
+    if user_id is None:
+        return invalid_user_response()
+    variant = get_variant(user_id)
     return jsonify({
         "current": variant,
         "variants": {k: v["label"] for k, v in VARIANTS.items()}
@@ -36,26 +98,23 @@ def get_variant_endpoint():
 @app.route("/set-variant", methods=["POST"])
 def set_variant_endpoint():
     data = request.json
+    user_id = request_user_id(request.headers.get("X-User-Id"), data)
+    if user_id is None:
+        return invalid_user_response()
     variant = data.get("variant", DEFAULT_VARIANT)
     if variant not in VARIANTS:
         return jsonify({"error": f"Unknown variant: {variant}"}), 400
-    active_variant[USER_ID] = variant
-    clear_history(USER_ID)
+    clear_history(user_id, reason="variant")
+    update_session(user_id, variant=variant, greeting_seeded=False, plan_turns=0)
     greeting = VARIANTS[variant]["greeting"]
     return jsonify({"status": "ok", "variant": variant, "greeting": greeting})
 
 
-@app.route("/chat", methods=["POST"])
-def chat_endpoint():
-    data = request.json
-    message = data.get("message", "").strip()
-
-    if not message:
-        return jsonify({"error": "No message provided"}), 400
-
-    # Handle commands
+def handle_command(message: str, user_id: str = USER_ID) -> Optional[list[str]]:
+    """Handle slash commands. Returns the reply bubbles, or None if not a command."""
     if message.lower() == "/profile":
-        profile = load_profile(USER_ID)
+        flush_profile_updates(user_id)
+        profile = load_profile(user_id)
         profile_text = []
         if profile.get("name"):
             profile_text.append(f"Name: {profile['name']}")
@@ -75,16 +134,18 @@ def chat_endpoint():
             profile_text.append(f"Committed: {'Yes' if profile['committed'] else 'No'}")
         if not profile_text:
             profile_text = ["No profile information yet."]
-        return jsonify({"messages": profile_text})
+        return profile_text
 
     if message.lower() in ["/new", "/clear"]:
-        clear_history(USER_ID)
-        return jsonify({"messages": ["New conversation started. Profile retained."]})
+        clear_history(user_id)
+        update_session(user_id, greeting_seeded=False, plan_turns=0)
+        return ["New conversation started. Profile retained."]
 
     if message.lower() == "/reset":
-        clear_history(USER_ID)
-        active_variant.pop(USER_ID, None)
-        save_profile(USER_ID, {
+        flush_profile_updates(user_id)
+        clear_history(user_id, reason="reset")
+        clear_session(user_id)
+        save_profile(user_id, {
             "name": None,
             "height": None,
             "current_weight": None,
@@ -101,16 +162,165 @@ def chat_endpoint():
             "committed": None,
             "notes": []
         })
-        return jsonify({"messages": ["Profile and history reset."]})
+        return ["Profile and history reset."]
+
+    return None
+
+
+def iter_paragraphs(chunks):
+    """Re-chunk a token stream into paragraphs, yielding each once its blank line arrives."""
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while "\n\n" in buffer:
+            paragraph, buffer = buffer.split("\n\n", 1)
+            if paragraph.strip():
+                yield paragraph.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def chat_reply(user_id: str, message: str) -> tuple[dict, int]:
+    """Run a command or a chat turn. Returns the response body and status."""
+    # Handle commands
+    command_reply = handle_command(message, user_id)
+    if command_reply is not None:
+        return {"messages": command_reply}, 200
+
+    limited = limited_reply(user_id)
+    if limited is not None:
+        return limited
 
     # Get response from assistant
-    variant = get_variant(USER_ID)
-    response = chat(USER_ID, message, variant=variant)
+    try:
+        with metrics.trace_request("/chat"):
+            variant = get_variant(user_id)
+            response = chat(user_id, message, variant=variant)
+            touch_session(user_id)
+    except ModelUnavailableError:
+        app.logger.warning("Model unavailable", exc_info=True)
+        return {"error": UNAVAILABLE_MESSAGE}, 503
+
+    if response is None:
+        # Answered together with the same user's concurrent message
+        return {"messages": [], "coalesced": True}, 200
 
     # Split response into paragraphs for multiple bubbles
     paragraphs = [p.strip() for p in response.split("\n\n") if p.strip()]
 
-    return jsonify({"messages": paragraphs})
+    return {"messages": paragraphs}, 200
+
+
+@app.route("/chat", methods=["POST"])
+def chat_endpoint():
+    data = request.json
+    user_id = request_user_id(request.headers.get("X-User-Id"), data)
+    if user_id is None:
+        return invalid_user_response()
+    message = data.get("message", "").strip()
+
+    if not message:
+        return jsonify({"error": "No message provided"}), 400
+
+    key = request.headers.get("Idempotency-Key")
+    if not valid_idempotency_key(key):
+        return jsonify({"error": "Invalid Idempotency-Key"}), 400
+
+    # A retry gets the first response back, waiting for it if it's still running
+    replay = reply_cache.begin(user_id, key) if key is not None else None
+    if replay is not None:
+        return jsonify(replay)
+    payload, status = None, 500
+    try:
+        payload, status = chat_reply(user_id, message)
+    finally:
+        if key is not None:
+            reply_cache.finish(user_id, key, payload if status == 200 else None)
+    return jsonify(payload), status, limit_headers(payload, status)
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream_endpoint():
+    """Stream the reply as server-sent events, one `message` event per bubble."""
+    data = request.json
+    user_id = request_user_id(request.headers.get("X-User-Id"), data)
+    if user_id is None:
+        return invalid_user_response()
+    message = data.get("message", "").strip()
+
+    if not message:
+        return jsonify({"error": "No message provided"}), 400
+
+    key = request.headers.get("Idempotency-Key")
+    if not valid_idempotency_key(key):
+        return jsonify({"error": "Invalid Idempotency-Key"}), 400
+    replay = reply_cache.begin(user_id, key) if key is not None else None
+
+    # Until the stream takes over the claimed key, any early exit releases it
+    streaming = False
+    try:
+        if replay is not None:
+            command_reply = replay["messages"]
+        else:
+            command_reply = handle_command(message, user_id)
+        if command_reply is None:
+            limited = limited_reply(user_id)
+            if limited is not None:
+                return jsonify(limited[0]), 429, limit_headers(*limited)
+        variant = get_variant(user_id)
+        streaming = True
+    finally:
+        if key is not None and replay is None and not streaming:
+            reply_cache.finish(user_id, key, None)
+
+    def generate():
+        # Bubbles sent so far, kept for replay once the stream completes
+        paragraphs = []
+        completed = False
+        try:
+            if command_reply is not None:
+                for paragraph in command_reply:
+                    paragraphs.append(paragraph)
+                    yield sse_event("message", {"text": paragraph})
+                completed = True
+                yield sse_event("done", {})
+                return
+            try:
+                with metrics.trace_request("/chat/stream"):
+                    for paragraph in iter_paragraphs(chat_stream(user_id, message, variant=variant)):
+                        paragraphs.append(paragraph)
+                        yield sse_event("message", {"text": paragraph})
+                    touch_session(user_id)
+            except ModelUnavailableError:
+                app.logger.warning("Model unavailable", exc_info=True)
+                yield sse_event("error", {"error": UNAVAILABLE_MESSAGE})
+                return
+            except Exception:
+                app.logger.exception("Streaming chat failed")
+                yield sse_event("error", {"error": "Something went wrong. Please try again."})
+                return
+            completed = True
+            yield sse_event("done", {})
+        finally:
+            if key is not None and replay is None:
+                reply_cache.finish(user_id, key, {"messages": paragraphs} if completed else None)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Per-stage latency histograms and cache counters in the Prometheus text format."""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":